@@ -0,0 +1,96 @@
+###
+### Learned aliases: the names users type -> the title or theater they resolved to.
+###
+### Whenever a fuzzy match resolves a typed name (other than exactly), the
+### normalized input is recorded against the entity it matched, so the next time
+### anyone types it the handlers resolve it with a cache lookup instead of a
+### matcher pass. Aliases are scoped to the candidates they were matched among
+### (the matcher's fingerprint): the same shorthand ("star", "amc 16") can best
+### match a different title or theater once the candidates differ, as between
+### zip codes or days, and names that match a candidate exactly are never looked
+### up here.
+###
+### The aliases for one set of candidates are kept together, as one table in a
+### cache shared through the CACHE_DIR/CACHE_REDIS_URL tier when one is
+### configured, so they survive cold starts and are shared between containers.
+### Each table holds at most ALIAS_CACHE_SIZE aliases (the least recently
+### learned go first; 0 turns aliases off), an alias decays ALIAS_TTL seconds
+### after it was learned, and a table expires with the last of its aliases, so
+### the second tier never holds more than one bounded table per set of
+### candidates in use. Containers learning for the same candidates at once may
+### overwrite each other's latest alias, which is then simply learned again.
+###
+
+import os
+import time
+import threading
+
+import tracing
+from cache import build_cache
+from matcher import normalize
+
+CACHE_SIZE = int(os.environ.get('ALIAS_CACHE_SIZE', 1024))
+TTL = int(os.environ.get('ALIAS_TTL', 3 * 24 * 3600))
+# number of alias tables (sets of candidates) kept in each container's memory
+TABLES = int(os.environ.get('ALIAS_TABLES', 64))
+
+cache = build_cache(TABLES, TTL, name='alias_tables')
+counts = {}
+_lock = threading.Lock()
+
+
+def _count(kind, event):
+    with _lock:
+        kind_counts = counts.setdefault(kind, {'hits': 0, 'misses': 0, 'learned': 0})
+        kind_counts[event] += 1
+
+
+def key(kind, scope):
+    return 'alias:%s:%s' % (kind, scope or '')
+
+
+def lookup(kind, scope, name, available):
+    ###
+    ### Returns the entity name was last resolved to among the candidates
+    ### identified by scope, if available(entity) (e.g. the title is still
+    ### showing), otherwise None.
+    ###
+    if CACHE_SIZE <= 0:
+        return None
+    alias = None
+    # {normalized name: [entity, time the alias expires]}
+    table = cache.get(key(kind, scope))
+    if table is not None:
+        entry = table.get(normalize(name))
+        if entry is not None and entry[1] >= time.time() and available(entry[0]):
+            alias = entry[0]
+    _count(kind, 'misses' if alias is None else 'hits')
+    tracing.incr('aliases.%s' % ('miss' if alias is None else 'hit'))
+    return alias
+
+
+def learn(kind, scope, name, entity):
+    if CACHE_SIZE <= 0:
+        return
+    now = time.time()
+    name = normalize(name)
+    # tables are shared with concurrent lookups, so they are replaced, never changed
+    table = dict((n, entry) for n, entry in (cache.get(key(kind, scope)) or {}).items() if entry[1] >= now and n != name)
+    table[name] = [entity, now + TTL]
+    while len(table) > CACHE_SIZE:
+        del table[next(iter(table))]
+    cache.set(key(kind, scope), table)
+    _count(kind, 'learned')
+
+
+def stats():
+    ###
+    ### Returns {kind: hits, misses, aliases learned and the share of lookups
+    ### that skipped the matcher}.
+    ###
+    with _lock:
+        report = {}
+        for kind, kind_counts in counts.items():
+            lookups = kind_counts['hits'] + kind_counts['misses']
+            report[kind] = dict(kind_counts, hit_rate=round(kind_counts['hits'] / float(lookups), 3) if lookups else 0.0)
+        return report
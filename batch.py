@@ -0,0 +1,113 @@
+###
+### Batch evaluation of Lex events, for replaying conversation logs, regression
+### testing and pre-computing popular answers.
+###
+### Events are taken CHUNK_SIZE at a time. Within a chunk, the fulfillment
+### events are grouped by the showings they read (zip code and number of days)
+### and by the TMDb title they ask about. Each group's data is fetched and
+### indexed once, up to CONCURRENCY groups at a time, and handed to every event
+### in the group, so those events also share the view's fuzzy matchers. The
+### handlers then run in input order, and responses are yielded in that order.
+###
+
+import os
+import logging
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+
+import arrow
+
+import quota
+import tracing
+import moviebot
+from matcher import normalize
+
+logger = logging.getLogger()
+
+CHUNK_SIZE = int(os.environ.get('BATCH_CHUNK_SIZE', 1000))
+CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', 4))
+
+
+def error(event, e):
+    logger.exception('batch event failed userId={}'.format(event.get('userId') if isinstance(event, dict) else None))
+    return {'error': str(e)}
+
+
+def evaluate(events, concurrency=CONCURRENCY):
+    ###
+    ### Yields the response to each of events (a list), or {'error': message}
+    ### for an event that could not be handled.
+    ###
+    import showings
+    import tmdb
+
+    start_date = arrow.utcnow().to('-07:00')
+    date = start_date.format('YYYY-MM-DD')
+    prepared = []
+    views = {}
+    details = {}
+    for event in events:
+        try:
+            spec, context, response = moviebot.begin(event)
+        except Exception as e:
+            prepared.append((None, None, error(event, e)))
+            continue
+        if response is None:
+            # every event in the chunk sees the same current time
+            context.provide(start_date=start_date)
+            if spec.showings_days:
+                views.setdefault((context.zipcode, spec.showings_days), []).append(context)
+            if spec.detail:
+                details.setdefault(normalize(context.slots['movie_title']), []).append(context)
+        prepared.append((spec, context, response))
+    tracing.incr('batch.groups', len(views) + len(details))
+
+    def load_view(key):
+        # a batch is bulk work, so it only uses the quota not reserved for users
+        with quota.background():
+            return showings.repository.get(key[0], date, key[1])
+
+    def load_detail(key):
+        with quota.background():
+            return tmdb.movie_detail(details[key][0].slots['movie_title']) or False
+
+    with tracing.span('batch.load'), ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        view_futures = [pool.submit(load_view, key) for key in views]
+        detail_futures = [pool.submit(load_detail, key) for key in details]
+        for contexts, future in zip(views.values(), view_futures):
+            for context in contexts:
+                context.provide(movies=future.result())
+        for contexts, future in zip(details.values(), detail_futures):
+            for context in contexts:
+                context.provide(detail=future.result())
+
+    for event, (spec, context, response) in zip(events, prepared):
+        if response is None:
+            try:
+                with tracing.span('handler'):
+                    response = spec.handler(context)
+            except Exception as e:
+                response = error(event, e)
+        yield response
+
+
+def batch(events, chunk_size=CHUNK_SIZE, concurrency=CONCURRENCY):
+    ###
+    ### Yields the response to each event of the iterable events, in order.
+    ###
+    events = iter(events)
+    while True:
+        chunk = list(islice(events, chunk_size))
+        if not chunk:
+            return
+        tracing.incr('batch.events', len(chunk))
+        for response in evaluate(chunk, concurrency):
+            yield response
+
+
+def handler(event, context):
+    # see moviebot.batch_handler
+    with tracing.invocation(Intent='Batch'):
+        responses = list(batch(event.get('events') or []))
+    moviebot.log_stats()
+    return {'responses': responses}
@@ -0,0 +1,73 @@
+###
+### Throughput of the batch entry point (batch.py) against handling the same
+### events one lambda_handler call at a time, with every upstream call served by
+### the stub server and the caches cleared before each run. The same number of
+### events is spread over fewer, larger groups (zip codes) in each round, and the
+### batch responses are checked against the one-at-a-time responses.
+###
+### usage: python bench/bench_batch.py [events] [latency_ms]
+###
+
+import os
+import sys
+import time
+
+from fixtures import ROOT, showings_payload, movie_titles, conversations, unlimited_quotas
+from stub_server import StubServer
+
+GROUP_SIZES = (3, 30, 300)
+
+
+def clear_caches():
+    caches = []
+    if 'showings' in sys.modules:
+        caches += [sys.modules['showings'].repository.cache, sys.modules['showings'].repository.locations]
+    if 'tmdb' in sys.modules:
+        caches += [sys.modules['tmdb'].titles, sys.modules['tmdb'].details]
+    for cache in caches:
+        cache.first.clear()
+
+
+def make_events(n_events, group_size, titles):
+    n_zips = max(1, n_events // group_size)
+    payloads = {'%05d' % (20000 + i): showings_payload(20, 10, 3, seed=20000 + i) for i in range(n_zips)}
+    events = [e for turns in conversations(payloads, n_events, 0, titles) for e in turns]
+    # fulfillment requests only, as a replayed log would hold them
+    return payloads, [e for e in events if e['invocationSource'] == 'FulfillmentCodeHook'][:n_events]
+
+
+def main(n_events=300, latency=20):
+    titles = movie_titles(200)
+    rounds = [(group_size,) + make_events(n_events, group_size, titles) for group_size in GROUP_SIZES]
+    showings = {}
+    for group_size, payloads, events in rounds:
+        showings.update(payloads)
+    with StubServer(latency=latency / 1000.0, showings=showings, titles=titles) as stub:
+        os.environ.update({'TMS_API_KEY': 'bench', 'TMDB_API_KEY': 'bench', 'TMS_API_URL': stub.url + '/tms/v1.1', 'TMDB_API_URL': stub.url + '/tmdb/3'})
+        unlimited_quotas()
+        sys.path.insert(0, ROOT)
+        import logging
+        import moviebot
+        import batch
+        logging.getLogger().setLevel(logging.CRITICAL)
+
+        print('%d events, stub latency %g ms' % (n_events, latency))
+        print('%10s %8s %14s %14s %10s' % ('group size', 'groups', 'single ev/s', 'batch ev/s', 'upstream'))
+        for group_size, payloads, events in rounds:
+            clear_caches()
+            t = time.perf_counter()
+            expected = [moviebot.lambda_handler(e, None) for e in events]
+            single = time.perf_counter() - t
+
+            clear_caches()
+            before = sum(stub.counts.values())
+            t = time.perf_counter()
+            actual = list(batch.batch(events))
+            elapsed = time.perf_counter() - t
+            assert actual == expected, 'batch responses differ'
+            print('%10d %8d %14.1f %14.1f %10d' % (
+                group_size, len(payloads), len(events) / single, len(events) / elapsed, sum(stub.counts.values()) - before))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
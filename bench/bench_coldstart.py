@@ -0,0 +1,90 @@
+###
+### Cold-start measurements: `python -X importtime` for `import moviebot`, and the
+### import time plus first-invocation time of every intent, each in a fresh
+### interpreter, against the local stub server.
+###
+### usage: python bench/bench_coldstart.py [repeat]
+###
+
+import os
+import sys
+import json
+import subprocess
+
+from fixtures import ROOT, movie_titles, UNLIMITED_QUOTAS
+from stub_server import StubServer
+
+EVENTS = {
+    'GetHelp': ('FulfillmentCodeHook', {}),
+    'GetMovies (validation)': ('DialogCodeHook', {'zipcode': '85701'}),
+    'GetMovies': ('FulfillmentCodeHook', {'zipcode': '85701'}),
+    'FindMovie': ('FulfillmentCodeHook', {'movie_title': None, 'zipcode': '85701'}),
+    'GetTheaterMovies': ('FulfillmentCodeHook', {'theater_name': 'amc town square', 'zipcode': '85701'}),
+    'FindShowtimes': ('FulfillmentCodeHook', {'movie_title': None, 'theater_name': 'amc town square', 'zipcode': '85701'}),
+    'GetMovieDetail': ('FulfillmentCodeHook', {'movie_title': None})
+}
+
+FIRST_INVOCATION = '''
+import sys, json, time, logging
+t = time.perf_counter()
+import moviebot
+imported = time.perf_counter()
+logging.getLogger().setLevel(logging.WARNING)
+moviebot.lambda_handler(json.loads(sys.argv[1]), None)
+done = time.perf_counter()
+print(json.dumps({'import_ms': (imported - t) * 1000, 'invoke_ms': (done - imported) * 1000, 'modules': len(sys.modules)}))
+'''
+
+
+def importtime(env):
+    ###
+    ### Returns the total import time of moviebot (us) and its slowest imports.
+    ###
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import moviebot'], cwd=ROOT, env=env, stderr=subprocess.PIPE, universal_newlines=True)
+    rows = []
+    for line in p.stderr.splitlines():
+        if line.startswith('import time:') and 'self [us]' not in line:
+            self_us, cumulative_us, name = line[len('import time:'):].split('|')
+            rows.append((int(cumulative_us), int(self_us), name.rstrip()))
+    # moviebot's own imports are the nested entries printed just before it
+    end = [i for i, r in enumerate(rows) if r[2] == ' moviebot']
+    if not end:
+        return 0, []
+    start = end[0]
+    while start > 0 and rows[start - 1][2].startswith('  '):
+        start -= 1
+    return rows[end[0]][0], sorted(rows[start:end[0] + 1], reverse=True)[:10]
+
+
+def event(intent, title):
+    source, slots = EVENTS[intent]
+    slots = {k: (title if v is None else v) for k, v in slots.items()}
+    return {'bot': {'name': 'MovieBot'}, 'userId': 'bench', 'invocationSource': source, 'sessionAttributes': {'zipcode': '85701'},
+            'currentIntent': {'name': intent.split(' ')[0], 'slots': slots}}
+
+
+def main(repeat=3):
+    titles = movie_titles(200)
+    with StubServer(titles=titles) as stub:
+        env = dict(os.environ, TMS_API_KEY='bench', TMDB_API_KEY='bench', TMS_API_URL=stub.url + '/tms/v1.1',
+                   TMDB_API_URL=stub.url + '/tmdb/3', PYTHONDONTWRITEBYTECODE='1')
+        env.pop('CACHE_DIR', None)
+        env.pop('SHOWINGS_STORE_DIR', None)
+        for name, value in UNLIMITED_QUOTAS.items():
+            env.setdefault(name, value)
+        total, slowest = importtime(env)
+        print('import moviebot: %.1f ms' % (total / 1000.0))
+        for cumulative, own, name in slowest:
+            print('    %8.1f ms cumulative %8.1f ms self  %s' % (cumulative / 1000.0, own / 1000.0, name.strip()))
+        print('\n%-24s %10s %12s %8s' % ('first invocation', 'import ms', 'invoke ms', 'modules'))
+        for intent in EVENTS:
+            samples = []
+            for _ in range(repeat):
+                out = subprocess.check_output([sys.executable, '-c', FIRST_INVOCATION, json.dumps(event(intent, titles[0]))], cwd=ROOT, env=env)
+                samples.append(json.loads(out))
+            best = min(samples, key=lambda s: s['import_ms'] + s['invoke_ms'])
+            print('%-24s %10.1f %12.1f %8d' % (intent, best['import_ms'], best['invoke_ms'], best['modules']))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
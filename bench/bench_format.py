@@ -0,0 +1,70 @@
+###
+### Compare the original Arrow-based showtime formatting in get_showtimes against
+### the memoized label tables in showings (clock_label, day_label, group_by_day)
+### on a dense multiplex fixture: one theater showing every title many times a
+### day. Also checks that the tables agree with Arrow for every minute of the day
+### and every day of two years.
+###
+### usage: python bench/bench_format.py [n_movies] [num_days] [shows_per_day]
+###
+
+import sys
+import time
+import datetime
+
+import arrow
+
+from fixtures import showings_payload
+import showings
+
+
+def legacy(times):
+    showtimes = {}
+    for minutes in times:
+        showtime = arrow.get(showings.from_minutes(minutes))
+        showtime_key = showtime.format('YYYY-MM-DD')
+        if showtime_key in showtimes:
+            showtimes[showtime_key].append(showtime.format('h:mm a'))
+        else:
+            showtimes[showtime_key] = [showtime.format('h:mm a')]
+    return ["*%s*\n```%s```" % (arrow.get(s, 'YYYY-MM-DD').format('ddd, MMM Do'), "\n".join(showtimes[s])) for s in sorted(showtimes.keys())]
+
+
+def tables(times):
+    return ["*%s*\n```%s```" % (day, "\n".join(labels)) for day, labels in showings.group_by_day(times)]
+
+
+def check_labels():
+    start = datetime.datetime(2018, 1, 1)
+    for m in range(showings.MINUTES_PER_DAY):
+        assert showings.clock_label(m) == arrow.get(start + datetime.timedelta(minutes=m)).format('h:mm a'), m
+    day = showings.to_minutes('2018-01-01') // showings.MINUTES_PER_DAY
+    for d in range(2 * 366):
+        assert showings.day_label(day + d) == arrow.get(start + datetime.timedelta(days=d)).format('ddd, MMM Do'), d
+
+
+def timed(fn, runs):
+    t = time.perf_counter()
+    results = [fn(times) for times in runs]
+    return time.perf_counter() - t, results
+
+
+def main(n_movies=40, num_days=7, shows_per_day=16):
+    check_labels()
+    index = showings.ShowingsIndex.build(showings_payload(n_movies, 1, num_days, shows_per_day=(shows_per_day, shows_per_day)))
+    runs = [index.pair_times(p) for p in index.pair_order]
+    n_showtimes = sum(len(times) for times in runs)
+    print('multiplex: %d titles, %d days, %d showtimes' % (len(runs), num_days, n_showtimes))
+
+    legacy_time, expected = timed(legacy, runs)
+    # first pass builds the tables, later passes are what a warm container sees
+    cold_time, actual = timed(tables, runs)
+    assert expected == actual, 'label tables disagree with arrow'
+    warm_time, actual = timed(tables, runs)
+    print('arrow  %8.2f us/showtime' % (legacy_time * 1e6 / n_showtimes))
+    print('tables %8.2f us/showtime (cold)   %6.2f us/showtime (warm)   speedup %6.1fx' % (
+        cold_time * 1e6 / n_showtimes, warm_time * 1e6 / n_showtimes, legacy_time / warm_time))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,80 @@
+###
+### Compare the original per-showtime `similar()` loops from get_showtimes and
+### get_theater_movies against FuzzyMatcher on a large synthetic payload.
+###
+### usage: python bench/bench_matcher.py [n_movies] [n_theaters] [n_queries]
+###
+
+import sys
+import time
+import random
+from difflib import SequenceMatcher
+
+from fixtures import showings_payload, misspell
+from matcher import FuzzyMatcher
+
+
+def similar(a, b):
+    return SequenceMatcher(None, a, b).ratio()
+
+
+def legacy_title(movies, movie_title):
+    best_sim = 0
+    best_title = ''
+    for m in movies:
+        prob = similar(m['title'].lower().strip(), movie_title.lower().strip())
+        if prob >= 0.5:
+            if prob > best_sim:
+                best_sim = prob
+                best_title = m['title']
+    return best_title
+
+
+def legacy_theater(movies, theater_name):
+    best_sim = 0
+    best_theater = ''
+    for m in movies:
+        for s in m['showtimes']:
+            prob = similar(s['theatre']['name'].lower().strip(), theater_name.lower().strip())
+            if prob >= 0.5:
+                if prob > best_sim:
+                    best_sim = prob
+                    best_theater = s['theatre']['name']
+    return best_theater
+
+
+def timed(fn, queries):
+    t = time.perf_counter()
+    results = [fn(q) for q in queries]
+    return time.perf_counter() - t, results
+
+
+def main(n_movies=120, n_theaters=60, n_queries=50):
+    movies = showings_payload(n_movies, n_theaters)
+    n_showtimes = sum(len(m['showtimes']) for m in movies)
+    rnd = random.Random(1)
+    titles = [m['title'] for m in movies]
+    theater_names = list(dict.fromkeys(s['theatre']['name'] for m in movies for s in m['showtimes']))
+    title_queries = [misspell(rnd.choice(titles), rnd) for _ in range(n_queries)]
+    theater_queries = [misspell(rnd.choice(theater_names), rnd) for _ in range(n_queries)]
+    print('payload: %d movies, %d theaters, %d showtimes; %d queries each' % (len(movies), len(theater_names), n_showtimes, n_queries))
+
+    t = time.perf_counter()
+    title_matcher = FuzzyMatcher(titles)
+    theater_matcher = FuzzyMatcher(theater_names)
+    build = time.perf_counter() - t
+    print('matcher build: %.2f ms' % (build * 1000))
+
+    for label, legacy, matcher, queries in (
+            ('titles', lambda q: legacy_title(movies, q), title_matcher, title_queries),
+            ('theaters', lambda q: legacy_theater(movies, q), theater_matcher, theater_queries)):
+        legacy_time, expected = timed(legacy, queries)
+        fast_time, actual = timed(lambda q: matcher.match(q) or '', queries)
+        assert expected == actual, 'matcher disagrees with legacy loop'
+        print('%-8s legacy %8.2f ms/query   matcher %6.3f ms/query   speedup %6.1fx   full ratios/query %.1f' % (
+            label, legacy_time * 1000 / len(queries), fast_time * 1000 / len(queries),
+            legacy_time / fast_time, matcher.stats['ratios'] / float(matcher.stats['queries'])))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,70 @@
+###
+### Measure GetMovieDetail latency against the stub server: the original four
+### sequential TMDb requests vs. the concurrent fan-out vs. a single
+### append_to_response request.
+###
+### usage: python bench/bench_movie_detail.py [latency_ms] [iterations]
+###
+
+import os
+import sys
+import time
+
+from fixtures import movie_titles, unlimited_quotas
+from stub_server import StubServer
+
+import requests
+
+
+def legacy_detail(base, movie_id):
+    # the original code path: three more requests, one after the other
+    key = os.environ['TMDB_API_KEY']
+    requests.get('%s/movie/%s/release_dates' % (base, movie_id), params={'api_key': key})
+    requests.get('%s/movie/%s' % (base, movie_id), params={'api_key': key, 'language': 'en-US'})
+    requests.get('%s/movie/%s/credits' % (base, movie_id), params={'api_key': key})
+
+
+def run(label, fn, titles, stub):
+    requests_before = sum(stub.counts.values())
+    samples = []
+    for title in titles:
+        t = time.perf_counter()
+        fn(title)
+        samples.append((time.perf_counter() - t) * 1000)
+    samples.sort()
+    print('%-18s mean %7.1f ms   p50 %7.1f ms   max %7.1f ms   upstream requests/lookup %.1f' % (
+        label, sum(samples) / len(samples), samples[len(samples) // 2], samples[-1],
+        (sum(stub.counts.values()) - requests_before) / float(len(titles))))
+
+
+def main(latency_ms=50, iterations=20):
+    titles = movie_titles(200)
+    os.environ.setdefault('TMDB_API_KEY', 'bench')
+    # otherwise the tmdb.py paths would be measuring quota waits
+    unlimited_quotas()
+    with StubServer(latency=latency_ms / 1000.0, titles=titles) as stub:
+        os.environ['TMDB_API_URL'] = stub.url + '/tmdb/3'
+        import tmdb
+        queries = titles[:iterations]
+        print('stub latency %d ms per request, %d lookups' % (latency_ms, len(queries)))
+
+        def uncached(title):
+            # measure the fetch path, not the detail cache
+            tmdb.titles.first.clear()
+            tmdb.details.first.clear()
+            tmdb.movie_detail(title)
+
+        def sequential(title):
+            timings = {}
+            movie_id, _ = tmdb.search(title, timings)
+            legacy_detail(tmdb.TMDB_URL, movie_id)
+
+        run('sequential', sequential, queries, stub)
+        tmdb.APPEND_TO_RESPONSE = False
+        run('fan-out', uncached, queries, stub)
+        tmdb.APPEND_TO_RESPONSE = True
+        run('append_to_response', uncached, queries, stub)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,88 @@
+###
+### Compare peak memory and parse time of r.json() + index build against the
+### streaming parse on a large showings payload. Each mode runs in a fresh
+### interpreter so that peak RSS is measured independently. Memory is measured
+### on a first, traced run; the times are the best and median of RUNS untraced
+### runs, as tracing slows the two modes down by different amounts.
+###
+### usage: python bench/bench_parse.py [n_movies] [n_theaters] [num_days]
+###        python bench/bench_parse.py --payload recorded_showings.json
+###
+
+import os
+import sys
+import json
+import time
+import gc
+import resource
+import tempfile
+import subprocess
+import tracemalloc
+
+from fixtures import showings_payload
+import showings
+
+CHUNK_SIZE = showings.CHUNK_SIZE
+RUNS = 7
+
+
+def parse(mode, path):
+    if mode == 'json':
+        # what requests does: read the whole body, then decode it
+        with open(path, 'rb') as f:
+            body = f.read()
+        return showings.ShowingsIndex.build(json.loads(body.decode('utf-8')))
+    with open(path, 'rb') as f:
+        return showings.ShowingsIndex.build(showings.iter_movies(iter(lambda: f.read(CHUNK_SIZE), b'')))
+
+
+def run_mode(mode, path):
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    index = parse(mode, path)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    samples = []
+    for _ in range(RUNS):
+        gc.collect()
+        t = time.perf_counter()
+        parse(mode, path)
+        samples.append((time.perf_counter() - t) * 1000)
+    samples.sort()
+    print(json.dumps({
+        'ms': round(samples[0], 1),
+        'median_ms': round(samples[len(samples) // 2], 1),
+        'peak_mb': round(peak / 1048576.0, 1),
+        'retained_mb': round(current / 1048576.0, 1),
+        'rss_growth_mb': round((rss_after - rss_before) / 1024.0, 1),
+        'showings': len(index)
+    }))
+
+
+def main(args):
+    if args[:1] == ['--mode']:
+        return run_mode(args[1], args[2])
+    if args[:1] == ['--payload']:
+        path = args[1]
+    else:
+        n_movies, n_theaters, num_days = ([int(a) for a in args] + [200, 80, 3][len(args):])[:3]
+        movies = showings_payload(n_movies, n_theaters, num_days)
+        fd, path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(movies, f)
+        del movies
+    print('payload %s: %.1f MB' % (path, os.path.getsize(path) / 1048576.0))
+    try:
+        for mode in ('json', 'streaming'):
+            out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--mode', mode, path])
+            r = json.loads(out)
+            print('%-10s best %7.1f ms   median %7.1f ms   peak traced %7.1f MB   retained %5.1f MB   RSS growth %7.1f MB   (%d showings)' % (
+                mode, r['ms'], r['median_ms'], r['peak_mb'], r['retained_mb'], r['rss_growth_mb'], r['showings']))
+    finally:
+        if args[:1] != ['--payload']:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,187 @@
+###
+### Replay Lex conversations against lambda_handler with every upstream call
+### served by the local stub server, and report per-intent latency percentiles,
+### CPU time, peak memory and upstream request counts.
+###
+### usage: python bench/bench_replay.py [--conversations N] [--latency MS]
+###            [--events recorded.jsonl] [--payload ZIP=showings.json ...]
+###            [--cold] [--geo] [--async] [--deadline MS] [--tracemalloc]
+###            [--json results.json]
+###
+### Without --payload, three zip codes are served synthetic payloads of small,
+### medium and large size. --events replays recorded Lex events (one JSON
+### event per line) instead of synthesized conversations. --cold clears the
+### in-process caches before every conversation. --geo gives the zip codes a
+### (synthetic) zip code table, so showings are fetched per cluster and each
+### theater list is filtered by distance, which takes a second TMS call.
+### --async runs lambda_handler with ASYNC_HANDLER=true; compare it with a
+### plain run (with --cold --geo, for intents making more than one call).
+### --deadline gives each invocation a Lambda context with MS milliseconds
+### left, so a --latency above it shows the degraded responses (see deadline.py).
+###
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import tracemalloc
+from array import array
+
+from fixtures import ROOT, showings_payload, movie_titles, conversations, unlimited_quotas
+from stub_server import StubServer
+
+SIZES = {'85701': (20, 10), '85702': (60, 40), '10001': (150, 80)}
+# far enough apart that every zip is its own cluster
+ORIGINS = {'85701': (32.2, -110.95), '85702': (32.9, -111.7), '10001': (40.75, -73.99)}
+
+
+def write_zip_table(path):
+    sys.path.insert(0, ROOT)
+    import geo
+    zips = sorted(ORIGINS)
+    geo.ZipTable(
+        array('I', [int(z) for z in zips]),
+        array('i', [int(round(ORIGINS[z][0] * geo.SCALE)) for z in zips]),
+        array('i', [int(round(ORIGINS[z][1] * geo.SCALE)) for z in zips])
+    ).save(path)
+
+
+class LambdaContext(object):
+    ###
+    ### The part of the Lambda context object the bot reads.
+    ###
+
+    def __init__(self, millis):
+        self.expires = time.monotonic() + millis / 1000.0
+
+    def get_remaining_time_in_millis(self):
+        return int((self.expires - time.monotonic()) * 1000)
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))]
+
+
+def clear_caches():
+    caches = []
+    if 'showings' in sys.modules:
+        caches += [sys.modules['showings'].repository.cache, sys.modules['showings'].repository.locations]
+    if 'tmdb' in sys.modules:
+        caches += [sys.modules['tmdb'].titles, sys.modules['tmdb'].details]
+    for cache in caches:
+        cache.first.clear()
+
+
+def replay(moviebot, stub, turns, results, trace, millis=None):
+    for event in turns:
+        key = event['currentIntent']['name']
+        if event['invocationSource'] == 'DialogCodeHook':
+            key += ' (validation)'
+        before = sum(stub.counts.values())
+        if trace:
+            tracemalloc.reset_peak()
+        cpu = time.process_time()
+        t = time.perf_counter()
+        moviebot.lambda_handler(event, LambdaContext(millis) if millis else None)
+        wall = (time.perf_counter() - t) * 1000
+        cpu = (time.process_time() - cpu) * 1000
+        r = results.setdefault(key, {'wall': [], 'cpu': [], 'upstream': 0, 'peak': 0})
+        r['wall'].append(wall)
+        r['cpu'].append(cpu)
+        r['upstream'] += sum(stub.counts.values()) - before
+        if trace:
+            r['peak'] = max(r['peak'], tracemalloc.get_traced_memory()[1])
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='replay Lex conversations against the stub server')
+    parser.add_argument('--conversations', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=20, help='stub latency per request in ms')
+    parser.add_argument('--events', help='recorded Lex events, one JSON object per line')
+    parser.add_argument('--payload', action='append', default=[], help='ZIP=path of a recorded showings payload')
+    parser.add_argument('--cold', action='store_true', help='clear caches before every conversation')
+    parser.add_argument('--geo', action='store_true', help='cluster zip codes and filter theaters by distance')
+    parser.add_argument('--async', dest='async_handler', action='store_true', help='run the async handler path')
+    parser.add_argument('--deadline', type=float, help='time left in each invocation in ms')
+    parser.add_argument('--tracemalloc', action='store_true', help='trace peak memory per intent (slower)')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    payloads = {}
+    for spec in args.payload:
+        zipcode, path = spec.split('=', 1)
+        with open(path) as f:
+            payloads[zipcode] = json.load(f)
+    if not payloads:
+        payloads = {z: showings_payload(m, t, 3, seed=int(z)) for z, (m, t) in SIZES.items()}
+    titles = movie_titles(200)
+
+    if args.events:
+        with open(args.events) as f:
+            convos = [[json.loads(line) for line in f if line.strip()]]
+    else:
+        convos = conversations(payloads, args.conversations, args.seed, titles)
+
+    with StubServer(latency=args.latency / 1000.0, showings=payloads, titles=titles, origins=ORIGINS) as stub, tempfile.TemporaryDirectory() as tmp:
+        os.environ.update({'TMS_API_KEY': 'bench', 'TMDB_API_KEY': 'bench', 'TMS_API_URL': stub.url + '/tms/v1.1', 'TMDB_API_URL': stub.url + '/tmdb/3'})
+        # without --geo, point ZIP_TABLE at a table that does not exist
+        os.environ['ZIP_TABLE'] = os.path.join(tmp, 'zipcodes.bin')
+        if args.geo:
+            write_zip_table(os.environ['ZIP_TABLE'])
+        os.environ['ASYNC_HANDLER'] = 'true' if args.async_handler else 'false'
+        unlimited_quotas()
+        sys.path.insert(0, ROOT)
+        import logging
+        import moviebot
+        logging.getLogger().setLevel(logging.WARNING)
+
+        if args.tracemalloc:
+            tracemalloc.start()
+        results = {}
+        start = time.perf_counter()
+        for turns in convos:
+            if args.cold:
+                clear_caches()
+            replay(moviebot, stub, turns, results, args.tracemalloc, args.deadline)
+        elapsed = time.perf_counter() - start
+
+    events = sum(len(r['wall']) for r in results.values())
+    print('%d events in %d conversations, %.1f s (%.1f events/s), stub latency %g ms, %s handler, peak RSS %.1f MB' % (
+        events, len(convos), elapsed, events / elapsed, args.latency, 'async' if args.async_handler else 'sync', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+    print('%-30s %6s %9s %9s %9s %9s %10s %10s' % ('intent', 'n', 'p50 ms', 'p95 ms', 'p99 ms', 'cpu ms', 'upstream', 'peak MB'))
+    summary = {}
+    for key in sorted(results):
+        r = results[key]
+        n = len(r['wall'])
+        summary[key] = {
+            'n': n,
+            'p50_ms': round(percentile(r['wall'], 50), 2),
+            'p95_ms': round(percentile(r['wall'], 95), 2),
+            'p99_ms': round(percentile(r['wall'], 99), 2),
+            'cpu_ms': round(sum(r['cpu']) / n, 2),
+            'upstream_per_event': round(r['upstream'] / float(n), 3),
+            'peak_mb': round(r['peak'] / 1048576.0, 2)
+        }
+        s = summary[key]
+        print('%-30s %6d %9.1f %9.1f %9.1f %9.2f %10.3f %10s' % (
+            key, n, s['p50_ms'], s['p95_ms'], s['p99_ms'], s['cpu_ms'], s['upstream_per_event'],
+            '%.2f' % s['peak_mb'] if args.tracemalloc else '-'))
+    print('upstream requests: %s' % json.dumps({k: v for k, v in sorted(stub.counts.items()) if '/movie/' not in k}))
+    if args.deadline:
+        print('degraded responses: %s' % json.dumps(sys.modules['deadline'].stats(), sort_keys=True))
+    if 'aliases' in sys.modules:
+        print('aliases: %s' % json.dumps(sys.modules['aliases'].stats(), sort_keys=True))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'events': events, 'elapsed_s': elapsed, 'latency_ms': args.latency, 'cold': args.cold, 'geo': args.geo, 'async': args.async_handler, 'deadline_ms': args.deadline, 'intents': summary}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
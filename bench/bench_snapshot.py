@@ -0,0 +1,108 @@
+###
+### Cold-load cost of a stored showings index and of the bundled TMDb snapshot:
+### re-parsing the JSON documents they used to be stored as vs. mapping the
+### binary snapshots (see snapshot.py), and the first query answered from each.
+###
+### usage: python bench/bench_snapshot.py [n_movies] [n_theaters] [num_days] [n_details]
+###
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+
+# keep every detail record in the cache for save_snapshot, and start without
+# any bundled snapshot
+os.environ['TMDB_CACHE_SIZE'] = '1000000'
+os.environ['TMDB_SNAPSHOT'] = os.path.join(tempfile.gettempdir(), 'bench-no-snapshot.bin')
+
+from fixtures import showings_payload, movie_titles
+from stub_server import tmdb_details, tmdb_credits
+import showings
+import tmdb
+
+
+def best_of(fn, runs=20):
+    best = None
+    for _ in range(runs):
+        t = time.perf_counter()
+        result = fn()
+        elapsed = (time.perf_counter() - t) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def detail_records(n):
+    records = {}
+    resolved = {}
+    for i, title in enumerate(movie_titles(n)):
+        movie_id = 1000 + i
+        details, credits = tmdb_details(movie_id, title), tmdb_credits(movie_id)
+        records['tmdb-detail:%d' % movie_id] = tmdb.assemble_detail(movie_id, title, {'release_dates': None, 'details': details, 'credits': credits})
+        resolved['tmdb-title:' + title.lower()] = [movie_id, title]
+    return resolved, records
+
+
+def main(n_movies=150, n_theaters=80, num_days=3, n_details=2000):
+    tmp = tempfile.mkdtemp()
+    index = showings.ShowingsIndex.build(showings_payload(n_movies, n_theaters, num_days))
+    index.fetched = int(time.time())
+    json_path = os.path.join(tmp, 'showings.json')
+    with open(json_path, 'w') as f:
+        json.dump({'fetched': index.fetched, 'index': index.to_dict()}, f, separators=(',', ':'))
+    snap_path = os.path.join(tmp, 'showings.snap')
+    index.save_snapshot(snap_path)
+
+    def from_json():
+        with open(json_path) as f:
+            return showings.ShowingsIndex.from_dict(json.load(f)['index'])
+
+    def query(loaded):
+        view = loaded.window(index.pair_times(0)[0], index.pair_times(0)[0] + showings.MINUTES_PER_DAY)
+        return view.titles(), [len(view.showtimes(title, view.theaters_for(title)[0])) for title in view.titles()]
+
+    print('showings: %d titles, %d theaters, %d showings; json %.1f KB, snapshot %.1f KB' % (
+        len(index.titles), len(index.theaters), len(index), os.path.getsize(json_path) / 1024.0, os.path.getsize(snap_path) / 1024.0))
+    json_ms, from_json_index = best_of(from_json)
+    snap_ms, snap_index = best_of(lambda: showings.ShowingsIndex.load_snapshot(snap_path))
+    json_query_ms, expected = best_of(lambda: query(from_json()))
+    snap_query_ms, actual = best_of(lambda: query(showings.ShowingsIndex.load_snapshot(snap_path)))
+    assert expected == actual, 'snapshot disagrees with json'
+    print('  json     load %8.3f ms   load + first query %8.3f ms' % (json_ms, json_query_ms))
+    print('  snapshot load %8.3f ms   load + first query %8.3f ms   %.0fx faster load' % (snap_ms, snap_query_ms, json_ms / snap_ms))
+
+    resolved, records = detail_records(n_details)
+    json_path = os.path.join(tmp, 'tmdb_snapshot.json')
+    with open(json_path, 'w') as f:
+        json.dump({'version': 1, 'created': int(time.time()), 'titles': resolved, 'details': records}, f, separators=(',', ':'))
+    for key, value in resolved.items():
+        tmdb.titles.first.set(key, value)
+    for key, value in records.items():
+        tmdb.details.first.set(key, value)
+    snap_path = os.path.join(tmp, 'tmdb_snapshot.bin')
+    tmdb.save_snapshot(snap_path)
+    key, (movie_id, title) = sorted(resolved.items())[n_details // 2]
+
+    def tmdb_json():
+        with open(json_path) as f:
+            data = json.load(f)
+        return data['details']['tmdb-detail:%d' % data['titles'][key][0]]
+
+    def tmdb_snap():
+        table = tmdb.DetailSnapshot(snap_path)
+        return table.detail(table.title(key)[0])
+
+    print('tmdb: %d titles and details; json %.1f KB, snapshot %.1f KB' % (
+        n_details, os.path.getsize(json_path) / 1024.0, os.path.getsize(snap_path) / 1024.0))
+    json_ms, expected = best_of(tmdb_json)
+    snap_ms, actual = best_of(tmdb_snap)
+    assert expected == actual, 'snapshot disagrees with json'
+    print('  json     load + one lookup %8.3f ms' % json_ms)
+    print('  snapshot load + one lookup %8.3f ms   %.0fx faster' % (snap_ms, json_ms / snap_ms))
+    shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,58 @@
+###
+### Memory held by a warm container that has served several metros: the raw
+### r.json() trees of their showings payloads vs. the columnar ShowingsIndex
+### built from them, in bytes per showing (measured with tracemalloc, and as
+### estimated by ShowingsIndex.nbytes for the cache's byte budget). Then fills a
+### byte-budgeted MemoryCache with the indexes to show what it keeps.
+###
+### usage: python bench/bench_store.py [n_metros] [n_movies] [n_theaters] [num_days]
+###
+
+import sys
+import json
+import gc
+import tracemalloc
+
+from fixtures import showings_payload
+import showings
+from cache import MemoryCache
+
+
+def retained(build, bodies):
+    ###
+    ### Returns what build(body) returns for every body, and the bytes they hold.
+    ###
+    gc.collect()
+    tracemalloc.start()
+    values = [build(body) for body in bodies]
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return values, current
+
+
+def main(n_metros=8, n_movies=120, n_theaters=60, num_days=3):
+    bodies = [json.dumps(showings_payload(n_movies, n_theaters, num_days, seed=seed)).encode('utf-8') for seed in range(n_metros)]
+    trees, tree_bytes = retained(lambda body: json.loads(body.decode('utf-8')), bodies)
+    n_showings = sum(len(m['showtimes']) for movies in trees for m in movies)
+    del trees
+    indexes, index_bytes = retained(lambda body: showings.ShowingsIndex.build(json.loads(body.decode('utf-8'))), bodies)
+    assert sum(len(index) for index in indexes) == n_showings
+    estimated = sum(index.nbytes() for index in indexes)
+
+    print('%d metros, %d showings, %.1f MB of JSON' % (n_metros, n_showings, sum(len(b) for b in bodies) / 1048576.0))
+    print('r.json() trees   %8.1f MB   %7.1f bytes/showing' % (tree_bytes / 1048576.0, tree_bytes / float(n_showings)))
+    print('columnar index   %8.1f MB   %7.1f bytes/showing   (nbytes estimate %.1f bytes/showing)   %.1fx smaller' % (
+        index_bytes / 1048576.0, index_bytes / float(n_showings), estimated / float(n_showings), tree_bytes / float(index_bytes)))
+
+    # a budget of half the indexes keeps the most recently used half
+    budget = estimated // 2
+    cache = MemoryCache(max_entries=len(indexes), max_bytes=budget, sizeof=showings.ShowingsIndex.nbytes)
+    for i, index in enumerate(indexes):
+        cache.set('metro-%d' % i, index)
+    print('cache budget     %8.1f MB   holds %d of %d metros (%.1f MB), %d evicted' % (
+        budget / 1048576.0, len(cache), len(indexes), cache.bytes / 1048576.0, cache.stats['evictions']))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,192 @@
+###
+### Synthetic Gracenote TMS / TMDb payloads for the benchmarks. Payloads follow
+### the shape of the real API responses, and are deterministic for a given seed.
+###
+
+import os
+import sys
+import random
+import datetime
+
+# make the Lambda modules importable when running a benchmark as a script
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+WORDS = [
+    'the', 'last', 'night', 'return', 'of', 'shadow', 'kingdom', 'war', 'star', 'river', 'dark',
+    'rising', 'ghost', 'city', 'lost', 'empire', 'fire', 'island', 'black', 'summer', 'storm',
+    'secret', 'game', 'wild', 'quiet', 'place', 'ready', 'player', 'one', 'blue', 'iron', 'heart'
+]
+CHAINS = ['AMC', 'Regal', 'Cinemark', 'Harkins', 'Century', 'Marcus', 'Alamo Drafthouse', 'Landmark']
+PLACES = ['Town Square', 'Mall', 'Downtown', 'Crossroads', 'Park Place', 'Riverside', 'Foothills', 'Plaza']
+# the stub server has no rate limits, so the API quotas (see quota.py) are
+# raised out of the way of the benchmarks
+UNLIMITED_QUOTAS = {name: '1000000' for name in ('QUOTA_TMS_RATE', 'QUOTA_TMS_BURST', 'QUOTA_TMDB_RATE', 'QUOTA_TMDB_BURST')}
+QUALS = ['Closed Captioned', 'Recliner Seats', 'Reserved Seating', 'Descriptive Video Services', 'No Passes']
+
+
+def unlimited_quotas():
+    ###
+    ### Raise the quotas for modules imported after this (unless set already).
+    ###
+    for name, value in UNLIMITED_QUOTAS.items():
+        os.environ.setdefault(name, value)
+
+
+def movie_titles(n, seed=0):
+    rnd = random.Random(seed)
+    titles = []
+    seen = set()
+    while len(titles) < n:
+        title = ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 4))).title()
+        if rnd.random() < 0.2:
+            title = '%s %d' % (title, rnd.randint(2, 4))
+        if title not in seen:
+            seen.add(title)
+            titles.append(title)
+    return titles
+
+
+def theaters(n, seed=0):
+    rnd = random.Random(seed + 1)
+    out = []
+    for i in range(n):
+        name = '%s %s %d' % (rnd.choice(CHAINS), rnd.choice(PLACES), rnd.choice([6, 8, 10, 12, 14, 16, 18, 20, 24]))
+        out.append({'id': str(5000 + i), 'name': name})
+    return out
+
+
+def showings_payload(n_movies=60, n_theaters=40, num_days=3, start_date=None, seed=0, shows_per_day=(2, 6)):
+    ###
+    ### Build a `movies/showings` style payload with n_movies titles spread over
+    ### n_theaters theaters for num_days days starting at start_date.
+    ###
+    rnd = random.Random(seed)
+    if start_date is None:
+        start_date = datetime.date.today()
+    titles = movie_titles(n_movies, seed)
+    venues = theaters(n_theaters, seed)
+    movies = []
+    for i, title in enumerate(titles):
+        showtimes = []
+        for venue in rnd.sample(venues, rnd.randint(1, max(1, n_theaters // 2))):
+            for day in range(num_days):
+                date = start_date + datetime.timedelta(days=day)
+                for _ in range(rnd.randint(*shows_per_day)):
+                    showtimes.append({
+                        'theatre': {'id': venue['id'], 'name': venue['name']},
+                        'dateTime': '%sT%02d:%02d' % (date.isoformat(), rnd.randint(10, 23), rnd.choice([0, 10, 15, 30, 45, 50])),
+                        'quals': '|'.join(rnd.sample(QUALS, 2)),
+                        'barg': rnd.random() < 0.2,
+                        'ticketURI': 'http://www.fandango.com/tms.asp?t=AA%s&m=%d&d=%s' % (venue['id'], 100000 + i, date.isoformat())
+                    })
+        showtimes.sort(key=lambda s: (s['dateTime'], s['theatre']['id']))
+        movies.append({
+            'tmsId': 'MV%09d' % (100000 + i),
+            'rootId': str(100000 + i),
+            'subType': 'Feature Film',
+            'title': title,
+            'releaseYear': 2018,
+            'releaseDate': '2018-03-%02d' % rnd.randint(1, 28),
+            'titleLang': 'en',
+            'descriptionLang': 'en',
+            'entityType': 'Movie',
+            'genres': rnd.sample(['Action', 'Drama', 'Comedy', 'Horror', 'Animated', 'Thriller'], 2),
+            'longDescription': ' '.join(rnd.choice(WORDS) for _ in range(60)),
+            'shortDescription': ' '.join(rnd.choice(WORDS) for _ in range(20)),
+            'topCast': [' '.join(rnd.choice(WORDS) for _ in range(2)).title() for _ in range(3)],
+            'directors': [' '.join(rnd.choice(WORDS) for _ in range(2)).title()],
+            'ratings': [{'body': 'Motion Picture Association of America', 'code': rnd.choice(['G', 'PG', 'PG-13', 'R'])}],
+            'runTime': 'PT0%dH%02dM' % (rnd.randint(1, 2), rnd.randint(0, 59)),
+            'preferredImage': {'uri': 'assets/p%d_v_v5_aa.jpg' % (100000 + i)},
+            'showtimes': showtimes
+        })
+    return movies
+
+
+def misspell(s, rnd):
+    ###
+    ### Lower-case s and apply one small typo, the way users type titles.
+    ###
+    s = s.lower()
+    if len(s) < 4:
+        return s
+    i = rnd.randrange(1, len(s) - 1)
+    op = rnd.randrange(3)
+    if op == 0:
+        return s[:i] + s[i + 1:]
+    if op == 1:
+        return s[:i] + s[i + 1] + s[i] + s[i + 2:]
+    return s[:i] + rnd.choice('aeiou') + s[i:]
+
+
+### --- Lex events --- ###
+
+
+def lex_event(intent, slots, session_attributes=None, source='FulfillmentCodeHook', user_id='bench'):
+    return {
+        'messageVersion': '1.0',
+        'invocationSource': source,
+        'userId': user_id,
+        'sessionAttributes': dict(session_attributes or {}),
+        'bot': {'name': 'MovieBot', 'alias': '$LATEST', 'version': '$LATEST'},
+        'outputDialogMode': 'Text',
+        'currentIntent': {'name': intent, 'slots': slots, 'confirmationStatus': 'None'},
+        'inputTranscript': ''
+    }
+
+
+def conversations(payloads, n, seed=0, tmdb_titles=None):
+    ###
+    ### Synthesize n conversations (lists of Lex events) covering all six intents.
+    ### payloads maps zip code -> showings payload served for it; titles and
+    ### theater names are drawn from the payload and typed with typos.
+    ###
+    rnd = random.Random(seed)
+    zipcodes = sorted(payloads)
+    out = []
+    for i in range(n):
+        user = 'user-%d' % i
+        zipcode = rnd.choice(zipcodes)
+        movies = payloads[zipcode]
+        movie = rnd.choice(movies)
+        title = movie['title']
+        theater = rnd.choice(movie['showtimes'])['theatre']['name']
+        typed_title = misspell(title, rnd) if rnd.random() < 0.5 else title.lower()
+        typed_theater = misspell(theater, rnd) if rnd.random() < 0.5 else theater.lower()
+        session = {'zipcode': zipcode}
+        kind = rnd.randrange(4)
+        if kind == 0:
+            # browse: list movies, pick one, pick a theater
+            turns = [
+                lex_event('GetMovies', {'zipcode': zipcode}, {}, 'DialogCodeHook', user),
+                lex_event('GetMovies', {'zipcode': zipcode}, session, user_id=user),
+                lex_event('FindMovie', {'movie_title': title, 'zipcode': None}, session, 'DialogCodeHook', user),
+                lex_event('FindMovie', {'movie_title': title, 'zipcode': None}, session, user_id=user),
+                lex_event('FindShowtimes', {'movie_title': title, 'theater_name': theater, 'zipcode': None}, session, user_id=user)
+            ]
+        elif kind == 1:
+            # ask about a theater, then a showtime there
+            turns = [
+                lex_event('GetTheaterMovies', {'theater_name': typed_theater, 'zipcode': zipcode}, {}, 'DialogCodeHook', user),
+                lex_event('GetTheaterMovies', {'theater_name': typed_theater, 'zipcode': zipcode}, session, user_id=user),
+                lex_event('FindShowtimes', {'movie_title': title, 'theater_name': theater, 'zipcode': None}, session, user_id=user)
+            ]
+        elif kind == 2:
+            # free-text showtimes question, with an invalid zip code first
+            turns = [
+                lex_event('FindShowtimes', {'movie_title': typed_title, 'theater_name': typed_theater, 'zipcode': '123'}, {}, 'DialogCodeHook', user),
+                lex_event('FindShowtimes', {'movie_title': typed_title, 'theater_name': typed_theater, 'zipcode': zipcode}, {}, 'DialogCodeHook', user),
+                lex_event('FindShowtimes', {'movie_title': typed_title, 'theater_name': typed_theater, 'zipcode': zipcode}, session, user_id=user)
+            ]
+        else:
+            # movie details and help
+            detail_title = rnd.choice(tmdb_titles) if tmdb_titles else title
+            turns = [
+                lex_event('GetHelp', {}, {}, user_id=user),
+                lex_event('GetMovieDetail', {'movie_title': misspell(detail_title, rnd) if rnd.random() < 0.5 else detail_title}, {}, user_id=user),
+                lex_event('FindMovie', {'movie_title': typed_title, 'zipcode': zipcode}, session, user_id=user)
+            ]
+        out.append(turns)
+    return out
@@ -0,0 +1,169 @@
+###
+### Local stub HTTP server standing in for the Gracenote TMS and TMDb APIs, with
+### injectable latency and per-path request counts.
+###
+### TMS is served under /tms (point TMS_API_URL at <url>/tms/v1.1) and TMDb
+### under /tmdb (point TMDB_API_URL at <url>/tmdb/3).
+###
+
+import re
+import json
+import datetime
+import time
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from fixtures import showings_payload, movie_titles, theaters
+
+MOVIE_RE = re.compile(r'^/tmdb/3/movie/(\d+)(/release_dates|/credits)?$')
+
+
+def tms_theatres(zipcode, n_theaters, origin=(32.2, -110.95)):
+    # theaters scattered within ~10 miles of origin, matching fixtures.theaters()
+    seed = int(zipcode) if zipcode.isdigit() else 0
+    rnd = random.Random(seed)
+    return [{
+        'theatreId': t['id'],
+        'name': t['name'],
+        'location': {'geoCode': {'latitude': '%.4f' % (origin[0] + rnd.uniform(-0.15, 0.15)), 'longitude': '%.4f' % (origin[1] + rnd.uniform(-0.15, 0.15))}}
+    } for t in theaters(n_theaters, seed)]
+
+
+def tmdb_release_dates(movie_id):
+    return {'id': movie_id, 'results': [
+        {'iso_3166_1': 'GB', 'release_dates': [{'certification': '12A', 'type': 3}]},
+        {'iso_3166_1': 'US', 'release_dates': [{'certification': random.Random(movie_id).choice(['G', 'PG', 'PG-13', 'R']), 'type': 3}]}
+    ]}
+
+
+def tmdb_details(movie_id, title):
+    rnd = random.Random(movie_id)
+    return {'id': movie_id, 'title': title, 'runtime': rnd.randint(80, 170), 'release_date': '2018-%02d-%02d' % (rnd.randint(1, 12), rnd.randint(1, 28)), 'overview': 'x' * 400}
+
+
+def tmdb_credits(movie_id):
+    rnd = random.Random(movie_id)
+    return {
+        'id': movie_id,
+        'cast': [{'name': 'Actor %d' % rnd.randint(1, 10000), 'character': 'Role %d' % i, 'order': i} for i in range(20)],
+        'crew': [{'name': 'Crew %d' % i, 'department': d, 'job': j} for i, (d, j) in enumerate([('Directing', 'Director'), ('Writing', 'Screenplay'), ('Sound', 'Music')] * 10)]
+    }
+
+
+class StubServer(object):
+    ###
+    ### Run the stub in a background thread:
+    ###
+    ###     with StubServer(latency=0.05) as stub:
+    ###         os.environ['TMDB_API_URL'] = stub.url + '/tmdb/3'
+    ###
+    ### latency is the delay (seconds) added to every response, or a dict mapping
+    ### 'tms'/'tmdb' to a delay. showings maps a zip code to the payload served for
+    ### it; unknown zips get a generated payload of the default size. origins maps
+    ### a zip code to the (lat, lon) its theaters are scattered around.
+    ###
+
+    def __init__(self, latency=0.0, showings=None, n_movies=60, n_theaters=40, append_to_response=True, titles=None, origins=None):
+        self.latency = latency
+        self.showings = showings or {}
+        self.origins = origins or {}
+        self.n_movies = n_movies
+        self.n_theaters = n_theaters
+        self.append_to_response = append_to_response
+        self.titles = titles or movie_titles(200)
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler_class())
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.thread = None
+        self.encoded = {}
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def delay(self, api):
+        latency = self.latency.get(api, 0) if isinstance(self.latency, dict) else self.latency
+        if latency:
+            time.sleep(latency)
+
+    def count(self, path):
+        with self.lock:
+            self.counts[path] = self.counts.get(path, 0) + 1
+
+    def showings_body(self, zipcode, start_date, num_days):
+        key = (zipcode, start_date, num_days)
+        if key not in self.encoded:
+            movies = self.showings.get(zipcode)
+            if movies is None:
+                date = datetime.datetime.strptime(start_date, '%Y-%m-%d').date()
+                movies = showings_payload(self.n_movies, self.n_theaters, num_days, date, seed=int(zipcode) if zipcode.isdigit() else 0)
+            self.encoded[key] = json.dumps(movies).encode('utf-8')
+        return self.encoded[key]
+
+    def route(self, path, query):
+        q = {k: v[0] for k, v in query.items()}
+        if path == '/tms/v1.1/movies/showings':
+            self.delay('tms')
+            return 200, self.showings_body(q.get('zip', '00000'), q['startDate'], int(q.get('numDays', 1)))
+        if path == '/tms/v1.1/theatres':
+            self.delay('tms')
+            zipcode = q.get('zip', '00000')
+            if zipcode in self.origins:
+                return 200, json.dumps(tms_theatres(zipcode, self.n_theaters, self.origins[zipcode])).encode('utf-8')
+            return 200, json.dumps(tms_theatres(zipcode, self.n_theaters)).encode('utf-8')
+        if path == '/tmdb/3/search/movie':
+            self.delay('tmdb')
+            words = set(q.get('query', '').lower().split())
+            results = [{'id': 1000 + i, 'title': t} for i, t in enumerate(self.titles) if words & set(t.lower().split())][:20]
+            return 200, json.dumps({'page': 1, 'results': results, 'total_results': len(results)}).encode('utf-8')
+        m = MOVIE_RE.match(path)
+        if m:
+            self.delay('tmdb')
+            movie_id = int(m.group(1))
+            if movie_id - 1000 >= len(self.titles):
+                return 404, b'{"status_code": 34}'
+            if m.group(2) == '/release_dates':
+                body = tmdb_release_dates(movie_id)
+            elif m.group(2) == '/credits':
+                body = tmdb_credits(movie_id)
+            else:
+                body = tmdb_details(movie_id, self.titles[movie_id - 1000])
+                if self.append_to_response:
+                    for section in q.get('append_to_response', '').split(','):
+                        if section == 'release_dates':
+                            body['release_dates'] = tmdb_release_dates(movie_id)
+                        elif section == 'credits':
+                            body['credits'] = tmdb_credits(movie_id)
+            return 200, json.dumps(body).encode('utf-8')
+        return 404, b'{}'
+
+    def handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                stub.count(url.path)
+                status, body = stub.route(url.path, parse_qs(url.query))
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
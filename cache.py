@@ -0,0 +1,446 @@
+###
+### Cache tiers shared by the intent handlers.
+###
+### A MemoryCache lives at module scope so it survives across warm Lambda
+### invocations; an optional second tier (FileCache under /tmp, or RedisCache)
+### is consulted on a first-tier miss. Values stored in the second tier must be
+### JSON-serializable.
+###
+### TieredCache.load() coalesces concurrent loads of the same key: callers in
+### this process share one call (SingleFlight), callers in other containers wait
+### on a lease held in the second tier, and an expired value still inside the
+### first tier's stale window is served while it is refreshed in the background.
+###
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import deadline
+import tracing
+
+logger = logging.getLogger()
+
+# how long, in seconds, a caller waits for another caller's load of the same key
+LOAD_WAIT = float(os.environ.get('CACHE_LOAD_WAIT', 10))
+# how long, in seconds, a lease on loading a key holds off other containers; long
+# enough to cover a fetch (it is released as soon as the load is done)
+LEASE_TTL = float(os.environ.get('CACHE_LEASE_TTL', 30))
+POLL_INTERVAL = 0.05
+
+
+class MemoryCache(object):
+    ###
+    ### In-process LRU cache with a per-entry TTL. Expired entries are kept for
+    ### a further stale_ttl seconds, during which get_stale() still returns them.
+    ### Given a sizeof function, least recently used entries are also evicted
+    ### once the cached values add up to more than max_bytes (the newest entry
+    ### is always kept).
+    ###
+
+    name = 'memory'
+
+    def __init__(self, max_entries=32, ttl=900, stale_ttl=0, max_bytes=0, sizeof=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'stale': 0}
+
+    def _remove(self, key):
+        expires_at, value, size = self._entries.pop(key)
+        self.bytes -= size
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            expires_at, value, size = entry
+            now = time.time()
+            if expires_at < now:
+                if expires_at + self.stale_ttl < now:
+                    self._remove(key)
+                    self.stats['expirations'] += 1
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return value
+
+    def get_stale(self, key):
+        ###
+        ### Returns the value for key if it has expired less than stale_ttl
+        ### seconds ago, otherwise None.
+        ###
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value, size = entry
+            now = time.time()
+            if expires_at >= now or expires_at + self.stale_ttl < now:
+                return None
+            self.stats['stale'] += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + (ttl if ttl is not None else self.ttl)
+        size = self.sizeof(value) if self.sizeof is not None else 0
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires_at, value, size)
+            self.bytes += size
+            while len(self._entries) > self.max_entries or (self.max_bytes and self.bytes > self.max_bytes and len(self._entries) > 1):
+                self._remove(next(iter(self._entries)))
+                self.stats['evictions'] += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def items(self):
+        ###
+        ### Returns the (key, value, expires_at) of every unexpired entry.
+        ###
+        now = time.time()
+        with self._lock:
+            return [(key, value, expires_at) for key, (expires_at, value, size) in self._entries.items() if expires_at >= now]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class FileCache(object):
+    ###
+    ### Second-tier cache storing one JSON document per key in a local directory
+    ### (typically under /tmp, which persists for the life of a Lambda container).
+    ###
+
+    name = 'file'
+
+    def __init__(self, directory, ttl=900):
+        self.directory = directory
+        self.ttl = ttl
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'errors': 0}
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            self.stats['misses'] += 1
+            return None
+        except (OSError, ValueError):
+            self.stats['errors'] += 1
+            self.stats['misses'] += 1
+            return None
+        if entry['expires'] < time.time():
+            self.delete(key)
+            self.stats['expirations'] += 1
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        return entry['value']
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + (ttl if ttl is not None else self.ttl)
+        path = self._path(key)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'key': key, 'expires': expires_at, 'value': value}, f, separators=(',', ':'))
+            os.replace(tmp_path, path)
+        except (OSError, TypeError, ValueError):
+            self.stats['errors'] += 1
+            logger.exception('unable to write cache entry {}'.format(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def lease(self, key, ttl):
+        ###
+        ### Take the exclusive lease on loading key, unless another process holds
+        ### one taken less than ttl seconds ago. Returns whether it was taken.
+        ###
+        path = self._path(key)[:-len('.json')] + '.lease'
+        for attempt in range(2):
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return True
+            except FileExistsError:
+                try:
+                    if os.path.getmtime(path) + ttl >= time.time():
+                        return False
+                    os.remove(path)
+                except OSError:
+                    pass
+            except OSError:
+                self.stats['errors'] += 1
+                return True
+        return False
+
+    def release(self, key):
+        try:
+            os.remove(self._path(key)[:-len('.json')] + '.lease')
+        except OSError:
+            pass
+
+
+class RedisCache(object):
+    ###
+    ### Second-tier cache backed by any Redis-compatible server. The `redis`
+    ### package is only imported when this tier is configured.
+    ###
+
+    name = 'redis'
+
+    def __init__(self, url=None, ttl=900, client=None, prefix='moviebot:'):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'errors': 0}
+
+    def get(self, key):
+        try:
+            raw = self.client.get(self.prefix + key)
+        except Exception:
+            self.stats['errors'] += 1
+            self.stats['misses'] += 1
+            logger.exception('unable to read cache entry {}'.format(key))
+            return None
+        if raw is None:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        return json.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        try:
+            self.client.setex(self.prefix + key, int(ttl if ttl is not None else self.ttl), json.dumps(value, separators=(',', ':')))
+        except Exception:
+            self.stats['errors'] += 1
+            logger.exception('unable to write cache entry {}'.format(key))
+
+    def delete(self, key):
+        try:
+            self.client.delete(self.prefix + key)
+        except Exception:
+            self.stats['errors'] += 1
+
+    def lease(self, key, ttl):
+        ###
+        ### Take the exclusive lease on loading key for ttl seconds, unless another
+        ### container holds it. Returns whether it was taken; if Redis cannot be
+        ### reached, every caller gets the lease.
+        ###
+        try:
+            return bool(self.client.set(self.prefix + 'lease:' + key, '1', nx=True, px=int(ttl * 1000)))
+        except Exception:
+            self.stats['errors'] += 1
+            return True
+
+    def release(self, key):
+        try:
+            self.client.delete(self.prefix + 'lease:' + key)
+        except Exception:
+            self.stats['errors'] += 1
+
+
+class SingleFlight(object):
+    ###
+    ### Runs at most one call per key at a time; callers arriving while a call is
+    ### in flight wait for its result instead of making their own.
+    ###
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def _begin(self, key):
+        # returns (call, whether the caller is the one to run it)
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                return call, False
+            call = self._calls[key] = {'done': threading.Event(), 'value': None}
+            return call, True
+
+    def _run(self, key, call, fn):
+        try:
+            call['value'] = fn()
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+        return call['value']
+
+    def do(self, key, fn, timeout=None):
+        ###
+        ### Returns fn(), or the result of the call for key already in flight. A
+        ### waiting caller gets None if that call fails or takes longer than timeout
+        ### seconds.
+        ###
+        call, leader = self._begin(key)
+        if leader:
+            return self._run(key, call, fn)
+        tracing.incr('singleflight.wait')
+        call['done'].wait(timeout)
+        return call['value']
+
+    def start(self, key, fn):
+        ###
+        ### Run fn() in a background thread unless a call for key is already in
+        ### flight. Returns whether a call was started.
+        ###
+        call, leader = self._begin(key)
+        if not leader:
+            return False
+
+        def run():
+            try:
+                self._run(key, call, fn)
+            except Exception:
+                logger.exception('background load failed key={}'.format(key))
+        threading.Thread(target=run, daemon=True).start()
+        return True
+
+
+class TieredCache(object):
+    ###
+    ### Two-tier cache: an in-process first tier backed by an optional shared
+    ### second tier. Second-tier hits are promoted into the first tier. The
+    ### first tier holds live objects; encode/decode convert them to and from
+    ### the JSON-serializable form kept in the second tier.
+    ###
+
+    def __init__(self, first, second=None, encode=None, decode=None, name='cache'):
+        self.first = first
+        self.second = second
+        self.encode = encode
+        self.decode = decode
+        self.name = name
+        self.flights = SingleFlight()
+
+    def get(self, key):
+        value = self.first.get(key)
+        if value is not None or self.second is None:
+            tracing.incr('%s.%s' % (self.name, 'miss' if value is None else 'hit'))
+            return value
+        value = self.second.get(key)
+        if value is not None:
+            if self.decode:
+                value = self.decode(value)
+            self.first.set(key, value)
+        tracing.incr('%s.%s' % (self.name, 'miss' if value is None else 'hit2'))
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.first.set(key, value, ttl)
+        if self.second is not None:
+            self.second.set(key, self.encode(value) if self.encode else value, ttl)
+
+    def delete(self, key):
+        self.first.delete(key)
+        if self.second is not None:
+            self.second.delete(key)
+
+    def load(self, key, load, wait=LOAD_WAIT):
+        ###
+        ### Returns the value for key produced by load(), which is expected to
+        ### store it (with set()) if it should be cached; load() returns None on
+        ### failure. Only one caller loads a key at a time: concurrent callers in
+        ### this process share the call, and callers in other containers wait up to
+        ### wait seconds for the value to appear in the second tier. If the first
+        ### tier holds a value that expired within its stale window, that value is
+        ### returned at once and load() refreshes it in the background. Waits are
+        ### cut to the invocation's deadline.
+        ###
+        wait = deadline.clamp(wait)
+        stale = self.first.get_stale(key)
+        if stale is not None:
+            if self.flights.start(key, lambda: self._load(key, load, wait)):
+                tracing.incr('%s.revalidate' % self.name)
+            return stale
+        return self.flights.do(key, lambda: self._load(key, load, wait), wait)
+
+    def _loaded(self, key):
+        # the value another container has stored in the second tier, if any
+        value = self.second.get(key)
+        if value is not None:
+            tracing.incr('%s.coalesced' % self.name)
+            if self.decode:
+                value = self.decode(value)
+            self.first.set(key, value)
+        return value
+
+    def _load(self, key, load, wait):
+        if self.second is None:
+            return load()
+        give_up_at = time.time() + wait
+        while not self.second.lease(key, LEASE_TTL):
+            if time.time() >= give_up_at:
+                # the other loader is taking too long, so don't wait any longer
+                return load()
+            time.sleep(POLL_INTERVAL)
+            value = self._loaded(key)
+            if value is not None:
+                return value
+        try:
+            # the previous lease holder may have stored the value since the last look
+            value = self._loaded(key)
+            if value is not None:
+                return value
+            return load()
+        finally:
+            self.second.release(key)
+
+    def stats(self):
+        tiers = {self.first.name: dict(self.first.stats)}
+        if self.first.sizeof is not None:
+            tiers[self.first.name]['bytes'] = self.first.bytes
+        if self.second is not None:
+            tiers[self.second.name] = dict(self.second.stats)
+        return tiers
+
+
+def build_cache(max_entries, ttl, encode=None, decode=None, name='cache', stale_ttl=0, max_bytes=0, sizeof=None):
+    ###
+    ### Build a TieredCache from the environment. CACHE_REDIS_URL selects a Redis
+    ### second tier; otherwise CACHE_DIR (if set) selects a file second tier.
+    ### Entries may be served stale for stale_ttl seconds by load(), and the
+    ### first tier holds at most max_bytes (as measured by sizeof) if given.
+    ###
+    second = None
+    if os.environ.get('CACHE_REDIS_URL'):
+        second = RedisCache(os.environ['CACHE_REDIS_URL'], ttl=ttl)
+    elif os.environ.get('CACHE_DIR'):
+        second = FileCache(os.environ['CACHE_DIR'], ttl=ttl)
+    return TieredCache(MemoryCache(max_entries, ttl, stale_ttl, max_bytes, sizeof), second, encode, decode, name)
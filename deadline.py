@@ -0,0 +1,121 @@
+###
+### Per-invocation time budget, taken from the Lambda context.
+###
+### lambda_handler opens the budget with deadline.invocation(context): the time
+### Lambda says is left, less DEADLINE_RESERVE seconds kept for building and
+### returning the response. Every outbound request, retry, quota wait and wait
+### on a concurrent load is cut to what is left of it, and once it is spent
+### they fail at once with upstream.DeadlineExceeded, which callers already
+### treat like any other failed request (and which never leaves a host's
+### circuit breaker half-open). The handlers then answer with the best
+### data they have, and each such fallback is counted under its degradation tier:
+###
+###     showings.stale     showings past their lifetime, as no fresh ones could be had
+###     showings.missing   no showings at all, so the answer is that none were found
+###     listing.unranked   a response card listed in index order, not ranked by showtimes
+###     listing.titles     the movies at a theater offered instead of their showtimes
+###     detail.partial     a movie's details missing the sections that were not fetched
+###
+### Like the current trace, the budget is module state rather than per thread,
+### so the thread pools working for the invocation all see it. Without a Lambda
+### context (benchmarks, batch evaluation) there is no budget unless
+### DEADLINE_DEFAULT is set.
+###
+
+import os
+import time
+import threading
+
+import tracing
+
+RESERVE = float(os.environ.get('DEADLINE_RESERVE', 0.3))
+# with less than this many seconds left, handlers skip optional work
+LOW = float(os.environ.get('DEADLINE_LOW', 0.5))
+# budget in seconds for invocations without a Lambda context (0 for none)
+DEFAULT = float(os.environ.get('DEADLINE_DEFAULT', 0))
+
+_expires = None
+counts = {}
+_lock = threading.Lock()
+
+
+class invocation(object):
+    ###
+    ### Sets the budget for the calls made inside the block:
+    ###
+    ###     with deadline.invocation(context):
+    ###         response = dispatch(event)
+    ###
+
+    def __init__(self, context=None):
+        seconds = DEFAULT or None
+        if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+            seconds = context.get_remaining_time_in_millis() / 1000.0
+        self.expires = time.monotonic() + seconds - RESERVE if seconds is not None else None
+
+    def __enter__(self):
+        global _expires
+        self.previous = _expires
+        _expires = self.expires
+        return self
+
+    def __exit__(self, *exc):
+        global _expires
+        _expires = self.previous
+        return False
+
+
+def remaining(until=None):
+    ###
+    ### Returns the seconds left in the budget (0 once it is spent), or None if
+    ### there is none. until (a time.monotonic() value) narrows the budget for
+    ### a single call, e.g. the whole of a TMDb detail lookup.
+    ###
+    expires = _expires
+    if until is not None and (expires is None or until < expires):
+        expires = until
+    if expires is None:
+        return None
+    return max(0.0, expires - time.monotonic())
+
+
+def low():
+    left = remaining()
+    return left is not None and left < LOW
+
+
+def clamp(seconds, until=None):
+    ###
+    ### Returns seconds, or what is left of the budget if that is less.
+    ###
+    left = remaining(until)
+    return seconds if left is None else min(seconds, left)
+
+
+def timeout(value, until=None):
+    ###
+    ### Returns a requests timeout (seconds, or a (connect, read) tuple) cut to
+    ### the budget, the same object if it fits, or 0 if the budget is spent.
+    ###
+    left = remaining(until)
+    if left is None:
+        return value
+    if left <= 0:
+        return 0
+    if isinstance(value, tuple):
+        return value if max(value) <= left else tuple(min(t, left) for t in value)
+    return value if value <= left else left
+
+
+def degrade(tier):
+    ###
+    ### Count a response served from degradation tier.
+    ###
+    with _lock:
+        counts[tier] = counts.get(tier, 0) + 1
+    tracing.incr('degraded.' + tier)
+
+
+def stats():
+    with _lock:
+        return dict(counts)
@@ -0,0 +1,179 @@
+###
+### Zip code geography: a compact zip -> (lat, lon) table and a grid-based
+### clustering of nearby zip codes, so that neighbouring zips can share a single
+### showings fetch.
+###
+### The table is a small binary file (see build_table) holding three parallel
+### arrays sorted by zip code. It is generated from the US Census Bureau ZCTA
+### gazetteer file and bundled with the deployment package as zipcodes.bin; if
+### no table is present, clustering is disabled and every zip stands alone.
+###
+
+import os
+import sys
+import math
+import struct
+import logging
+from array import array
+from bisect import bisect_left
+
+logger = logging.getLogger()
+
+TABLE_PATH = os.environ.get('ZIP_TABLE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'zipcodes.bin'))
+# zips within this many miles of each other may share a cluster (0 disables clustering)
+CLUSTER_RADIUS = float(os.environ.get('GEO_CLUSTER_RADIUS', 3))
+
+MAGIC = b'MBZIP1\0\0'
+HEADER = struct.Struct('<8sI')
+SCALE = 10000.0
+MILES_PER_DEGREE = 69.0
+EARTH_RADIUS = 3958.8
+
+
+def distance(a, b):
+    ###
+    ### Great-circle distance in miles between two (lat, lon) points.
+    ###
+    lat1, lon1 = math.radians(a[0]), math.radians(a[1])
+    lat2, lon2 = math.radians(b[0]), math.radians(b[1])
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(h)))
+
+
+class ZipTable(object):
+    ###
+    ### Parallel arrays of zip codes and their coordinates (in 1/10000 degree),
+    ### sorted by zip code: about 12 bytes per zip.
+    ###
+
+    def __init__(self, zips, lats, lons):
+        self.zips = zips
+        self.lats = lats
+        self.lons = lons
+        self.grids = {}
+
+    def __len__(self):
+        return len(self.zips)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            magic, count = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError('%s is not a zip code table' % path)
+            columns = []
+            for typecode in ('I', 'i', 'i'):
+                column = array(typecode)
+                column.fromfile(f, count)
+                if sys.byteorder != 'little':
+                    column.byteswap()
+                columns.append(column)
+        return cls(*columns)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, len(self.zips)))
+            for column in (self.zips, self.lats, self.lons):
+                if sys.byteorder != 'little':
+                    column = array(column.typecode, column)
+                    column.byteswap()
+                column.tofile(f)
+
+    def _find(self, zipcode):
+        try:
+            z = int(zipcode)
+        except ValueError:
+            return None
+        i = bisect_left(self.zips, z)
+        if i < len(self.zips) and self.zips[i] == z:
+            return i
+        return None
+
+    def _location(self, i):
+        return self.lats[i] / SCALE, self.lons[i] / SCALE
+
+    def locate(self, zipcode):
+        ###
+        ### Returns the (lat, lon) of zipcode, or None if it is not in the table.
+        ###
+        i = self._find(zipcode)
+        return None if i is None else self._location(i)
+
+    def _cell(self, lat, lon, side):
+        # square cells of `side` miles: rows of constant latitude, with each row's
+        # longitude step widened for its latitude
+        lat_step = side / MILES_PER_DEGREE
+        row = int(math.floor(lat / lat_step))
+        lon_step = lat_step / max(0.01, math.cos(math.radians((row + 0.5) * lat_step)))
+        col = int(math.floor(lon / lon_step))
+        return row, col, ((row + 0.5) * lat_step, (col + 0.5) * lon_step)
+
+    def _grid(self, side):
+        grid = self.grids.get(side)
+        if grid is None:
+            grid = {}
+            for i in range(len(self.zips)):
+                row, col, center = self._cell(self.lats[i] / SCALE, self.lons[i] / SCALE, side)
+                grid.setdefault((row, col), []).append(i)
+            self.grids[side] = grid
+        return grid
+
+    def cluster(self, zipcode, radius=CLUSTER_RADIUS):
+        ###
+        ### Returns the canonical zip code of the cluster containing zipcode: the
+        ### zip closest to the centre of its grid cell. Cells are sized so that
+        ### every zip in a cluster is within radius miles of the canonical zip.
+        ### Zips that are not in the table are their own cluster.
+        ###
+        i = self._find(zipcode)
+        if i is None or radius <= 0:
+            return zipcode
+        side = radius / math.sqrt(2)
+        row, col, center = self._cell(self.lats[i] / SCALE, self.lons[i] / SCALE, side)
+        members = self._grid(side)[(row, col)]
+        best = min(members, key=lambda j: (distance(center, self._location(j)), self.zips[j]))
+        return '%05d' % self.zips[best]
+
+
+def build_table(src, dest):
+    ###
+    ### Build a table from the Census ZCTA gazetteer (tab-separated, with GEOID,
+    ### INTPTLAT and INTPTLONG columns), e.g. 2020_Gaz_zcta_national.txt.
+    ###
+    rows = []
+    with open(src) as f:
+        header = [h.strip() for h in f.readline().split('\t')]
+        geoid, lat, lon = header.index('GEOID'), header.index('INTPTLAT'), header.index('INTPTLONG')
+        for line in f:
+            fields = line.split('\t')
+            rows.append((int(fields[geoid]), int(round(float(fields[lat]) * SCALE)), int(round(float(fields[lon]) * SCALE))))
+    rows.sort()
+    table = ZipTable(array('I', [r[0] for r in rows]), array('i', [r[1] for r in rows]), array('i', [r[2] for r in rows]))
+    table.save(dest)
+    return table
+
+
+_table = None
+
+
+def table():
+    ###
+    ### Returns the bundled ZipTable, loading it on first use, or None if there
+    ### is none.
+    ###
+    global _table
+    if _table is None:
+        try:
+            _table = ZipTable.load(TABLE_PATH)
+        except FileNotFoundError:
+            _table = False
+        except (OSError, ValueError, EOFError):
+            logger.exception('unable to load zip code table {}'.format(TABLE_PATH))
+            _table = False
+    return _table or None
+
+
+if __name__ == '__main__':
+    # usage: python geo.py 2020_Gaz_zcta_national.txt [zipcodes.bin]
+    t = build_table(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else TABLE_PATH)
+    print('wrote %d zip codes' % len(t))
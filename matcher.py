@@ -0,0 +1,113 @@
+###
+### Fuzzy matching of user-provided titles and theater names against a fixed set
+### of candidates.
+###
+### FuzzyMatcher returns exactly what the original per-candidate `similar()` loop
+### returned: the first candidate (in candidate order) with the highest
+### SequenceMatcher ratio, provided that ratio is at least the threshold. It gets
+### there with far fewer full ratio computations:
+###
+###   * candidates are normalized (lower-cased and stripped) once, up front
+###   * the query is analysed once, as SequenceMatcher's second sequence
+###   * candidates are visited in order of shared trigrams with the query, so a
+###     strong match is usually found first
+###   * real_quick_ratio() and quick_ratio() are upper bounds on ratio(), so any
+###     candidate whose bound cannot beat the current best is skipped
+###
+
+import hashlib
+from difflib import SequenceMatcher
+
+from tracing import traced
+
+THRESHOLD = 0.5
+
+
+def normalize(s):
+    return s.lower().strip()
+
+
+def ngrams(s, n=3):
+    if len(s) < n:
+        return {s} if s else set()
+    return {s[i:i + n] for i in range(len(s) - n + 1)}
+
+
+class FuzzyMatcher(object):
+    ###
+    ### Matcher built once from a list of candidate strings, and optionally a
+    ### parallel list of keys (e.g. IDs) for match() to return in their place.
+    ### fingerprint identifies the candidates and keys, so that results kept
+    ### elsewhere (see aliases) apply only to matchers over the same ones.
+    ###
+
+    def __init__(self, candidates, threshold=THRESHOLD, n=3, keys=None):
+        self.candidates = list(candidates)
+        self.keys = self.candidates if keys is None else list(keys)
+        self.normalized = [normalize(c) for c in self.candidates]
+        self.threshold = threshold
+        self.n = n
+        self.exact = {}
+        self.grams = {}
+        for i, c in enumerate(self.normalized):
+            self.exact.setdefault(c, i)
+            for g in ngrams(c, n):
+                self.grams.setdefault(g, []).append(i)
+        self.fingerprint = hashlib.sha1('\n'.join('%s\t%s' % pair for pair in zip(self.normalized, self.keys)).encode('utf-8')).hexdigest()[:16]
+        self.stats = {'queries': 0, 'exact': 0, 'ratios': 0}
+
+    def __len__(self):
+        return len(self.candidates)
+
+    @traced('match')
+    def best(self, query):
+        ###
+        ### Returns (candidate index, ratio) of the best match for query, or
+        ### (None, 0.0) if no candidate reaches the threshold.
+        ###
+        self.stats['queries'] += 1
+        q = normalize(query)
+        i = self.exact.get(q)
+        if i is not None:
+            self.stats['exact'] += 1
+            return i, 1.0
+
+        # rank candidates by the number of trigrams they share with the query
+        shared = {}
+        for g in ngrams(q, self.n):
+            for i in self.grams.get(g, ()):
+                shared[i] = shared.get(i, 0) + 1
+        order = sorted(range(len(self.normalized)), key=lambda i: (-shared.get(i, 0), i))
+
+        sm = SequenceMatcher(None)
+        sm.set_seq2(q)
+        best_i = None
+        best_ratio = 0.0
+        for i in order:
+            sm.set_seq1(self.normalized[i])
+            if not self._may_beat(sm.real_quick_ratio(), i, best_i, best_ratio):
+                continue
+            if not self._may_beat(sm.quick_ratio(), i, best_i, best_ratio):
+                continue
+            self.stats['ratios'] += 1
+            ratio = sm.ratio()
+            if ratio >= self.threshold and self._may_beat(ratio, i, best_i, best_ratio):
+                best_i = i
+                best_ratio = ratio
+        return best_i, best_ratio
+
+    def _may_beat(self, bound, i, best_i, best_ratio):
+        if bound < self.threshold:
+            return False
+        if best_i is None or bound > best_ratio:
+            return True
+        # ties go to the candidate that comes first
+        return bound == best_ratio and i < best_i
+
+    def match(self, query):
+        ###
+        ### Returns the key of the best-matching candidate for query (the
+        ### candidate itself unless keys were given), or None.
+        ###
+        i, ratio = self.best(query)
+        return None if i is None else self.keys[i]
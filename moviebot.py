@@ -5,14 +5,49 @@
 
 import os
 import re
-import arrow
+import sys
+import json
 import logging
-import requests
-from difflib import SequenceMatcher
+
+import tracing
+import deadline
+
+# arrow, requests and the data layer (showings, tmdb, upstream) are imported by
+# the handlers that use them, so that cold starts serving GetHelp or slot
+# validation never load the network stack
 
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 
+ZIPCODE_RE = re.compile(r'^(\d{5})([- ])?(\d{4})?$')
+# response card buttons carry the TMS theatre ID after the theater name
+THEATER_ID_RE = re.compile(r'\s*#(\w+)\s*$')
+INVALID_ZIPCODE_MESSAGE = 'Whoops! You entered an invalid zip code. What is your zip code?'
+HELP_EXAMPLES = [
+    "  * What movies are out right now?",
+    "  * What movies are playing near _zipcode_?",
+    "  * Where is _movie_ playing?",
+    "  * Tell me when _movie_ is showing at _theater_",
+    "  * How long is _movie_?",
+    "  * What is _movie_ rated?"
+]
+HELP_CONTENT = "You can ask me for information about when and where movies are playing, as well as for basic info on current movies. Here are some examples of things you can ask me:\n%s" % "\n".join(HELP_EXAMPLES)
+# number of requests handled by this container
+invocations = 0
+# session attribute carrying the digest of the showings behind the last response
+# card, and its maximum size in bytes (Lex limits the size of session attributes)
+DIGEST_ATTRIBUTE = 'showings'
+DIGEST_MAX_BYTES = int(os.environ.get('SESSION_DIGEST_MAX_BYTES', 1024))
+# response card options returned per turn (Lex renders at most 10 cards of 5
+# buttons); the rest are served a page at a time by the MoreResults intent
+CARD_PAGE_SIZE = int(os.environ.get('CARD_PAGE_SIZE', 24))
+PAGE_ATTRIBUTE = 'page'
+MORE_OPTION = {'text': 'More...', 'value': 'Show more results'}
+
+# fetch each intent's data up front on an event loop, with independent
+# upstream calls overlapped (see IntentContext.load)
+ASYNC_HANDLER = os.environ.get('ASYNC_HANDLER', 'false').lower() == 'true'
+
 
 ### --- Helpers to build responses which match the structure of the necessary dialog actions --- ###
 
@@ -86,9 +121,11 @@ def delegate(session_attributes, slots):
     }
 
 
-def build_response_card(title, subtitle, options):
+@tracing.traced('response_card')
+def build_response_card(title, subtitle, options, first_page=1):
     ###
     ### Build one or more responseCards with a title, subtitle, and an optional set of options which should be displayed as buttons.
+    ### Cards are numbered from first_page, for pages after the first.
     ###
     attachments = []
     # Lex permits max 5 buttons per card
@@ -105,8 +142,8 @@ def build_response_card(title, subtitle, options):
             buttons = []
             for j in range(min(5, len(group))):
                 buttons.append(group[j])
-            if cnt > 1:
-                card_title = "%s - page %d" % (card_title, i+1)
+            if cnt > 1 or first_page > 1:
+                card_title = "%s - page %d" % (card_title, i+first_page)
             attachments.append({
                 'title': card_title,
                 'subTitle': subtitle,
@@ -122,13 +159,6 @@ def build_response_card(title, subtitle, options):
 ### --- Helper Functions --- ###
 
 
-def similar(a, b):
-    ###
-    ### Help function which returns probability if 2 strings are similar (using difflib)
-    ###
-    return SequenceMatcher(None, a, b).ratio()
-
-
 def build_validation_result(is_valid, violated_slot, message_content):
     return {
         'isValid': is_valid,
@@ -137,6 +167,7 @@ def build_validation_result(is_valid, violated_slot, message_content):
     }
 
 
+@tracing.traced('validate')
 def validate_zipcode(slots, output_session_attributes):
     # check if zipcode in session attrs or request slots, and if it is valid
     zipcode = None
@@ -148,7 +179,7 @@ def validate_zipcode(slots, output_session_attributes):
         zipcode = output_session_attributes['zipcode']
     if zipcode:
         # check format of zipcode
-        zipcode_match = re.search('^(\d{5})([- ])?(\d{4})?$', zipcode)
+        zipcode_match = ZIPCODE_RE.search(zipcode)
         if zipcode_match:
             zipcode = zipcode_match.group(1)
             output_session_attributes['zipcode'] = zipcode
@@ -157,94 +188,425 @@ def validate_zipcode(slots, output_session_attributes):
     return [zipcode, output_session_attributes]
 
 
+### --- Session digests --- ###
+
+
+def save_digest(session_attributes, movies, titles=(), theaters=()):
+    ###
+    ### Remember which showings index served this turn (its cache key and fetch
+    ### time) and the positions in it of the titles and theaters we offered, so
+    ### that the next turn can resolve the user's pick without fuzzy matching.
+    ### Positions are dropped from the end until the digest fits DIGEST_MAX_BYTES.
+    ###
+    if movies.key is None:
+        session_attributes.pop(DIGEST_ATTRIBUTE, None)
+        return
+    title_ids = set(titles)
+    theater_ids = set(theaters)
+    digest = {
+        'k': movies.key,
+        'f': movies.index.fetched,
+        'ti': [i for i, t in enumerate(movies.index.titles) if t in title_ids],
+        'th': [i for i, t in enumerate(movies.index.theaters) if t in theater_ids]
+    }
+    body = json.dumps(digest, separators=(',', ':'))
+    while len(body) > DIGEST_MAX_BYTES and (digest['ti'] or digest['th']):
+        digest['ti' if len(digest['ti']) >= len(digest['th']) else 'th'].pop()
+        body = json.dumps(digest, separators=(',', ':'))
+    session_attributes[DIGEST_ATTRIBUTE] = body
+
+
+def load_digest(session_attributes, movies):
+    ###
+    ### Returns {normalized name: title} and {normalized name: theatre ID} dicts
+    ### of the titles and theaters offered by the previous turn, or empty dicts
+    ### if there is no digest, it cannot be read (session attributes come from
+    ### the client) or it does not describe the index that serves this turn
+    ### (e.g. the showings have since been refetched).
+    ###
+    from matcher import normalize
+    raw = session_attributes.get(DIGEST_ATTRIBUTE) if session_attributes else None
+    if not raw:
+        return {}, {}
+    index = movies.index
+    titles = {}
+    theaters = {}
+    try:
+        digest = json.loads(raw)
+        stale = digest['k'] != movies.key or digest['f'] != index.fetched
+        if not stale:
+            for i in digest.get('ti', ()):
+                if 0 <= i < len(index.titles):
+                    titles.setdefault(normalize(index.titles[i]), index.titles[i])
+            for i in digest.get('th', ()):
+                if 0 <= i < len(index.theaters):
+                    theaters.setdefault(normalize(index.theater_names[index.theaters[i]]), index.theaters[i])
+    except (ValueError, TypeError, KeyError, AttributeError, IndexError):
+        stale = True
+    if stale:
+        tracing.incr('digest.stale')
+        return {}, {}
+    return titles, theaters
+
+
+def resolve(name, digested, available, matcher, kind):
+    ###
+    ### Returns the canonical name for the user-supplied name: the one we offered
+    ### last turn if it matches exactly and is still available, or the candidate
+    ### it names exactly, or what the same input resolved to before among the
+    ### same candidates (see aliases), or else the best fuzzy match ('' if there
+    ### is none). Fuzzy matches are learned as aliases of kind.
+    ###
+    from matcher import normalize
+    if name and digested:
+        candidate = digested.get(normalize(name))
+        if candidate is not None and available(candidate):
+            tracing.incr('digest.hit')
+            return candidate
+    m = matcher()
+    if not name:
+        return m.match(name) or ''
+    i = m.exact.get(normalize(name))
+    if i is not None:
+        return m.keys[i]
+    import aliases
+    alias = aliases.lookup(kind, m.fingerprint, name, available)
+    if alias is not None:
+        return alias
+    i, ratio = m.best(name)
+    if i is None:
+        return ''
+    aliases.learn(kind, m.fingerprint, name, m.keys[i])
+    return m.keys[i]
+
+
+### --- Theater IDs --- ###
+
+
+def theater_label(movies, theater):
+    # the theater's name, followed by its ID if it has one
+    name = movies.theater_name(theater)
+    return name if name == theater else '%s #%s' % (name, theater)
+
+
+def resolve_theater(theater_name, digested, movies):
+    ###
+    ### Returns the ID of the theater the user asked for: the ID carried by a
+    ### response card button if there is one, otherwise as resolve().
+    ###
+    if theater_name:
+        theater_id = THEATER_ID_RE.search(theater_name)
+        if theater_id is not None:
+            if movies.has_theater(theater_id.group(1)):
+                tracing.incr('theater.id')
+                return theater_id.group(1)
+            theater_name = theater_name[:theater_id.start()]
+    return resolve(theater_name, digested, movies.has_theater, movies.theater_matcher, 'theater')
+
+
+### --- Intent registry --- ###
+
+
+class Intent(object):
+    ###
+    ### An intent handler and what it needs before it runs: the slots that must
+    ### be filled, whether it needs a validated zip code, for how many days (if
+    ### any) it reads showings, and whether it reads the TMDb detail record of
+    ### its movie_title slot.
+    ###
+
+    def __init__(self, name, handler, slots=(), zipcode=False, showings_days=None, detail=False):
+        self.name = name
+        self.handler = handler
+        self.slots = slots
+        self.zipcode = zipcode
+        self.showings_days = showings_days
+        self.detail = detail
+
+
+INTENTS = {}
+
+
+def intent(name, slots=(), zipcode=False, showings_days=None, detail=False):
+    ###
+    ### Decorator registering a handler for intent name in INTENTS.
+    ###
+    def register(handler):
+        INTENTS[name] = Intent(name, handler, slots, zipcode, showings_days, detail)
+        return handler
+    return register
+
+
+class IntentContext(object):
+    ###
+    ### What dispatch hands a handler: the slots, the session attributes to
+    ### return, the validated zip code and, for intents that read them, the
+    ### showings view and TMDb detail record (fetched on first use, or all at
+    ### once by load()).
+    ###
+
+    def __init__(self, intent_request, spec):
+        self.request = intent_request
+        self.spec = spec
+        self.slots = intent_request['currentIntent']['slots']
+        self.session_attributes = intent_request['sessionAttributes']
+        self.zipcode = None
+        self.showings_days = spec.showings_days
+        self._start_date = None
+        self._movies = None
+        self._detail = None
+
+    @property
+    def start_date(self):
+        # the current local time; fixed for the whole request
+        if self._start_date is None:
+            import arrow
+            self._start_date = arrow.utcnow().to('-07:00')
+        return self._start_date
+
+    @property
+    def movies(self):
+        if self._movies is None:
+            import showings
+            self._movies = showings.repository.get(self.zipcode, self.start_date.format('YYYY-MM-DD'), self.showings_days)
+        return self._movies
+
+    @property
+    def detail(self):
+        # None if no TMDb movie matches the movie_title slot
+        if self._detail is None:
+            import tmdb
+            self._detail = tmdb.movie_detail(self.slots['movie_title']) or False
+        return self._detail or None
+
+    async def load(self):
+        ###
+        ### Fetch everything the intent reads, concurrently.
+        ###
+        import asyncio
+        calls = []
+        if self.spec.showings_days:
+            import showings
+            calls.append(showings.repository.get_async(self.zipcode, self.start_date.format('YYYY-MM-DD'), self.spec.showings_days))
+        if self.spec.detail:
+            import tmdb
+            calls.append(tmdb.movie_detail_async(self.slots['movie_title']))
+        results = await asyncio.gather(*calls)
+        if self.spec.detail:
+            self._detail = results.pop() or False
+        if self.spec.showings_days:
+            self._movies = results.pop()
+
+    def provide(self, start_date=None, movies=None, detail=None):
+        ###
+        ### Hand the context data fetched for it elsewhere, e.g. once for a
+        ### whole group of batched events.
+        ###
+        if start_date is not None:
+            self._start_date = start_date
+        if movies is not None:
+            self._movies = movies
+        if detail is not None:
+            self._detail = detail or False
+
+
+def validate_request(intent_request, spec, context):
+    ###
+    ### Middleware run by dispatch before the handler. Returns the response to a
+    ### DialogCodeHook for an intent that needs a zip code (which never touches
+    ### the data layer), or a prompt for a missing slot; otherwise fills in
+    ### context.zipcode and returns None.
+    ###
+    source = intent_request['invocationSource']
+    slots = context.slots
+    if spec.zipcode and source == 'DialogCodeHook':
+        zipcode, context.session_attributes = validate_zipcode(slots, context.session_attributes)
+        if not zipcode:
+            if zipcode == False:
+                # user entered improperly-formatted zipcode -- need to correct
+                validation_result = build_validation_result(False, 'zipcode', INVALID_ZIPCODE_MESSAGE)
+                return elicit_slot(
+                    context.session_attributes,
+                    spec.name,
+                    slots,
+                    validation_result['violatedSlot'],
+                    validation_result['message']
+                )
+            # prompt for zipcode
+            return elicit_slot(
+                context.session_attributes,
+                spec.name,
+                slots,
+                'zipcode'
+            )
+        # delegate control back to Lex to perform intent fulfillment
+        return delegate(context.session_attributes, slots)
+    for slot in spec.slots:
+        if not slots.get(slot):
+            return elicit_slot(context.session_attributes, spec.name, slots, slot)
+    if spec.zipcode:
+        context.zipcode = context.session_attributes['zipcode']
+    return None
+
+
+### --- Response card pages --- ###
+
+
+class Listing(object):
+    ###
+    ### A list of items to offer as response card buttons, leading to intent:
+    ### option(item) builds the button for an item. The items are ranked by
+    ### count(item) as ranked() decides, and ranked records whether they were.
+    ###
+
+    def __init__(self, intent, message, title, subtitle, items, option, count, rank=None):
+        self.intent = intent
+        self.message = message
+        self.title = title
+        self.subtitle = subtitle
+        self.items, self.ranked = ranked(items, count, rank)
+        self.option = option
+
+
+LISTINGS = {}
+
+
+def listing(name):
+    ###
+    ### Decorator registering, in LISTINGS, the function which rebuilds intent
+    ### name's Listing from the context and the query saved in a page cursor
+    ### (and whether to rank it, see ranked()).
+    ###
+    def register(fn):
+        LISTINGS[name] = fn
+        return fn
+    return register
+
+
+def ranked(items, count, rank=None):
+    ###
+    ### Returns (items, whether they were ranked): most showtimes first, with
+    ### ties in their original order, if rank is True, in their original order
+    ### if it is False, and unless there is no time to count every item's
+    ### showtimes if it is None.
+    ###
+    items = list(items)
+    if rank is None:
+        rank = len(items) <= 1 or not deadline.low()
+        if not rank:
+            deadline.degrade('listing.unranked')
+    if not rank:
+        return items, False
+    return sorted(items, key=lambda item: -count(item)), True
+
+
+def card_page(context, name, query, results, offset=0):
+    ###
+    ### Returns the ElicitIntent response with the page of results starting at
+    ### offset. If there are more, a More button is added and a cursor to the
+    ### next page is left in the session attributes: the intent, query and
+    ### offset, and the showings window and ordering the results were built
+    ### with, so that every page comes from the same list.
+    ###
+    session_attributes = context.session_attributes
+    end = offset + CARD_PAGE_SIZE
+    options = [results.option(item) for item in results.items[offset:end]]
+    if end < len(results.items):
+        options.append(MORE_OPTION)
+        cursor = {'i': name, 'q': query, 'o': end, 'd': context.showings_days, 'r': results.ranked}
+        session_attributes[PAGE_ATTRIBUTE] = json.dumps(cursor, separators=(',', ':'))
+    else:
+        session_attributes.pop(PAGE_ATTRIBUTE, None)
+    return elicit_intent(
+        session_attributes,
+        results.intent,
+        {'contentType': 'PlainText', 'content': results.message},
+        # number cards on from the previous pages, each of which had a More button
+        build_response_card(results.title, results.subtitle, options, offset // CARD_PAGE_SIZE * ((CARD_PAGE_SIZE + 5) // 5) + 1)
+    )
+
+
+@listing('GetMovies')
+def movies_listing(context, zipcode, rank=None):
+    movies = context.movies
+    return Listing(
+        'FindMovie',
+        'Here are the movies I found:',
+        'Movies showing near %s' % zipcode,
+        'Select a movie to see theaters',
+        movies.titles(),
+        lambda m: {'text': m, 'value': 'Where is the film %s playing near %s' % (m, zipcode)},
+        movies.title_count,
+        rank
+    )
+
+
+@listing('FindMovie')
+def theaters_listing(context, title, rank=None):
+    movies = context.movies
+    return Listing(
+        'FindShowtimes',
+        '*%s* is showing at the following theaters:' % title,
+        'Theaters showing %s' % title,
+        'Select a theater to see showtimes',
+        movies.theaters_for(title),
+        lambda t: {'text': movies.theater_name(t), 'value': 'When is theater %s showing film %s' % (theater_label(movies, t), title)},
+        lambda t: movies.showtime_count(title, t),
+        rank
+    )
+
+
+@listing('GetTheaterMovies')
+def theater_movies_listing(context, theater, rank=None):
+    movies = context.movies
+    return Listing(
+        'FindShowtimes',
+        'Currently showing at *%s*:' % movies.theater_name(theater),
+        'Now showing',
+        'Select a movie to see showtimes',
+        movies.titles_at(theater),
+        lambda m: {'text': m, 'value': 'When is theater %s showing film %s' % (theater_label(movies, theater), m)},
+        lambda m: movies.showtime_count(m, theater),
+        rank
+    )
+
+
 ### --- Functions that control the bot's behavior --- ###
 
 
-def help(intent_request):
+@intent('GetHelp')
+def help(context):
     ###
     ### Returns help information and examples for bot
     ###
-    examples = [
-        "  * What movies are out right now?",
-        "  * What movies are playing near _zipcode_?",
-        "  * Where is _movie_ playing?",
-        "  * Tell me when _movie_ is showing at _theater_",
-        "  * How long is _movie_?",
-        "  * What is _movie_ rated?"
-    ]
-    output_session_attributes = intent_request['sessionAttributes']
-    content = "You can ask me for information about when and where movies are playing, as well as for basic info on current movies. Here are some examples of things you can ask me:\n%s" % "\n".join(examples)
     return close(
-        output_session_attributes,
+        context.session_attributes,
         'Fulfilled',
         {
             'contentType': 'PlainText',
-            'content': content
+            'content': HELP_CONTENT
         }
     )
 
 
-def get_movie_detail(intent_request):
+@intent('GetMovieDetail', slots=('movie_title',), detail=True)
+def get_movie_detail(context):
     ###
-    ### Performs dialog management and fulfillment for retrieving info
-    ### for a particular movie.
+    ### Performs fulfillment for retrieving info for a particular movie.
     ###
-    movie_title = intent_request['currentIntent']['slots']['movie_title']
-    source = intent_request['invocationSource']
-    output_session_attributes = intent_request['sessionAttributes']
-    rating = ''
-    release_date = ''
-    runtime = 0
-
-    # get TMDB movie ID based on provided movie title
-    best_id = 0
-    best_title = ''
-    r = requests.get('https://api.themoviedb.org/3/search/movie', params={'language': 'en-US', 'page': '1', 'include_adult': 'false', 'primary_release_year': '2018', 'query': movie_title.strip(), 'api_key': os.environ['TMDB_API_KEY']})
-    if r.status_code == 200 and r.text:
-        results = r.json()
-        best_sim = 0
-        # find closest match to provided movie title
-        for m in results['results']:
-            prob = similar(m['title'].lower().strip(), movie_title.lower().strip())
-            if prob >= 0.5:
-                if prob > best_sim:
-                    best_sim = prob
-                    best_id = m['id']
-                    best_title = m['title']
-    if best_id != 0:
-        # get movie rating
-        r = requests.get("https://api.themoviedb.org/3/movie/%s/release_dates" % best_id, params={'api_key': os.environ['TMDB_API_KEY']})
-        if r.status_code == 200 and r.text:
-            results = r.json()
-            for r in results['results']:
-                if r['iso_3166_1'] == 'US':
-                    rating = r['release_dates'][0]['certification']
-
-        # get movie runtime and release date
-        r = requests.get("https://api.themoviedb.org/3/movie/%s" % best_id, params={'api_key': os.environ['TMDB_API_KEY'], 'language': 'en-US'})
-        if r.status_code == 200 and r.text:
-            result = r.json()
-            runtime = result['runtime']
-            release_date = arrow.get(result['release_date']).format('ddd, MMM Do YYYY')
-
-        # get stars and directors
-        r = requests.get("https://api.themoviedb.org/3/movie/%s/credits" % best_id, params={'api_key': os.environ['TMDB_API_KEY']})
-        if r.status_code == 200 and r.text:
-            result = r.json()
-            stars = []
-            directors = []
-            cast = result['cast']
-            for i in range(0, min(len(cast), 3)):
-                stars.append(cast[i]['name'])
-            for c in result['crew']:
-                if c['department'] == 'Directing' and c['job'] == 'Director':
-                    directors.append(c['name'])
-    if best_id:
-        content = "Here is some info for *%s*:\n_Starring_: %s\n_Directed by_: %s\n_Release date_: %s\n_Runtime_: %d mins\n_Rating_: %s" % (best_title, ", ".join(stars), ", ".join(directors), release_date, runtime, rating)
+    movie_title = context.slots['movie_title']
+
+    import arrow
+
+    # get TMDB movie ID based on provided movie title, then its details
+    detail = context.detail
+    if detail:
+        release_date = arrow.get(detail['release_date']).format('ddd, MMM Do YYYY') if detail['release_date'] else ''
+        content = "Here is some info for *%s*:\n_Starring_: %s\n_Directed by_: %s\n_Release date_: %s\n_Runtime_: %d mins\n_Rating_: %s" % (detail['title'], ", ".join(detail['stars']), ", ".join(detail['directors']), release_date, detail['runtime'], detail['rating'])
     else:
         content = "I'm sorry, I can't find any info for *%s*" % movie_title
     return close(
-        output_session_attributes,
+        context.session_attributes,
         'Fulfilled',
         {
             'contentType': 'PlainText',
@@ -253,89 +615,40 @@ def get_movie_detail(intent_request):
     )
 
 
-def get_showtimes(intent_request):
+@intent('FindShowtimes', slots=('movie_title', 'theater_name'), zipcode=True, showings_days=3)
+def get_showtimes(context):
     ###
-    ### Performs dialog management and fulfillment for finding showtimes for a
-    ### (movie, theater) pair.
+    ### Performs fulfillment for finding showtimes for a (movie, theater) pair.
     ###
-    source = intent_request['invocationSource']
-    slots = intent_request['currentIntent']['slots']
-    output_session_attributes = intent_request['sessionAttributes']
-
-    # perform slot validation
-    if source == 'DialogCodeHook':
-        zipcode, output_session_attributes = validate_zipcode(slots, output_session_attributes)
-        if not zipcode:
-            if zipcode == False:
-                # user entered improperly-formatted zipcode -- need to correct
-                validation_result = build_validation_result(False, 'zipcode', 'Whoops! You entered an invalid zip code. What is your zip code?')
-                return elicit_slot(
-                    output_session_attributes,
-                    intent_request['currentIntent']['name'],
-                    slots,
-                    validation_result['violatedSlot'],
-                    validation_result['message']
-                )
-            # prompt for zipcode
-            return elicit_slot(
-                output_session_attributes,
-                intent_request['currentIntent']['name'],
-                slots,
-                'zipcode'
-            )
-        else:
-            # delegate control back to Lex to perform intent fulfillment
-            return delegate(output_session_attributes, slots)
-
-    movie_title = slots['movie_title']
-    theater_name = slots['theater_name']
-    zipcode = output_session_attributes['zipcode']
-
-    # send API request to get movie info
-    start_date = arrow.utcnow().to('-07:00')
-    r = requests.get('http://data.tmsapi.com/v1.1/movies/showings', params={'startDate': start_date.format('YYYY-MM-DD'), 'zip': zipcode, 'numDays': 3, 'api_key': os.environ['TMS_API_KEY']})
-    if r.status_code == 200 and r.text:
-        movies = r.json()
-        best_sim = 0
-        best_title = ''
-        best_theater = ''
-        # find closest match to provided movie title
-        for m in movies:
-            prob = similar(m['title'].lower().strip(), movie_title.lower().strip())
-            if prob >= 0.5:
-                if prob > best_sim:
-                    best_sim = prob
-                    best_title = m['title']
-        best_sim = 0
-        # find closest match to provided theater name
-        for m in movies:
-            for s in m['showtimes']:
-                prob = similar(s['theatre']['name'].lower().strip(), theater_name.lower().strip())
-                if prob >= 0.5:
-                    if prob > best_sim:
-                        best_sim = prob
-                        best_theater = s['theatre']['name']
-        showtimes = {}
-        # find showings of movies matching our best-guessed movie playing
-        # at our best-guessed theater
-        for m in movies:
-            if m['title'] == best_title:
-                for s in m['showtimes']:
-                    if s['theatre']['name'] == best_theater:
-                        showtime = arrow.Arrow.strptime(s['dateTime'], '%Y-%m-%dT%H:%M', '-07:00')
-                        if showtime > start_date:
-                            showtime_key = showtime.format('YYYY-MM-DD')
-                            if showtime_key in showtimes:
-                                showtimes[showtime_key].append(showtime.format('h:mm a'))
-                            else:
-                                showtimes[showtime_key] = [showtime.format('h:mm a')]
+    movie_title = context.slots['movie_title']
+    theater_name = context.slots['theater_name']
+    output_session_attributes = context.session_attributes
+
+    import showings
+
+    movies = context.movies
+    # find closest matches to provided movie title and theater name, starting
+    # with the ones offered by the previous turn
+    digest_titles, digest_theaters = load_digest(output_session_attributes, movies)
+    best_title = resolve(movie_title, digest_titles, movies.has_title, movies.title_matcher, 'title')
+    best_theater = resolve_theater(theater_name, digest_theaters, movies)
+    if deadline.low():
+        # no time to look up the showtimes, so offer the theater's movies instead
+        movies_list = theater_movies_listing(context, best_theater)
+        if len(movies_list.items) > 0:
+            deadline.degrade('listing.titles')
+            save_digest(output_session_attributes, movies, movies_list.items, [best_theater])
+            return card_page(context, 'GetTheaterMovies', best_theater, movies_list)
+    # find upcoming showings of our best-guessed movie playing at our
+    # best-guessed theater
+    now = showings.to_minutes(context.start_date.format('YYYY-MM-DDTHH:mm'))
+    with tracing.span('format'):
+        showtimes = showings.group_by_day(movies.showtimes(best_title, best_theater, after=now))
+        showtimes_list = ["*%s*\n```%s```" % (day, "\n".join(times)) for day, times in showtimes]
     if len(showtimes) > 0:
-        showtimes_list = []
-        for s in sorted(showtimes.keys()):
-            showtimes_list.append("*%s*\n```%s```" % (arrow.get(s, 'YYYY-MM-DD').format('ddd, MMM Do'), "\n".join(showtimes[s])))
-        content = "*%s* is showing at %s at the following times:\n%s" % (best_title, best_theater, "\n".join(showtimes_list))
+        content = "*%s* is showing at %s at the following times:\n%s" % (best_title, movies.theater_name(best_theater), "\n".join(showtimes_list))
     else:
-        content = "I'm sorry, I can't find any showtimes for *%s* at %s" % (best_title, best_theater)
+        content = "I'm sorry, I can't find any showtimes for *%s* at %s" % (best_title, movies.theater_name(best_theater))
     return close(
         output_session_attributes,
         'Fulfilled',
@@ -346,83 +659,24 @@ def get_showtimes(intent_request):
     )
 
 
-def find_movie(intent_request):
+@intent('FindMovie', slots=('movie_title',), zipcode=True, showings_days=1)
+def find_movie(context):
     ###
-    ### Performs dialog management and fulfillment for finding a particular movie
-    ### playing in a zip code area.
+    ### Performs fulfillment for finding a particular movie playing in a zip code
+    ### area.
     ###
-    source = intent_request['invocationSource']
-    slots = intent_request['currentIntent']['slots']
-    output_session_attributes = intent_request['sessionAttributes']
-
-    # perform slot validation
-    if source == 'DialogCodeHook':
-        zipcode, output_session_attributes = validate_zipcode(slots, output_session_attributes)
-        if not zipcode:
-            if zipcode == False:
-                # user entered improperly-formatted zipcode -- need to correct
-                validation_result = build_validation_result(False, 'zipcode', 'Whoops! You entered an invalid zip code. What is your zip code?')
-                return elicit_slot(
-                    output_session_attributes,
-                    intent_request['currentIntent']['name'],
-                    slots,
-                    validation_result['violatedSlot'],
-                    validation_result['message']
-                )
-            # prompt for zipcode
-            return elicit_slot(
-                output_session_attributes,
-                intent_request['currentIntent']['name'],
-                slots,
-                'zipcode'
-            )
-        else:
-            # delegate control back to Lex to perform intent fulfillment
-            return delegate(output_session_attributes, slots)
-
-    movie_title = slots['movie_title']
-    zipcode = output_session_attributes['zipcode']
-
-    # send API request to get movie info
-    theaters = []
-    start_date = arrow.utcnow().to('-07:00').format('YYYY-MM-DD')
-    r = requests.get('http://data.tmsapi.com/v1.1/movies/showings', params={'startDate': start_date, 'zip': zipcode, 'api_key': os.environ['TMS_API_KEY']})
-    if r.status_code == 200 and r.text:
-        movies = r.json()
-        best_sim = 0
-        best_title = ''
-        # find closest match to provided movie title
-        for m in movies:
-            prob = similar(m['title'].lower().strip(), movie_title.lower().strip())
-            if prob >= 0.5:
-                if prob > best_sim:
-                    best_sim = prob
-                    best_title = m['title']
-        # find all theaters showing our best-matched title
-        for m in movies:
-            if m['title'] == best_title:
-                for s in m['showtimes']:
-                    if s['theatre']['name'] in theaters:
-                        continue
-                    else:
-                        theaters.append(s['theatre']['name'])
-    if len(theaters) > 0:
-        theater_opts = []
-        for t in theaters:
-            theater_opts.append({
-                'text': t,
-                'value': 'When is theater %s showing film %s' % (t, best_title)
-            })
-        return elicit_intent(
-            output_session_attributes,
-            'FindShowtimes',
-            {'contentType': 'PlainText', 'content': '*%s* is showing at the following theaters:' % best_title},
-            build_response_card(
-                'Theaters showing %s' % best_title,
-                'Select a theater to see showtimes',
-                theater_opts
-            )
-        )
+    movie_title = context.slots['movie_title']
+    output_session_attributes = context.session_attributes
+
+    movies = context.movies
+    # find closest match to provided movie title
+    digest_titles, digest_theaters = load_digest(output_session_attributes, movies)
+    best_title = resolve(movie_title, digest_titles, movies.has_title, movies.title_matcher, 'title')
+    # find all theaters showing our best-matched title
+    theaters = theaters_listing(context, best_title)
+    if len(theaters.items) > 0:
+        save_digest(output_session_attributes, movies, [best_title], theaters.items)
+        return card_page(context, 'FindMovie', best_title, theaters)
     else:
         content = "I'm sorry, I can't find any theaters showing *%s*" % movie_title
     return close(
@@ -435,85 +689,24 @@ def find_movie(intent_request):
     )
 
 
-def get_theater_movies(intent_request):
+@intent('GetTheaterMovies', slots=('theater_name',), zipcode=True, showings_days=1)
+def get_theater_movies(context):
     ###
-    ### Performs dialog management and fulfillment for finding movies playing at a
-    ### particular theater in a zip code area.
+    ### Performs fulfillment for finding movies playing at a particular theater in
+    ### a zip code area.
     ###
-    source = intent_request['invocationSource']
-    slots = intent_request['currentIntent']['slots']
-    output_session_attributes = intent_request['sessionAttributes']
-
-    # perform slot validation
-    if source == 'DialogCodeHook':
-        zipcode, output_session_attributes = validate_zipcode(slots, output_session_attributes)
-        if not zipcode:
-            if zipcode == False:
-                # user entered improperly-formatted zipcode -- need to correct
-                validation_result = build_validation_result(False, 'zipcode', 'Whoops! You entered an invalid zip code. What is your zip code?')
-                return elicit_slot(
-                    output_session_attributes,
-                    intent_request['currentIntent']['name'],
-                    slots,
-                    validation_result['violatedSlot'],
-                    validation_result['message']
-                )
-            # prompt for zipcode
-            return elicit_slot(
-                output_session_attributes,
-                intent_request['currentIntent']['name'],
-                slots,
-                'zipcode'
-            )
-        else:
-            # delegate control back to Lex to perform intent fulfillment
-            return delegate(output_session_attributes, slots)
-
-    theater_name = slots['theater_name']
-    zipcode = output_session_attributes['zipcode']
-
-    # send API request to get movie info
-    movies_list = []
-    start_date = arrow.utcnow().to('-07:00').format('YYYY-MM-DD')
-    r = requests.get('http://data.tmsapi.com/v1.1/movies/showings', params={'startDate': start_date, 'zip': zipcode, 'api_key': os.environ['TMS_API_KEY']})
-    if r.status_code == 200 and r.text:
-        movies = r.json()
-        prob = 0
-        best_sim = 0
-        best_theater = ''
-        # determine best theater name match
-        for m in movies:
-            for s in m['showtimes']:
-                prob = similar(s['theatre']['name'].lower().strip(), theater_name.lower().strip())
-                if prob >= 0.5:
-                    if prob > best_sim:
-                        best_sim = prob
-                        best_theater = s['theatre']['name']
-        # find movies at best-matched theater name
-        for m in movies:
-            for s in m['showtimes']:
-                if s['theatre']['name'] == best_theater:
-                    if m['title'] in movies_list:
-                        continue
-                    else:
-                        movies_list.append(m['title'])
-    if len(movies_list) > 0:
-        movie_opts = []
-        for m in movies_list:
-            movie_opts.append({
-                'text': m,
-                'value': 'When is theater %s showing film %s' % (best_theater, m)
-            })
-        return elicit_intent(
-            output_session_attributes,
-            'FindShowtimes',
-            {'contentType': 'PlainText', 'content': 'Currently showing at *%s*:' % best_theater},
-            build_response_card(
-                'Now showing',
-                'Select a movie to see showtimes',
-                movie_opts
-            )
-        )
+    theater_name = context.slots['theater_name']
+    output_session_attributes = context.session_attributes
+
+    movies = context.movies
+    # determine best theater name match
+    digest_titles, digest_theaters = load_digest(output_session_attributes, movies)
+    best_theater = resolve_theater(theater_name, digest_theaters, movies)
+    # find movies at best-matched theater name
+    movies_list = theater_movies_listing(context, best_theater)
+    if len(movies_list.items) > 0:
+        save_digest(output_session_attributes, movies, movies_list.items, [best_theater])
+        return card_page(context, 'GetTheaterMovies', best_theater, movies_list)
     else:
         content = "I'm sorry, I can't find any movies showing at *%s*" % theater_name
     return close(
@@ -526,70 +719,18 @@ def get_theater_movies(intent_request):
     )
 
 
-def get_movies(intent_request):
+@intent('GetMovies', zipcode=True, showings_days=1)
+def get_movies(context):
     ###
-    ### Performs dialog management and fulfillment for listing all movies playing in
-    ### a zip code area.
+    ### Performs fulfillment for listing all movies playing in a zip code area.
     ###
-    source = intent_request['invocationSource']
-    slots = intent_request['currentIntent']['slots']
-    output_session_attributes = intent_request['sessionAttributes']
+    output_session_attributes = context.session_attributes
+    zipcode = context.zipcode
 
-    # perform slot validation
-    if source == 'DialogCodeHook':
-        zipcode, output_session_attributes = validate_zipcode(slots, output_session_attributes)
-        if not zipcode:
-            if zipcode == False:
-                # user entered improperly-formatted zipcode -- need to correct
-                validation_result = build_validation_result(False, 'zipcode', 'Whoops! You entered an invalid zip code. What is your zip code?')
-                return elicit_slot(
-                    output_session_attributes,
-                    intent_request['currentIntent']['name'],
-                    slots,
-                    validation_result['violatedSlot'],
-                    validation_result['message']
-                )
-            # prompt for zipcode
-            return elicit_slot(
-                output_session_attributes,
-                intent_request['currentIntent']['name'],
-                slots,
-                'zipcode'
-            )
-        else:
-            # delegate control back to Lex to perform intent fulfillment
-            return delegate(output_session_attributes, slots)
-
-
-    # send API request to get movie showings
-    zipcode = output_session_attributes['zipcode']
-    movies_list = []
-    start_date = arrow.utcnow().to('-07:00').format('YYYY-MM-DD')
-    r = requests.get('http://data.tmsapi.com/v1.1/movies/showings', params={'startDate': start_date, 'zip': zipcode, 'api_key': os.environ['TMS_API_KEY']})
-    if r.status_code == 200 and r.text:
-        movies = r.json()
-        for m in movies:
-            if m['title'] in movies_list:
-                continue
-            else:
-                movies_list.append(m['title'])
-    if len(movies_list) > 0:
-        movie_opts = []
-        for m in movies_list:
-            movie_opts.append({
-                'text': m,
-                'value': 'Where is the film %s playing near %s' % (m, zipcode)
-            })
-        return elicit_intent(
-            output_session_attributes,
-            'FindMovie',
-            {'contentType': 'PlainText', 'content': 'Here are the movies I found:'},
-            build_response_card(
-                'Movies showing near %s' % zipcode,
-                'Select a movie to see theaters',
-                movie_opts
-            )
-        )
+    movies_list = movies_listing(context, zipcode)
+    if len(movies_list.items) > 0:
+        save_digest(output_session_attributes, context.movies, movies_list.items)
+        return card_page(context, 'GetMovies', zipcode, movies_list)
     else:
         content = "I'm sorry, I can't find any movies showing near *%s*" % zipcode
     return close(
@@ -602,32 +743,107 @@ def get_movies(intent_request):
     )
 
 
+@intent('MoreResults')
+def more_results(context):
+    ###
+    ### Performs fulfillment for the More button of a response card: serves the
+    ### next page of the listing saved in the page cursor, rebuilt from the
+    ### cached showings over the same window and in the same order. The Lex
+    ### intent has no zip code slot or validation code hook, so the zip code is
+    ### read from the session here, and a session without one (or without a
+    ### usable cursor) is told there are no more results.
+    ###
+    output_session_attributes = context.session_attributes
+    results = None
+    try:
+        cursor = json.loads(output_session_attributes.pop(PAGE_ATTRIBUTE))
+        offset = int(cursor['o'])
+        rebuild = LISTINGS[cursor['i']]
+        # cursors saved before they carried the window and ordering were ranked over one day
+        days = cursor.get('d', 1)
+        if days not in set(spec.showings_days for spec in INTENTS.values() if spec.showings_days):
+            raise ValueError('unexpected showings window %r' % (days,))
+        context.zipcode = output_session_attributes['zipcode']
+        context.showings_days = days
+        if offset > 0:
+            results = rebuild(context, cursor['q'], bool(cursor.get('r', True)))
+    except (KeyError, ValueError, TypeError):
+        results = None
+    if results is not None and offset < len(results.items):
+        return card_page(context, cursor['i'], cursor['q'], results, offset)
+    return close(
+        output_session_attributes,
+        'Fulfilled',
+        {
+            'contentType': 'PlainText',
+            'content': "I'm sorry, I don't have any more results to show you"
+        }
+    )
+
+
 ### --- Intents --- ###
 
 
-def dispatch(intent_request):
+_loop = None
+
+
+def run(coroutine):
     ###
-    ### Called when the user specifies an intent for this bot.
+    ### Run coroutine to completion on this container's event loop, which is
+    ### created on first use and kept for later invocations.
+    ###
+    global _loop
+    if _loop is None:
+        import asyncio
+        _loop = asyncio.new_event_loop()
+    return _loop.run_until_complete(coroutine)
+
+
+def begin(intent_request):
+    ###
+    ### Look up the intent's registration and run the validation middleware.
+    ### Returns the spec, the handler's context and, if validation answered
+    ### the request itself, its response.
     ###
 
     logger.debug('dispatch userId={}, intentName={}'.format(intent_request['userId'], intent_request['currentIntent']['name']))
 
     intent_name = intent_request['currentIntent']['name']
+    spec = INTENTS.get(intent_name)
+    if spec is None:
+        raise Exception('Intent with name ' + intent_name + ' not supported')
+    context = IntentContext(intent_request, spec)
+    return spec, context, validate_request(intent_request, spec, context)
 
-    # Dispatch to your bot's intent handlers
-    if intent_name == 'FindMovie':
-        return find_movie(intent_request)
-    if intent_name == 'GetTheaterMovies':
-        return get_theater_movies(intent_request)
-    if intent_name == 'GetMovies':
-        return get_movies(intent_request)
-    if intent_name == 'FindShowtimes':
-        return get_showtimes(intent_request)
-    if intent_name == 'GetMovieDetail':
-        return get_movie_detail(intent_request)
-    if intent_name == 'GetHelp':
-        return help(intent_request)
-    raise Exception('Intent with name ' + intent_name + ' not supported')
+
+def dispatch(intent_request):
+    ###
+    ### Called when the user specifies an intent for this bot: runs the
+    ### validation middleware, then the intent's registered handler.
+    ###
+    spec, context, response = begin(intent_request)
+    if response is not None:
+        return response
+    if ASYNC_HANDLER and (spec.showings_days or spec.detail):
+        with tracing.span('load'):
+            run(context.load())
+    with tracing.span('handler'):
+        return spec.handler(context)
+
+
+async def dispatch_async(intent_request):
+    ###
+    ### dispatch() for callers already running an event loop: everything the
+    ### handler reads is fetched first, with the independent calls gathered,
+    ### so the handler itself never waits on the network.
+    ###
+    spec, context, response = begin(intent_request)
+    if response is not None:
+        return response
+    with tracing.span('load'):
+        await context.load()
+    with tracing.span('handler'):
+        return spec.handler(context)
 
 
 ### --- Main handler --- ###
@@ -636,8 +852,51 @@ def dispatch(intent_request):
 def lambda_handler(event, context):
     ###
     ### Route the incoming request based on intent.
-    ### The JSON body of the request is provided in the event slot.
+    ### The JSON body of the request is provided in the event slot. Upstream
+    ### calls are bounded by the time Lambda has left (see deadline.py).
     ###
 
+    global invocations
+    invocations += 1
     logger.debug('event.bot.name={}'.format(event['bot']['name']))
-    return dispatch(event)
+    with tracing.invocation(Intent=event['currentIntent']['name']), deadline.invocation(context):
+        tracing.incr('cold_start', 1 if invocations == 1 else 0)
+        response = dispatch(event)
+    log_stats()
+    return response
+
+
+def log_stats():
+    # only report on the parts of the data layer this container has loaded
+    if 'showings' in sys.modules:
+        logger.debug('showings cache stats={}'.format(sys.modules['showings'].repository.cache.stats()))
+    if 'tmdb' in sys.modules:
+        logger.debug('tmdb cache stats titles={}, details={}'.format(sys.modules['tmdb'].titles.stats(), sys.modules['tmdb'].details.stats()))
+    if 'aliases' in sys.modules:
+        logger.debug('alias stats={}'.format(sys.modules['aliases'].stats()))
+    if deadline.counts:
+        logger.debug('degraded responses={}'.format(deadline.stats()))
+    if 'upstream' in sys.modules:
+        logger.debug('upstream stats={}'.format(sys.modules['upstream'].stats))
+    if 'quota' in sys.modules:
+        logger.debug('quota stats={}'.format(sys.modules['quota'].stats()))
+
+
+def batch_handler(event, context):
+    ###
+    ### Entry point for evaluating many Lex events in one call (replaying
+    ### conversation logs, regression tests, pre-computing answers): takes
+    ### {'events': [...]} and returns {'responses': [...]} in the same order.
+    ###
+    import batch
+    return batch.handler(event, context)
+
+
+def prewarm_handler(event, context):
+    ###
+    ### Scheduled entry point (e.g. a CloudWatch Events rule) which materializes
+    ### showings for the zip codes in PREWARM_ZIPCODES, or in the event's
+    ### 'zipcodes' list, ahead of user requests.
+    ###
+    import prewarm
+    return prewarm.prewarm(event.get('zipcodes') if event else None)
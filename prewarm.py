@@ -0,0 +1,55 @@
+###
+### Pre-warm job: materializes showings indexes for a configured list of zip codes
+### so that the first user in each zip does not pay for the TMS fetch.
+###
+
+import os
+import time
+import arrow
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import quota
+import showings
+
+logger = logging.getLogger()
+
+ZIPCODES = [z.strip() for z in os.environ.get('PREWARM_ZIPCODES', '').split(',') if z.strip()]
+CONCURRENCY = int(os.environ.get('PREWARM_CONCURRENCY', 4))
+
+
+def prewarm(zipcodes=None, start_date=None, concurrency=CONCURRENCY):
+    ###
+    ### Fetch, index and store showings for each zip code (or for each cluster of
+    ### nearby zip codes), at most `concurrency` at a time. Returns one report per
+    ### fetch with its fetch time, payload size and index build time.
+    ###
+    if zipcodes is None:
+        zipcodes = ZIPCODES
+    if start_date is None:
+        start_date = arrow.utcnow().to('-07:00').format('YYYY-MM-DD')
+    start = time.perf_counter()
+
+    # nearby zip codes share one fetch, so only refresh each area once
+    areas = {}
+    for zipcode in zipcodes:
+        areas.setdefault(showings.repository.fetch_area(zipcode), []).append(zipcode)
+
+    def refresh(area):
+        # pre-warming only uses the part of the API quotas not reserved for users
+        with quota.background():
+            index, report = showings.repository.refresh(area[0], start_date, radius=area[1])
+        report['ok'] = index is not None
+        report['serves'] = areas[area]
+        return report
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        reports = list(pool.map(refresh, areas))
+    for report in reports:
+        logger.info('prewarm {}'.format(report))
+    return {
+        'start_date': start_date,
+        'elapsed_ms': round((time.perf_counter() - start) * 1000, 1),
+        'failed': [z for r in reports if not r['ok'] for z in r['serves']],
+        'zipcodes': reports
+    }
@@ -0,0 +1,282 @@
+###
+### Outbound call quotas for the Gracenote TMS and TMDb API keys.
+###
+### Every call made with an API key first takes a token from that key's
+### Governor: a token bucket refilled at the provider's per-second rate, plus a
+### daily call count. Fulfillment calls wait briefly for a token; calls made in
+### the background (the pre-warm job) may not use the last QUOTA_RESERVE share of
+### either budget, so pre-warming can never starve users. A call that cannot get
+### a token raises QuotaExceededError, which callers treat like any other failed
+### request (serving cached data where they have it).
+###
+### The daily count is kept in process by default. With QUOTA_REDIS_URL it is
+### shared by every container, along with a per-second count that holds all
+### containers together to the provider's rate.
+###
+
+import os
+import time
+import hashlib
+import logging
+import threading
+import requests
+
+import deadline
+import tracing
+import upstream
+
+logger = logging.getLogger()
+
+# fraction of the burst and daily budgets kept back for fulfillment calls
+RESERVE = float(os.environ.get('QUOTA_RESERVE', 0.5))
+# how long, in seconds, fulfillment and background calls wait for a token
+MAX_WAIT = float(os.environ.get('QUOTA_MAX_WAIT', 1))
+BACKGROUND_MAX_WAIT = float(os.environ.get('QUOTA_BACKGROUND_MAX_WAIT', 30))
+REDIS_URL = os.environ.get('QUOTA_REDIS_URL')
+
+# per-second rate, burst size and daily limit (0 for none) of each API
+LIMITS = {
+    'tms': (float(os.environ.get('QUOTA_TMS_RATE', 2)), float(os.environ.get('QUOTA_TMS_BURST', 4)), int(os.environ.get('QUOTA_TMS_DAILY', 0))),
+    'tmdb': (float(os.environ.get('QUOTA_TMDB_RATE', 4)), float(os.environ.get('QUOTA_TMDB_BURST', 40)), int(os.environ.get('QUOTA_TMDB_DAILY', 0)))
+}
+
+FULFILLMENT = 'fulfillment'
+BACKGROUND = 'background'
+
+_local = threading.local()
+
+
+class QuotaExceededError(requests.RequestException):
+    ###
+    ### Raised instead of issuing a request when no token could be had in time.
+    ###
+    pass
+
+
+class background(object):
+    ###
+    ### Marks the calls made by this thread inside the block as background calls:
+    ###
+    ###     with quota.background():
+    ###         showings.repository.refresh(...)
+    ###
+
+    def __enter__(self):
+        self.previous = getattr(_local, 'priority', FULFILLMENT)
+        _local.priority = BACKGROUND
+        return self
+
+    def __exit__(self, *exc):
+        _local.priority = self.previous
+        return False
+
+
+def priority():
+    return getattr(_local, 'priority', FULFILLMENT)
+
+
+class TokenBucket(object):
+    ###
+    ### Holds up to burst tokens, refilled at rate tokens per second.
+    ###
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self):
+        with self._lock:
+            self._refill()
+            return self.tokens
+
+    def take(self, floor=0):
+        ###
+        ### Take a token if that leaves at least floor tokens. Returns 0 if one
+        ### was taken, otherwise the number of seconds until one can be.
+        ###
+        with self._lock:
+            self._refill()
+            if self.tokens - 1 >= floor:
+                self.tokens -= 1
+                return 0
+            return (floor + 1 - self.tokens) / self.rate
+
+    def refund(self):
+        # give back a token taken for a call that was not made
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + 1)
+
+
+class MemoryCounter(object):
+    ###
+    ### Counters kept in this process.
+    ###
+
+    shared = False
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self._counts.get(key, 0)
+
+    def incr(self, key, ttl):
+        with self._lock:
+            # only the current day's (or second's) counters are ever read
+            if len(self._counts) > 64:
+                self._counts.clear()
+            self._counts[key] = self._counts.get(key, 0) + 1
+            return self._counts[key]
+
+    def decr(self, key):
+        with self._lock:
+            self._counts[key] = max(0, self._counts.get(key, 0) - 1)
+
+
+class RedisCounter(object):
+    ###
+    ### Counters shared by every container through Redis. The `redis` package is
+    ### only imported when this backend is configured.
+    ###
+
+    shared = True
+
+    def __init__(self, url=None, client=None, prefix='moviebot:quota:'):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        try:
+            return int(self.client.get(self.prefix + key) or 0)
+        except Exception:
+            logger.exception('unable to read quota counter {}'.format(key))
+            return 0
+
+    def incr(self, key, ttl):
+        try:
+            pipe = self.client.pipeline()
+            pipe.incr(self.prefix + key)
+            pipe.expire(self.prefix + key, int(ttl))
+            return pipe.execute()[0]
+        except Exception:
+            logger.exception('unable to update quota counter {}'.format(key))
+            return 0
+
+    def decr(self, key):
+        try:
+            self.client.decr(self.prefix + key)
+        except Exception:
+            logger.exception('unable to update quota counter {}'.format(key))
+
+
+class Governor(object):
+    ###
+    ### Meters the calls made with one API key.
+    ###
+
+    def __init__(self, name, api_key, rate, burst, daily=0, counter=None):
+        self.name = name
+        # counters are per key, without putting the key itself in them
+        self.id = '%s:%s' % (name, hashlib.sha1(api_key.encode('utf-8')).hexdigest()[:8])
+        self.rate = rate
+        self.daily = daily
+        self.bucket = TokenBucket(rate, burst)
+        self.counter = counter if counter is not None else MemoryCounter()
+        self.stats = {'calls': 0, 'waits': 0, 'rejected': 0, 'background': 0}
+
+    def _reject(self, reason):
+        self.stats['rejected'] += 1
+        tracing.incr('quota.%s.rejected' % self.name)
+        raise QuotaExceededError('%s quota exhausted (%s)' % (self.name, reason))
+
+    def acquire(self):
+        ###
+        ### Take a token for one call, waiting for it if need be; raises
+        ### QuotaExceededError if none can be had (DeadlineExceeded if none can
+        ### be had before the invocation's deadline).
+        ###
+        low = priority() == BACKGROUND
+        share = 1 - RESERVE if low else 1
+        day_key = '%s:%s' % (self.id, time.strftime('%Y%m%d', time.gmtime()))
+        if self.daily and self.counter.get(day_key) >= self.daily * share:
+            self._reject('daily')
+        max_wait = BACKGROUND_MAX_WAIT if low else MAX_WAIT
+        give_up_at = time.time() + deadline.clamp(max_wait)
+        floor = self.bucket.burst * RESERVE if low else 0
+        while True:
+            wait = self.bucket.take(floor)
+            if wait == 0 and self.counter.shared:
+                # hold every container together to the provider's rate
+                now = time.time()
+                second_key = '%s:%d' % (self.id, int(now))
+                if self.counter.incr(second_key, 2) > self.rate * share:
+                    # this second is used up: hand back both the shared count
+                    # and the local token, and wait for the next second
+                    self.counter.decr(second_key)
+                    self.bucket.refund()
+                    wait = 1 - (now % 1)
+            if wait == 0:
+                break
+            if time.time() + wait > give_up_at:
+                if deadline.clamp(max_wait) < max_wait:
+                    raise upstream.DeadlineExceeded('deadline passed waiting for %s quota' % self.name)
+                self._reject('rate')
+            self.stats['waits'] += 1
+            tracing.incr('quota.%s.wait' % self.name, wait * 1000, 'Milliseconds')
+            time.sleep(wait)
+        self.counter.incr(day_key, 24 * 3600)
+        self.stats['calls'] += 1
+        if low:
+            self.stats['background'] += 1
+        tracing.gauge('quota.%s.tokens' % self.name, self.bucket.tokens)
+
+    def budget(self):
+        ###
+        ### Returns the tokens currently in the bucket and the calls left today
+        ### (None if there is no daily limit).
+        ###
+        left = None
+        if self.daily:
+            left = max(0, self.daily - self.counter.get('%s:%s' % (self.id, time.strftime('%Y%m%d', time.gmtime()))))
+        return round(self.bucket.available(), 2), left
+
+
+governors = {}
+_counter = RedisCounter(REDIS_URL) if REDIS_URL else MemoryCounter()
+_lock = threading.Lock()
+
+
+def governor(name, api_key):
+    ###
+    ### Returns the Governor for api_key of API name ('tms' or 'tmdb').
+    ###
+    with _lock:
+        g = governors.get((name, api_key))
+        if g is None:
+            rate, burst, daily = LIMITS[name]
+            g = governors[(name, api_key)] = Governor(name, api_key, rate, burst, daily, _counter)
+        return g
+
+
+def stats():
+    ###
+    ### Returns {api: counts, current tokens and calls left today} for every
+    ### governor in use.
+    ###
+    report = {}
+    for g in list(governors.values()):
+        tokens, left = g.budget()
+        report[g.id] = dict(g.stats, tokens=tokens, left_today=left)
+    return report
@@ -0,0 +1,828 @@
+###
+### Repository for the Gracenote TMS `movies/showings` call, shared by all of the
+### intent handlers so that a conversation only fetches a zip code's showings once.
+###
+### Each fetched payload is reduced to a columnar ShowingsIndex, which is what
+### gets cached: the raw JSON is discarded once the index is built, and the
+### cache evicts indexes by their size in bytes as well as by count.
+###
+
+import os
+import sys
+import json
+import time
+import codecs
+import asyncio
+import logging
+import datetime
+import requests
+from array import array
+from bisect import bisect_left
+
+import geo
+import quota
+import deadline
+import snapshot
+import tracing
+import upstream
+from cache import build_cache
+from matcher import FuzzyMatcher
+
+logger = logging.getLogger()
+
+TMS_URL = os.environ.get('TMS_API_URL', 'http://data.tmsapi.com/v1.1')
+SHOWINGS_URL = TMS_URL + '/movies/showings'
+THEATRES_URL = TMS_URL + '/theatres'
+
+# always fetch at least this many days so that one entry serves every intent
+FETCH_DAYS = int(os.environ.get('SHOWINGS_FETCH_DAYS', 3))
+CACHE_TTL = int(os.environ.get('SHOWINGS_CACHE_TTL', 900))
+CACHE_SIZE = int(os.environ.get('SHOWINGS_CACHE_SIZE', 16))
+# budget for the cached indexes, as measured by ShowingsIndex.nbytes (0 for none)
+CACHE_BYTES = int(os.environ.get('SHOWINGS_CACHE_BYTES', 32 * 1024 * 1024))
+# for how long after expiring a cached index is still served while it is refetched
+STALE_TTL = int(os.environ.get('SHOWINGS_STALE_TTL', 600))
+# theaters within this many miles of the user's zip code are shown
+RADIUS = float(os.environ.get('SHOWINGS_RADIUS', 5))
+LOCATIONS_TTL = int(os.environ.get('THEATER_LOCATIONS_TTL', 24 * 3600))
+# parse the showings body incrementally rather than with r.json()
+STREAMING = os.environ.get('SHOWINGS_STREAMING', 'true').lower() == 'true'
+# large enough that few movies are cut off at a chunk boundary (and so parsed
+# twice), small next to the parsed payload it saves holding
+CHUNK_SIZE = 256 * 1024
+# directory of pre-built indexes written by the pre-warm job, and how long they stay usable
+STORE_DIR = os.environ.get('SHOWINGS_STORE_DIR')
+STORE_MAX_AGE = int(os.environ.get('SHOWINGS_STORE_MAX_AGE', 6 * 3600))
+SNAPSHOT_KIND = b'SHOW'
+SNAPSHOT_VERSION = 1
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+MINUTES_PER_DAY = 24 * 60
+
+
+def to_minutes(date_time):
+    ###
+    ### Convert a TMS local 'YYYY-MM-DDTHH:MM' (or 'YYYY-MM-DD') string to minutes
+    ### since the epoch on the local wall clock, so that minutes // MINUTES_PER_DAY
+    ### is the local day.
+    ###
+    days = datetime.date(int(date_time[0:4]), int(date_time[5:7]), int(date_time[8:10])).toordinal() - EPOCH_ORDINAL
+    minutes = days * MINUTES_PER_DAY
+    if len(date_time) >= 16:
+        minutes += int(date_time[11:13]) * 60 + int(date_time[14:16])
+    return minutes
+
+
+def from_minutes(minutes):
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(minutes=minutes)
+
+
+### --- Showtime labels --- ###
+
+DAY_NAMES = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTH_NAMES = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+_clock_labels = []
+_day_labels = {}
+
+
+def clock_label(minutes):
+    ###
+    ### 'h:mm a' label (e.g. '1:05 pm') of the time of day of minutes, from a
+    ### table of all 1440 labels built on first use.
+    ###
+    if not _clock_labels:
+        _clock_labels.extend('%d:%02d %s' % ((m // 60) % 12 or 12, m % 60, 'am' if m < 720 else 'pm') for m in range(MINUTES_PER_DAY))
+    return _clock_labels[minutes % MINUTES_PER_DAY]
+
+
+def day_label(day):
+    ###
+    ### 'ddd, MMM Do' label (e.g. 'Fri, Oct 16th') of a day number
+    ### (minutes // MINUTES_PER_DAY), memoized.
+    ###
+    label = _day_labels.get(day)
+    if label is None:
+        date = datetime.date.fromordinal(day + EPOCH_ORDINAL)
+        suffix = 'th' if 10 < date.day % 100 < 14 else {1: 'st', 2: 'nd', 3: 'rd'}.get(date.day % 10, 'th')
+        label = _day_labels[day] = '%s, %s %d%s' % (DAY_NAMES[date.weekday()], MONTH_NAMES[date.month - 1], date.day, suffix)
+    return label
+
+
+def group_by_day(times):
+    ###
+    ### Group sorted showtimes (local epoch minutes) by day, returning a list of
+    ### (day label, [time labels]).
+    ###
+    groups = []
+    current = None
+    for minutes in times:
+        day = minutes // MINUTES_PER_DAY
+        if day != current:
+            current = day
+            labels = []
+            groups.append((day_label(day), labels))
+        labels.append(clock_label(minutes))
+    return groups
+
+
+def iter_movies(chunks, counter=None):
+    ###
+    ### Incrementally parse a JSON array from an iterable of byte chunks, yielding
+    ### one movie at a time, so only a single movie (plus one chunk of input) is
+    ### ever held as Python objects. counter['bytes'] accumulates the input size.
+    ###
+    ### A movie cut off at the end of the buffer is not decoded again until
+    ### twice as much of it has arrived (the chunks in between are only
+    ### collected), so a movie spanning many chunks is re-parsed and copied a
+    ### logarithmic number of times rather than once per chunk.
+    ###
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf = ''
+    pos = 0
+    # text received but not yet added to buf, and how much of it buf[pos:] and
+    # pending must hold before decoding again
+    pending = []
+    pending_size = 0
+    need = 0
+    started = False
+    eof = False
+    while True:
+        # skip whitespace and separators up to the next value
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if pos < len(buf):
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError('expected a JSON array of movies')
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                return
+            if eof or len(buf) - pos >= need:
+                try:
+                    movie, end = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    # most likely a value cut off at the end of the buffer
+                    if eof:
+                        raise
+                    need = 2 * (len(buf) - pos)
+                else:
+                    pos = end
+                    need = 0
+                    yield movie
+                    continue
+        elif eof:
+            raise ValueError('unexpected end of JSON array')
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+            pending.append(utf8.decode(b'', True))
+        else:
+            if counter is not None:
+                counter['bytes'] = counter.get('bytes', 0) + len(chunk)
+            pending.append(utf8.decode(chunk))
+        pending_size += len(pending[-1])
+        if eof or len(buf) - pos + pending_size >= need:
+            buf = buf[pos:] + ''.join(pending)
+            pos = 0
+            pending = []
+            pending_size = 0
+
+
+class Showing(object):
+    ###
+    ### Record view of one row of a ShowingsIndex; the fields are read from the
+    ### index's columns on access.
+    ###
+    __slots__ = ('index', 'row')
+
+    def __init__(self, index, row):
+        self.index = index
+        self.row = row
+
+    @property
+    def title(self):
+        return self.index.titles[self.index.title_col[self.row]]
+
+    @property
+    def theater(self):
+        return self.index.theaters[self.index.theater_col[self.row]]
+
+    @property
+    def theater_name(self):
+        return self.index.theater_names[self.theater]
+
+    @property
+    def minutes(self):
+        return self.index.minute_col[self.row]
+
+
+class ShowingsIndex(object):
+    ###
+    ### Columnar index over a showings payload. Titles and TMS theatre IDs are
+    ### interned into string tables (in order of first appearance), with theater
+    ### ID -> display name; theaters are keyed by ID so that distinct theaters
+    ### sharing a name are kept apart. Each showing is one row of three parallel
+    ### arrays: title index, theater index and showtime in local epoch minutes.
+    ###
+    ### Rows are grouped by (title, theater) pair, each pair's showtimes sorted,
+    ### and pairs are grouped by title. Pair p's rows are
+    ### pair_start[p]:pair_start[p + 1], title t's pairs are
+    ### title_start[t]:title_start[t + 1], and theater h's pairs (in order of
+    ### first appearance) are theater_pairs[theater_start[h]:theater_start[h + 1]].
+    ###
+
+    def __init__(self):
+        self.titles = []
+        self.theaters = []
+        self.theater_names = {}
+        self.title_ids = {}
+        self.theater_ids = {}
+        self.title_col = array('H')
+        self.theater_col = array('H')
+        self.minute_col = array('i')
+        self.pair_start = array('I', [0])
+        self.pair_theater = array('H')
+        self.title_start = array('I', [0])
+        # every pair, in order of first appearance
+        self.pair_order = array('I')
+        self.theater_pairs = array('I')
+        self.theater_start = array('I', [0])
+        self.matchers = {}
+        # when the payload was fetched (epoch seconds); with the cache key it
+        # identifies this index, so title and theater positions can be handed out
+        # as IDs
+        self.fetched = 0
+        # (title index, theater index) -> showtimes, until finish()
+        self._pending = {}
+
+    def add(self, title, theater, minutes, name=None):
+        t = self.title_ids.get(title)
+        if t is None:
+            title = sys.intern(title)
+            t = self.title_ids[title] = len(self.titles)
+            self.titles.append(title)
+        h = self.theater_ids.get(theater)
+        if h is None:
+            theater = sys.intern(theater)
+            h = self.theater_ids[theater] = len(self.theaters)
+            self.theaters.append(theater)
+            self.theater_names[theater] = theater if name is None else sys.intern(name)
+        times = self._pending.get((t, h))
+        if times is None:
+            times = self._pending[(t, h)] = array('i')
+        times.append(minutes)
+
+    def finish(self):
+        ###
+        ### Pack the showings added so far into the columns.
+        ###
+        pending = self._pending
+        self._pending = {}
+        pairs = list(pending)
+        typecode = 'H' if max(len(self.titles), len(self.theaters)) <= 0xffff else 'I'
+        self.title_col = array(typecode)
+        self.theater_col = array(typecode)
+        self.minute_col = array('i')
+        self.pair_start = array('I', [0])
+        self.pair_theater = array(typecode)
+        title_counts = [0] * len(self.titles)
+        theater_counts = [0] * len(self.theaters)
+        position = [0] * len(pairs)
+        # sorted() is stable, so each title's pairs keep their order of appearance
+        for p, r in enumerate(sorted(range(len(pairs)), key=lambda r: pairs[r][0])):
+            t, h = pairs[r]
+            times = sorted(pending[pairs[r]])
+            position[r] = p
+            self.minute_col.extend(times)
+            self.title_col.extend(array(typecode, [t]) * len(times))
+            self.theater_col.extend(array(typecode, [h]) * len(times))
+            self.pair_start.append(len(self.minute_col))
+            self.pair_theater.append(h)
+            title_counts[t] += 1
+            theater_counts[h] += 1
+        self.title_start = array('I', [0])
+        for n in title_counts:
+            self.title_start.append(self.title_start[-1] + n)
+        self.theater_start = array('I', [0])
+        for n in theater_counts:
+            self.theater_start.append(self.theater_start[-1] + n)
+        self.pair_order = array('I', position)
+        self.theater_pairs = array('I', [position[r] for r in sorted(range(len(pairs)), key=lambda r: pairs[r][1])])
+        return self
+
+    @classmethod
+    def build(cls, movies):
+        index = cls()
+        for m in movies:
+            title = m['title']
+            for s in m['showtimes']:
+                theatre = s['theatre']
+                index.add(title, theatre.get('id') or theatre['name'], to_minutes(s['dateTime']), theatre['name'])
+        return index.finish()
+
+    def __len__(self):
+        return len(self.minute_col)
+
+    def __iter__(self):
+        return (Showing(self, row) for row in range(len(self.minute_col)))
+
+    def pairs_for_title(self, t):
+        return range(self.title_start[t], self.title_start[t + 1])
+
+    def pairs_at_theater(self, h):
+        return self.theater_pairs[self.theater_start[h]:self.theater_start[h + 1]]
+
+    def pair(self, title, theater):
+        ###
+        ### Returns the pair index for (title, theater), or None if the title
+        ### never plays there.
+        ###
+        t = self.title_ids.get(title)
+        h = self.theater_ids.get(theater)
+        if t is None or h is None:
+            return None
+        pair_theater = self.pair_theater
+        for p in range(self.title_start[t], self.title_start[t + 1]):
+            if pair_theater[p] == h:
+                return p
+        return None
+
+    def pair_title(self, p):
+        return self.title_col[self.pair_start[p]]
+
+    def pair_times(self, p):
+        return self.minute_col[self.pair_start[p]:self.pair_start[p + 1]]
+
+    def count(self, p, start, end):
+        ###
+        ### Number of pair p's showtimes in [start, end).
+        ###
+        lo, hi = self.pair_start[p], self.pair_start[p + 1]
+        return bisect_left(self.minute_col, end, lo, hi) - bisect_left(self.minute_col, start, lo, hi)
+
+    def columns(self):
+        return (self.title_col, self.theater_col, self.minute_col, self.pair_start, self.pair_theater,
+                self.title_start, self.pair_order, self.theater_pairs, self.theater_start)
+
+    def nbytes(self):
+        ###
+        ### Approximate memory held by the index: its columns, string tables and
+        ### lookup dicts (but not its matchers, which are built on demand).
+        ###
+        columns = self.columns()
+        tables = (self.titles, self.theaters, self.theater_names, self.title_ids, self.theater_ids)
+        strings = set(self.titles)
+        strings.update(self.theaters)
+        strings.update(self.theater_names.values())
+        return sum(sys.getsizeof(c) for c in columns) + sum(sys.getsizeof(t) for t in tables) + sum(sys.getsizeof(s) for s in strings)
+
+    def to_dict(self):
+        return {
+            'fetched': self.fetched,
+            'titles': self.titles,
+            'theaters': self.theaters,
+            'theater_names': [self.theater_names[t] for t in self.theaters],
+            'times': [[self.pair_title(p), self.pair_theater[p], self.pair_times(p).tolist()] for p in self.pair_order]
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        index = cls()
+        index.fetched = data.get('fetched', 0)
+        titles = data['titles']
+        theaters = data['theaters']
+        # register every name first so the original ordering is preserved
+        index.titles = [sys.intern(t) for t in titles]
+        index.theaters = [sys.intern(t) for t in theaters]
+        index.title_ids = {t: i for i, t in enumerate(index.titles)}
+        index.theater_ids = {t: i for i, t in enumerate(index.theaters)}
+        # indexes cached before theaters were keyed by ID use the name as the ID
+        index.theater_names = dict(zip(index.theaters, (sys.intern(t) for t in data.get('theater_names', theaters))))
+        for title_id, theater_id, times in data['times']:
+            index._pending[(title_id, theater_id)] = array('i', times)
+        return index.finish()
+
+    def save_snapshot(self, path):
+        ###
+        ### Write the index as a binary snapshot (see snapshot.py), returning the
+        ### number of bytes written.
+        ###
+        sections = snapshot.string_table(self.titles) + snapshot.string_table(self.theaters)
+        sections += snapshot.string_table([self.theater_names[t] for t in self.theaters])
+        return snapshot.save(path, SNAPSHOT_KIND, SNAPSHOT_VERSION, {'fetched': self.fetched}, sections + self.columns())
+
+    @classmethod
+    def load_snapshot(cls, path):
+        ###
+        ### Map a snapshot written by save_snapshot. Only the string tables are
+        ### decoded; the columns are read in place from the mapping.
+        ###
+        snap = snapshot.Snapshot(path, SNAPSHOT_KIND, SNAPSHOT_VERSION)
+        index = cls()
+        index.fetched = snap.meta['fetched']
+        index.titles = [sys.intern(t) for t in snap.strings(1)]
+        index.theaters = [sys.intern(t) for t in snap.strings(3)]
+        index.title_ids = {t: i for i, t in enumerate(index.titles)}
+        index.theater_ids = {t: i for i, t in enumerate(index.theaters)}
+        index.theater_names = dict(zip(index.theaters, (sys.intern(t) for t in snap.strings(5))))
+        (index.title_col, index.theater_col, index.minute_col, index.pair_start, index.pair_theater,
+         index.title_start, index.pair_order, index.theater_pairs, index.theater_start) = [snap.section(i) for i in range(7, 16)]
+        return index
+
+    def window(self, start, end, theaters=None, scope=None, key=None):
+        return ShowingsView(self, start, end, theaters, scope, key)
+
+    def matcher(self, key, candidates, names=None):
+        ###
+        ### Returns the FuzzyMatcher over candidates(), built once per key (the
+        ### kind of candidate and the view's window and scope) and kept for as
+        ### long as the index stays cached. If names is given, the matcher compares
+        ### against names[candidate] and returns the matching candidate.
+        ###
+        m = self.matchers.get(key)
+        if m is None:
+            candidates = candidates()
+            if names is None:
+                m = FuzzyMatcher(candidates)
+            else:
+                m = FuzzyMatcher([names[c] for c in candidates], keys=candidates)
+            self.matchers[key] = m
+        return m
+
+
+class ShowingsView(object):
+    ###
+    ### Read-only view of a ShowingsIndex restricted to showtimes in [start, end)
+    ### and, if theaters is given, to that set of theaters. scope identifies the
+    ### theater restriction (e.g. the user's zip code) for caching matchers, and
+    ### key is the cache key the index was found under.
+    ###
+
+    def __init__(self, index, start, end, theaters=None, scope=None, key=None):
+        self.index = index
+        self.start = start
+        self.end = end
+        self.allowed = theaters
+        self.scope = scope
+        self.key = key
+
+    def _allows(self, h):
+        return self.allowed is None or self.index.theaters[h] in self.allowed
+
+    def _has_showing(self, p):
+        index = self.index
+        if not self._allows(index.pair_theater[p]):
+            return False
+        hi = index.pair_start[p + 1]
+        i = bisect_left(index.minute_col, self.start, index.pair_start[p], hi)
+        return i < hi and index.minute_col[i] < self.end
+
+    def titles(self):
+        index = self.index
+        return [title for t, title in enumerate(index.titles) if any(self._has_showing(p) for p in index.pairs_for_title(t))]
+
+    def theaters(self):
+        index = self.index
+        return [theater for h, theater in enumerate(index.theaters) if any(self._has_showing(p) for p in index.pairs_at_theater(h))]
+
+    def theaters_for(self, title):
+        index = self.index
+        t = index.title_ids.get(title)
+        if t is None:
+            return []
+        return [index.theaters[index.pair_theater[p]] for p in index.pairs_for_title(t) if self._has_showing(p)]
+
+    def titles_at(self, theater):
+        index = self.index
+        h = index.theater_ids.get(theater)
+        if h is None:
+            return []
+        return [index.titles[index.pair_title(p)] for p in index.pairs_at_theater(h) if self._has_showing(p)]
+
+    def has_title(self, title):
+        t = self.index.title_ids.get(title)
+        return t is not None and any(self._has_showing(p) for p in self.index.pairs_for_title(t))
+
+    def has_theater(self, theater):
+        h = self.index.theater_ids.get(theater)
+        return h is not None and any(self._has_showing(p) for p in self.index.pairs_at_theater(h))
+
+    def showtime_count(self, title, theater):
+        p = self.index.pair(title, theater)
+        if p is None or not self._allows(self.index.pair_theater[p]):
+            return 0
+        return self.index.count(p, self.start, self.end)
+
+    def title_count(self, title):
+        index = self.index
+        t = index.title_ids.get(title)
+        if t is None:
+            return 0
+        return sum(index.count(p, self.start, self.end) for p in index.pairs_for_title(t) if self._allows(index.pair_theater[p]))
+
+    def theater_name(self, theater):
+        return self.index.theater_names.get(theater, '')
+
+    def title_matcher(self):
+        return self.index.matcher(('titles', self.start, self.end, self.scope), self.titles)
+
+    def theater_matcher(self):
+        return self.index.matcher(('theaters', self.start, self.end, self.scope), self.theaters, self.index.theater_names)
+
+    def showtimes(self, title, theater, after=None):
+        index = self.index
+        p = index.pair(title, theater)
+        if p is None or not self._allows(index.pair_theater[p]):
+            return []
+        start = self.start if after is None else max(self.start, after + 1)
+        lo, hi = index.pair_start[p], index.pair_start[p + 1]
+        return index.minute_col[bisect_left(index.minute_col, start, lo, hi):bisect_left(index.minute_col, self.end, lo, hi)]
+
+
+def cache_key(zipcode, start_date, num_days, radius=None):
+    key = 'showings:%s:%s:%d' % (zipcode, start_date, num_days)
+    if radius is not None:
+        key += ':%g' % radius
+    return key
+
+
+class ShowingsStore(object):
+    ###
+    ### Directory of pre-built indexes, one binary snapshot per
+    ### (zipcode, startDate, numDays), written by the pre-warm job and mapped by
+    ### the intent handlers before falling back to a live fetch.
+    ###
+
+    def __init__(self, directory, max_age=STORE_MAX_AGE):
+        self.directory = directory
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, zipcode, start_date, num_days, radius=None):
+        name = 'showings-%s-%s-%d' % (zipcode, start_date, num_days)
+        if radius is not None:
+            name += '-%g' % radius
+        return os.path.join(self.directory, name + '.snap')
+
+    def read(self, zipcode, start_date, num_days, radius=None, stale=False):
+        ###
+        ### Returns the stored index, or None if there is none or (unless stale
+        ### is set) it is older than max_age.
+        ###
+        try:
+            index = ShowingsIndex.load_snapshot(self._path(zipcode, start_date, num_days, radius))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            logger.exception('unable to read stored showings zip={}'.format(zipcode))
+            return None
+        if not stale and index.fetched + self.max_age < time.time():
+            return None
+        return index
+
+    def write(self, zipcode, start_date, num_days, index, radius=None):
+        ###
+        ### Store index, returning the number of bytes written.
+        ###
+        if not index.fetched:
+            index.fetched = int(time.time())
+        return index.save_snapshot(self._path(zipcode, start_date, num_days, radius))
+
+
+class ShowingsRepository(object):
+    ###
+    ### Fetches showings keyed by (zipcode, startDate, numDays) and caches the
+    ### resulting ShowingsIndex. An entry fetched for more days than requested
+    ### also satisfies the shorter request. Lookups go to the cache, then to the
+    ### pre-warmed store (if any), then to the TMS API.
+    ###
+    ### When a zip code table is available, nearby zips share one fetch: each
+    ### request is served from its cluster's canonical zip, fetched with a radius
+    ### wide enough to cover the whole cluster, and the theaters are then
+    ### filtered down to those within RADIUS miles of the requested zip.
+    ###
+    ### If showings cannot be fetched (in time), expired ones still in the
+    ### cache's stale window, or stored ones however old, are served instead.
+    ###
+
+    def __init__(self, cache, store=None, fetch_days=FETCH_DAYS, locations=None):
+        self.cache = cache
+        self.store = store
+        self.fetch_days = fetch_days
+        self.locations = locations
+
+    def fetch_area(self, zipcode):
+        ###
+        ### Returns the (zipcode, radius) to fetch showings for in order to serve
+        ### zipcode; radius is None when clustering is disabled.
+        ###
+        table = geo.table()
+        if table is None or geo.CLUSTER_RADIUS <= 0 or table.locate(zipcode) is None:
+            return zipcode, None
+        return table.cluster(zipcode), RADIUS + geo.CLUSTER_RADIUS
+
+    def lookup(self, zipcode, start_date, num_days, radius=None):
+        ###
+        ### Returns the cache key and index of cached or stored showings covering
+        ### num_days, or (None, None).
+        ###
+        for days in range(max(num_days, self.fetch_days), num_days - 1, -1):
+            key = cache_key(zipcode, start_date, days, radius)
+            index = self.cache.get(key)
+            if index is not None:
+                return key, index
+        if self.store is not None:
+            for days in range(max(num_days, self.fetch_days), num_days - 1, -1):
+                index = self.store.read(zipcode, start_date, days, radius)
+                if index is not None:
+                    key = cache_key(zipcode, start_date, days, radius)
+                    self.cache.set(key, index)
+                    return key, index
+        return None, None
+
+    def stale(self, zipcode, start_date, num_days, radius=None):
+        ###
+        ### lookup() for when a fetch has failed: returns the cache key and index
+        ### of showings which have expired but are still in the cache, or are
+        ### stored but older than the store's max_age, or (None, None).
+        ###
+        for days in range(max(num_days, self.fetch_days), num_days - 1, -1):
+            key = cache_key(zipcode, start_date, days, radius)
+            index = self.cache.first.get_stale(key)
+            if index is None and self.store is not None:
+                index = self.store.read(zipcode, start_date, days, radius, stale=True)
+            if index is not None:
+                return key, index
+        return None, None
+
+    def fetch(self, zipcode, start_date, num_days, radius=None):
+        ###
+        ### Returns the successful showings Response, or None. With STREAMING the
+        ### body has not been read yet.
+        ###
+        params = {'startDate': start_date, 'zip': zipcode, 'numDays': num_days, 'api_key': os.environ['TMS_API_KEY']}
+        if radius is not None:
+            params['radius'] = radius
+        try:
+            r = upstream.get(SHOWINGS_URL, params=params, stream=STREAMING, quota=quota.governor('tms', params['api_key']))
+        except requests.RequestException as e:
+            logger.debug('showings fetch failed zip={}, error={}'.format(zipcode, e))
+            return None
+        if r.status_code == 200:
+            return r
+        logger.debug('showings fetch failed zip={}, status={}'.format(zipcode, r.status_code))
+        r.close()
+        return None
+
+    def parse(self, r, counter):
+        ###
+        ### Build a ShowingsIndex from a showings Response body.
+        ###
+        if STREAMING:
+            try:
+                return ShowingsIndex.build(iter_movies(r.iter_content(CHUNK_SIZE), counter))
+            finally:
+                r.close()
+        counter['bytes'] = len(r.content)
+        return ShowingsIndex.build(r.json() if r.content else [])
+
+    def refresh(self, zipcode, start_date, num_days=None, radius=None):
+        ###
+        ### Fetch and index showings for zipcode, then write them to the cache and
+        ### the store. Returns the index (None if the fetch failed) and a report of
+        ### where the time went.
+        ###
+        days = max(num_days or 0, self.fetch_days)
+        report = {'zipcode': zipcode, 'start_date': start_date, 'num_days': days, 'radius': radius, 'key': cache_key(zipcode, start_date, days, radius)}
+        t = time.perf_counter()
+        with tracing.span('tms.showings'):
+            r = self.fetch(zipcode, start_date, days, radius)
+        report['fetch_ms'] = round((time.perf_counter() - t) * 1000, 1)
+        if r is None:
+            return None, report
+        # when streaming, reading the body is part of the build
+        t = time.perf_counter()
+        counter = {}
+        try:
+            with tracing.span('showings.parse'):
+                index = self.parse(r, counter)
+        except (requests.RequestException, ValueError) as e:
+            logger.debug('showings parse failed zip={}, error={}'.format(zipcode, e))
+            return None, report
+        index.fetched = int(time.time())
+        report['build_ms'] = round((time.perf_counter() - t) * 1000, 1)
+        report['payload_bytes'] = counter.get('bytes', 0)
+        tracing.incr('tms.payload_bytes', report['payload_bytes'], 'Bytes')
+        report['titles'] = len(index.titles)
+        report['theaters'] = len(index.theaters)
+        report['showings'] = len(index)
+        self.cache.set(report['key'], index)
+        if self.store is not None:
+            report['stored_bytes'] = self.store.write(zipcode, start_date, days, index, radius)
+        return index, report
+
+    def theater_locations(self, zipcode, radius):
+        ###
+        ### Returns {theatre ID: [lat, lon]} for the theaters within radius miles
+        ### of zipcode, or None if they could not be fetched.
+        ###
+        key = 'theatre-ids:%s:%g' % (zipcode, radius)
+        locations = self.locations.get(key)
+        if locations is not None:
+            return locations
+        try:
+            with tracing.span('tms.theatres'):
+                api_key = os.environ['TMS_API_KEY']
+                r = upstream.get(THEATRES_URL, params={'zip': zipcode, 'radius': radius, 'numTheatres': 200, 'api_key': api_key}, quota=quota.governor('tms', api_key))
+        except requests.RequestException as e:
+            logger.debug('theatres fetch failed zip={}, error={}'.format(zipcode, e))
+            return None
+        if r.status_code != 200 or not r.text:
+            logger.debug('theatres fetch failed zip={}, status={}'.format(zipcode, r.status_code))
+            return None
+        locations = {}
+        for t in r.json():
+            geo_code = t.get('location', {}).get('geoCode')
+            if geo_code:
+                locations[t.get('theatreId') or t['name']] = [float(geo_code['latitude']), float(geo_code['longitude'])]
+        self.locations.set(key, locations)
+        return locations
+
+    def theaters_near(self, zipcode, center, radius):
+        ###
+        ### Returns the set of theatre IDs within RADIUS miles of zipcode, out of
+        ### those fetched for center, or None if that cannot be determined.
+        ###
+        origin = geo.table().locate(zipcode)
+        locations = self.theater_locations(center, radius)
+        if origin is None or locations is None:
+            return None
+        return {name for name, location in locations.items() if geo.distance(origin, location) <= RADIUS}
+
+    def _load(self, zipcode, start_date, num_days, radius):
+        index, report = self.refresh(zipcode, start_date, num_days, radius)
+        if index is not None:
+            logger.debug('showings fetched {}'.format(report))
+        return index
+
+    def index(self, center, start_date, num_days, radius):
+        ###
+        ### Returns the cache key and index of showings for center (see
+        ### fetch_area), fetching them if need be, or (None, None).
+        ###
+        key, index = self.lookup(center, start_date, num_days, radius)
+        if index is None:
+            # concurrent requests for the same showings share a single fetch
+            key = cache_key(center, start_date, max(num_days, self.fetch_days), radius)
+            index = self.cache.load(key, lambda: self._load(center, start_date, num_days, radius))
+            if index is None:
+                key, index = self.stale(center, start_date, num_days, radius)
+                deadline.degrade('showings.missing' if index is None else 'showings.stale')
+        return key, index
+
+    def view(self, zipcode, start_date, num_days, key, index, theaters):
+        start = to_minutes(start_date)
+        if index is None:
+            return ShowingsIndex().window(start, start)
+        return index.window(start, start + num_days * MINUTES_PER_DAY, theaters, zipcode if theaters is not None else None, key)
+
+    def get(self, zipcode, start_date, num_days=1):
+        ###
+        ### Returns a ShowingsView of the movies playing in zipcode over the
+        ### num_days starting at start_date ('YYYY-MM-DD'). The view is empty if
+        ### the showings could not be retrieved.
+        ###
+        center, radius = self.fetch_area(zipcode)
+        key, index = self.index(center, start_date, num_days, radius)
+        theaters = None
+        if index is not None and radius is not None:
+            theaters = self.theaters_near(zipcode, center, radius)
+        return self.view(zipcode, start_date, num_days, key, index, theaters)
+
+    async def get_async(self, zipcode, start_date, num_days=1):
+        ###
+        ### get() for the async handler path: the showings and, for a clustered
+        ### zip, the theater locations are fetched concurrently.
+        ###
+        center, radius = self.fetch_area(zipcode)
+        if radius is None:
+            key, index = await upstream.run_async(self.index, center, start_date, num_days, radius)
+            theaters = None
+        else:
+            (key, index), theaters = await asyncio.gather(
+                upstream.run_async(self.index, center, start_date, num_days, radius),
+                upstream.run_async(self.theaters_near, zipcode, center, radius)
+            )
+        return self.view(zipcode, start_date, num_days, key, index, theaters)
+
+
+repository = ShowingsRepository(
+    build_cache(CACHE_SIZE, CACHE_TTL, ShowingsIndex.to_dict, ShowingsIndex.from_dict, name='showings', stale_ttl=STALE_TTL, max_bytes=CACHE_BYTES, sizeof=ShowingsIndex.nbytes),
+    ShowingsStore(STORE_DIR) if STORE_DIR else None,
+    locations=build_cache(CACHE_SIZE * 4, LOCATIONS_TTL, name='theater_locations')
+)
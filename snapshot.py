@@ -0,0 +1,137 @@
+###
+### Versioned binary snapshot files, memory-mapped and read in place.
+###
+### A snapshot is a header, a table of sections and the sections themselves:
+### fixed-width arrays (little-endian, 8-byte aligned) and string tables (an
+### array of end offsets into a UTF-8 blob, taking two sections). Loading maps
+### the file and casts each section to a memoryview over the mapping, so nothing
+### is copied or decoded until it is read. The first section is a small JSON
+### document of metadata.
+###
+### Used for stored showings indexes (showings.ShowingsStore) and the bundled
+### TMDb snapshot (tmdb.save_snapshot).
+###
+
+import os
+import sys
+import json
+import mmap
+import struct
+from array import array
+
+MAGIC = b'MBSNAP\0\0'
+# magic, kind, version, number of sections
+HEADER = struct.Struct('<8s4sII')
+# typecode ('B' for bytes), offset, length in bytes
+SECTION = struct.Struct('<2s6xQQ')
+ALIGN = 8
+
+
+def string_table(values):
+    ###
+    ### Returns the (end offsets, UTF-8 blob) sections for a list of strings.
+    ###
+    ends = array('I')
+    blob = bytearray()
+    for value in values:
+        blob += value.encode('utf-8')
+        ends.append(len(blob))
+    return ends, bytes(blob)
+
+
+class StringTable(object):
+    ###
+    ### Read-only sequence over a string table, decoding each string on access.
+    ###
+
+    def __init__(self, ends, blob):
+        self.ends = ends
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.ends)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.ends)
+        end = self.ends[i]
+        return str(self.blob[self.ends[i - 1] if i else 0:end], 'utf-8')
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self.ends)))
+
+
+def save(path, kind, version, meta, sections):
+    ###
+    ### Write a snapshot of kind (4 bytes, e.g. b'SHOW') to path, atomically.
+    ### sections are arrays or bytes. Returns the number of bytes written.
+    ###
+    sections = [json.dumps(meta, separators=(',', ':')).encode('utf-8')] + list(sections)
+    offset = HEADER.size + SECTION.size * len(sections)
+    table = []
+    for section in sections:
+        offset += -offset % ALIGN
+        if isinstance(section, array):
+            table.append((section.typecode.encode('ascii'), offset, section.itemsize * len(section)))
+        else:
+            table.append((b'B', offset, len(section)))
+        offset += table[-1][2]
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, kind, version, len(sections)))
+        for entry in table:
+            f.write(SECTION.pack(*entry))
+        for section, (typecode, offset, length) in zip(sections, table):
+            f.write(b'\0' * (offset - f.tell()))
+            if isinstance(section, array) and sys.byteorder != 'little':
+                section = array(section.typecode, section)
+                section.byteswap()
+            f.write(section if not isinstance(section, array) else section.tobytes())
+    os.replace(tmp_path, path)
+    return offset
+
+
+class Snapshot(object):
+    ###
+    ### A snapshot file mapped into memory. Raises OSError if it cannot be read
+    ### and ValueError if it is not a snapshot of the expected kind and version.
+    ###
+
+    def __init__(self, path, kind, version):
+        with open(path, 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.buffer)
+        if len(view) < HEADER.size:
+            raise ValueError('%s is not a snapshot' % path)
+        magic, file_kind, file_version, count = HEADER.unpack_from(view)
+        if magic != MAGIC or file_kind != kind:
+            raise ValueError('%s is not a %s snapshot' % (path, kind.decode('ascii')))
+        if file_version != version:
+            raise ValueError('%s has version %d, not %d' % (path, file_version, version))
+        self.sections = []
+        for i in range(count):
+            typecode, offset, length = SECTION.unpack_from(view, HEADER.size + i * SECTION.size)
+            if offset + length > len(view):
+                raise ValueError('%s is truncated' % path)
+            self.sections.append((typecode.decode('ascii'), view[offset:offset + length]))
+        self.meta = json.loads(str(self.sections[0][1], 'utf-8'))
+
+    def section(self, i):
+        ###
+        ### Returns section i (counting from 1; 0 is the metadata) as a
+        ### memoryview of its typecode over the mapping.
+        ###
+        typecode, view = self.sections[i]
+        if typecode == 'B':
+            return view
+        if sys.byteorder != 'little':
+            column = array(typecode, view.tobytes())
+            column.byteswap()
+            return column
+        return view.cast(typecode)
+
+    def strings(self, i):
+        ###
+        ### Returns the string table in sections i and i + 1.
+        ###
+        return StringTable(self.section(i), self.section(i + 1))
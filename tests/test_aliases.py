@@ -0,0 +1,90 @@
+###
+### Learned aliases as used by moviebot.resolve().
+###
+### usage: python -m pytest tests
+###
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cache
+import aliases
+import moviebot
+from matcher import FuzzyMatcher
+
+
+def resolve(name, titles):
+    matcher = FuzzyMatcher(titles)
+    return moviebot.resolve(name, {}, set(titles).__contains__, lambda: matcher, 'title')
+
+
+class ResolveAliasTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = aliases.cache
+        aliases.cache = cache.TieredCache(cache.MemoryCache(aliases.TABLES, aliases.TTL))
+
+    def tearDown(self):
+        aliases.cache = self.cache
+
+    def test_alias_does_not_override_exact_title(self):
+        # learned in a zip code showing only "Star River"
+        self.assertEqual(resolve('star', ['Star River']), 'Star River')
+        # in one showing both, "star" names a title exactly
+        self.assertEqual(resolve('star', ['Star River', 'Star']), 'Star')
+
+    def test_alias_applies_only_to_the_same_candidates(self):
+        self.assertEqual(resolve('star rivrs', ['Star River']), 'Star River')
+        self.assertEqual(resolve('star rivrs', ['Star River', 'Star Rivers']), 'Star Rivers')
+
+    def test_alias_skips_the_matcher(self):
+        titles = ['Star River', 'Moon Lake']
+        matcher = FuzzyMatcher(titles)
+        for attempt in range(2):
+            self.assertEqual(moviebot.resolve('star rivr', {}, set(titles).__contains__, lambda: matcher, 'title'), 'Star River')
+        self.assertEqual(matcher.stats['queries'], 1)
+
+
+class PersistedAliasTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = aliases.cache
+        self.directory = tempfile.mkdtemp()
+        self.second = cache.FileCache(self.directory, aliases.TTL)
+
+    def tearDown(self):
+        aliases.cache = self.cache
+        shutil.rmtree(self.directory)
+
+    def cold_start(self):
+        aliases.cache = cache.TieredCache(cache.MemoryCache(aliases.TABLES, aliases.TTL), self.second)
+
+    def test_alias_survives_a_cold_start(self):
+        self.cold_start()
+        aliases.learn('title', 'scope', 'star rivr', 'Star River')
+        self.cold_start()
+        self.assertEqual(aliases.lookup('title', 'scope', 'Star Rivr', lambda title: True), 'Star River')
+        self.assertIsNone(aliases.lookup('title', 'other', 'star rivr', lambda title: True))
+
+    def test_table_size_is_capped(self):
+        self.cold_start()
+        size, aliases.CACHE_SIZE = aliases.CACHE_SIZE, 8
+        try:
+            for i in range(9):
+                aliases.learn('title', 'scope', 'name %d' % i, 'Title %d' % i)
+        finally:
+            aliases.CACHE_SIZE = size
+        table = self.second.get(aliases.key('title', 'scope'))
+        self.assertEqual(len(table), 8)
+        # the least recently learned alias went first
+        self.assertNotIn('name 0', table)
+        self.assertIn('name 8', table)
+
+
+if __name__ == '__main__':
+    unittest.main()
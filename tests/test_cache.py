@@ -0,0 +1,53 @@
+###
+### TieredCache loads coordinated through a lease in the second tier.
+###
+### usage: python -m pytest tests
+###
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cache
+
+
+class RecordingFileCache(cache.FileCache):
+    def lease(self, key, ttl):
+        self.lease_ttl = ttl
+        return cache.FileCache.lease(self, key, ttl)
+
+
+class TieredCacheLoadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.second = RecordingFileCache(self.directory)
+        self.cache = cache.TieredCache(cache.MemoryCache(), self.second, name='test')
+        self.loads = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load(self):
+        self.loads += 1
+        self.cache.set('key', 'fetched')
+        return 'fetched'
+
+    def test_value_stored_before_lease_is_not_fetched_again(self):
+        # another container stored the value and released its lease just before this one took it
+        self.second.set('key', 'stored')
+        self.assertEqual(self.cache.load('key', self.load, wait=0.1), 'stored')
+        self.assertEqual(self.loads, 0)
+
+    def test_lease_covers_a_fetch(self):
+        self.assertEqual(self.cache.load('key', self.load, wait=0.1), 'fetched')
+        self.assertEqual(self.loads, 1)
+        self.assertEqual(self.second.lease_ttl, cache.LEASE_TTL)
+
+
+if __name__ == '__main__':
+    unittest.main()
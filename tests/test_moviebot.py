@@ -0,0 +1,122 @@
+###
+### Intent handlers dispatched from Lex events.
+###
+### usage: python -m pytest tests
+###
+
+import os
+import sys
+import json
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import deadline
+import moviebot
+import showings
+
+TITLES = ['Movie %02d' % i for i in range(80)]
+# the first 30 titles only play tomorrow
+TOMORROW_ONLY = 30
+
+
+def event(intent, session_attributes, slots=None, source='FulfillmentCodeHook'):
+    return {
+        'userId': 'test',
+        'invocationSource': source,
+        'bot': {'name': 'MovieBot'},
+        'currentIntent': {'name': intent, 'slots': slots or {}},
+        'sessionAttributes': session_attributes
+    }
+
+
+def offered(response):
+    cards = response['dialogAction']['responseCard']['genericAttachments']
+    return [button['text'] for card in cards for button in card['buttons'] if button is not moviebot.MORE_OPTION]
+
+
+def is_no_more_results(response):
+    action = response['dialogAction']
+    return action['type'] == 'Close' and 'more results' in action['message']['content']
+
+
+class MoreResultsTest(unittest.TestCase):
+
+    def test_session_without_zipcode(self):
+        self.assertTrue(is_no_more_results(moviebot.dispatch(event('MoreResults', {}))))
+
+    def test_session_without_cursor(self):
+        self.assertTrue(is_no_more_results(moviebot.dispatch(event('MoreResults', {'zipcode': '98101'}))))
+
+    def test_cursor_without_zipcode(self):
+        cursor = json.dumps({'i': 'GetMovies', 'q': '98101', 'o': 24})
+        self.assertTrue(is_no_more_results(moviebot.dispatch(event('MoreResults', {moviebot.PAGE_ATTRIBUTE: cursor}))))
+
+    def test_malformed_cursor(self):
+        for cursor in ('{', '[]', '{"i": "GetMovies", "q": "98101"}', '{"i": "GetMovies", "q": "98101", "o": "x"}',
+                       '{"i": "Unknown", "q": "98101", "o": 24}', '{"i": "GetMovies", "q": "98101", "o": 0}'):
+            response = moviebot.dispatch(event('MoreResults', {'zipcode': '98101', moviebot.PAGE_ATTRIBUTE: cursor}))
+            self.assertTrue(is_no_more_results(response), cursor)
+            self.assertNotIn(moviebot.PAGE_ATTRIBUTE, response['sessionAttributes'])
+
+
+class LowContext(object):
+    # leaves less than deadline.LOW seconds once the reserve is taken
+    def get_remaining_time_in_millis(self):
+        return (deadline.RESERVE + deadline.LOW / 2) * 1000
+
+
+class OneTheaterRepository(object):
+    ###
+    ### Showings of TITLES at one theater: each title playing today does so
+    ### (i % 7) + 1 times, so ranking reorders them.
+    ###
+
+    def __init__(self, today):
+        start = showings.to_minutes(today)
+        times = []
+        for i, title in enumerate(TITLES):
+            day = start + showings.MINUTES_PER_DAY if i < TOMORROW_ONLY else start
+            times.append([i, 0, [day + 23 * 60 + 50 - j for j in range((i % 7) + 1)][::-1]])
+        self.index = showings.ShowingsIndex.from_dict({'titles': TITLES, 'theaters': ['1001'], 'theater_names': ['Cinema One'], 'times': times})
+
+    def get(self, zipcode, start_date, num_days=1):
+        return showings.ShowingsRepository.view(self, zipcode, start_date, num_days, 'test', self.index, None)
+
+
+class PagingTest(unittest.TestCase):
+
+    def setUp(self):
+        import arrow
+        self.repository = showings.repository
+        self.fake = OneTheaterRepository(arrow.utcnow().to('-07:00').format('YYYY-MM-DD'))
+        showings.repository = self.fake
+
+    def tearDown(self):
+        showings.repository = self.repository
+
+    def pages(self, response):
+        pages = [offered(response)]
+        while moviebot.PAGE_ATTRIBUTE in response['sessionAttributes']:
+            response = moviebot.dispatch(event('MoreResults', response['sessionAttributes']))
+            pages.append(offered(response))
+        return pages
+
+    def test_pages_of_a_degraded_listing_come_from_the_same_list(self):
+        slots = {'movie_title': 'Movie 50', 'theater_name': 'Cinema One'}
+        with deadline.invocation(LowContext()):
+            response = moviebot.dispatch(event('FindShowtimes', {'zipcode': '98101'}, slots))
+        pages = self.pages(response)
+        # the three-day window in index order, as page one was
+        self.assertEqual(sum(pages, []), TITLES)
+
+    def test_pages_of_a_ranked_listing_cover_it_once(self):
+        response = moviebot.dispatch(event('GetTheaterMovies', {'zipcode': '98101'}, {'theater_name': 'Cinema One'}))
+        pages = self.pages(response)
+        today = TITLES[TOMORROW_ONLY:]
+        counts = dict((title, (i % 7) + 1) for i, title in enumerate(TITLES))
+        self.assertEqual(sum(pages, []), sorted(today, key=lambda title: -counts[title]))
+
+
+if __name__ == '__main__':
+    unittest.main()
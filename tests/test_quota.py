@@ -0,0 +1,60 @@
+###
+### Quota Governor behaviour with a counter shared between containers.
+###
+### usage: python -m pytest tests
+###
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import quota
+
+
+class BusyCounter(quota.MemoryCounter):
+    ###
+    ### A shared counter whose per-second count other containers have used up.
+    ###
+
+    shared = True
+
+    def incr(self, key, ttl):
+        count = quota.MemoryCounter.incr(self, key, ttl)
+        # per-second keys end in a Unix time, daily ones in YYYYMMDD
+        if len(key.rsplit(':', 1)[1]) > 8:
+            return count + 1000
+        return count
+
+
+class GovernorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.max_wait = quota.MAX_WAIT
+        quota.MAX_WAIT = 0
+
+    def tearDown(self):
+        quota.MAX_WAIT = self.max_wait
+
+    def test_throttled_call_gives_back_its_tokens(self):
+        counter = BusyCounter()
+        governor = quota.Governor('tms', 'key', rate=2, burst=4, counter=counter)
+        for _ in range(3):
+            with self.assertRaises(quota.QuotaExceededError):
+                governor.acquire()
+        self.assertEqual(round(governor.bucket.available()), 4)
+        # nothing was added to the per-second counts of the other containers
+        self.assertFalse(any(counter._counts.values()))
+
+    def test_call_within_shared_rate(self):
+        counter = quota.MemoryCounter()
+        counter.shared = True
+        governor = quota.Governor('tms', 'key', rate=2, burst=4, counter=counter)
+        governor.acquire()
+        self.assertEqual(governor.stats['calls'], 1)
+        self.assertEqual(sum(counter._counts.values()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
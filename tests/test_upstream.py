@@ -0,0 +1,132 @@
+###
+### Circuit breaker and retry behaviour of upstream.get().
+###
+### usage: python -m pytest tests
+###
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import quota
+import deadline
+import upstream
+
+# nothing listens on the discard port, so a request that gets through fails fast
+URL = 'http://127.0.0.1:9/'
+
+
+class RejectingQuota(object):
+    def acquire(self):
+        raise quota.QuotaExceededError('no tokens')
+
+
+class SpentContext(object):
+    def get_remaining_time_in_millis(self):
+        return 0
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        upstream.breakers.clear()
+        upstream.stats.clear()
+
+    def open_circuit(self):
+        breaker, host_stats = upstream._host_state('127.0.0.1:9')
+        breaker.failures = breaker.threshold
+        # opened long enough ago that the next request is the trial
+        breaker.opened_at = time.time() - breaker.cooldown - 1
+        return breaker
+
+    def test_trial_without_quota_is_released(self):
+        breaker = self.open_circuit()
+        with self.assertRaises(quota.QuotaExceededError):
+            upstream.get(URL, quota=RejectingQuota())
+        self.assertEqual(breaker.state, 'open')
+        # the next request is let through as the trial, rather than being short-circuited
+        with self.assertRaises(quota.QuotaExceededError):
+            upstream.get(URL, quota=RejectingQuota())
+
+    def test_trial_past_deadline_is_released(self):
+        breaker = self.open_circuit()
+        with deadline.invocation(SpentContext()):
+            with self.assertRaises(upstream.DeadlineExceeded):
+                upstream.get(URL, retries=0)
+        self.assertEqual(breaker.state, 'open')
+        with self.assertRaises(upstream.requests.ConnectionError):
+            upstream.get(URL, retries=0)
+
+    def test_failed_trial_reopens_circuit(self):
+        breaker = self.open_circuit()
+        with self.assertRaises(upstream.requests.ConnectionError):
+            upstream.get(URL, retries=0)
+        self.assertEqual(breaker.state, 'open')
+        with self.assertRaises(upstream.CircuitOpenError):
+            upstream.get(URL, retries=0)
+
+    def test_release_only_clears_own_trial(self):
+        breaker = self.open_circuit()
+        self.assertTrue(breaker.allow())
+        breaker.trial = -1
+        breaker.release_trial()
+        self.assertEqual(breaker.state, 'half-open')
+        self.assertFalse(breaker.allow())
+
+
+class RetriedResponse(object):
+    status_code = 503
+
+    def __init__(self, retry_after):
+        self.headers = {'Retry-After': retry_after}
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class RetryingSession(object):
+    ###
+    ### A session whose host is always unavailable and asks for retries after
+    ### retry_after seconds.
+    ###
+
+    def __init__(self, retry_after='0'):
+        self.retry_after = retry_after
+        self.responses = []
+
+    def get(self, url, **kwargs):
+        self.responses.append(RetriedResponse(self.retry_after))
+        return self.responses[-1]
+
+
+class RetryTest(unittest.TestCase):
+
+    def setUp(self):
+        upstream.breakers.clear()
+        self.session = upstream.session
+        upstream.session = RetryingSession()
+
+    def tearDown(self):
+        upstream.session = self.session
+
+    def test_retried_responses_are_closed(self):
+        r = upstream.get(URL, retries=2, stream=True)
+        responses = upstream.session.responses
+        self.assertEqual(len(responses), 3)
+        self.assertIs(r, responses[-1])
+        self.assertTrue(all(response.closed for response in responses[:-1]))
+
+    def test_response_cut_by_deadline_is_closed(self):
+        upstream.session.retry_after = str(int(upstream.MAX_BACKOFF))
+        r = upstream.get(URL, retries=2, stream=True, until=time.monotonic() + upstream.MAX_BACKOFF / 2)
+        self.assertEqual(len(upstream.session.responses), 1)
+        self.assertEqual(r.status_code, 503)
+        self.assertTrue(r.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,309 @@
+###
+### TMDb client used by the GetMovieDetail intent.
+###
+### Once a title has been resolved to a TMDb ID, the release dates, details and
+### credits for that ID are fetched with a single `append_to_response` request.
+### If that request fails (or the API ignores the appended sections) the three
+### endpoints are fetched concurrently instead, so latency is bounded by the
+### slowest call rather than their sum.
+###
+### Resolved titles and assembled detail records are cached in two levels: the
+### normalized title the user typed -> (TMDb ID, canonical title), including
+### "not found" results for a shorter time, and TMDb ID -> detail record. Behind
+### both caches sits an optional bundled snapshot (see save_snapshot), mapped at
+### cold start and searched in place.
+###
+
+import os
+import sys
+import json
+import time
+import logging
+import requests
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import quota
+import deadline
+import snapshot
+import tracing
+import upstream
+from cache import build_cache, LOAD_WAIT
+from matcher import FuzzyMatcher, normalize
+
+logger = logging.getLogger()
+
+TMDB_URL = os.environ.get('TMDB_API_URL', 'https://api.themoviedb.org/3')
+# per-request timeout, and deadline for a movie's whole lookup (title search and
+# detail requests, retries included), in seconds
+CALL_TIMEOUT = float(os.environ.get('TMDB_TIMEOUT', 3))
+DEADLINE = float(os.environ.get('TMDB_DEADLINE', 5))
+APPEND_TO_RESPONSE = os.environ.get('TMDB_APPEND_TO_RESPONSE', 'true').lower() == 'true'
+
+# movie details almost never change, so cache them (and title resolutions) for a long time
+TITLE_TTL = int(os.environ.get('TMDB_TITLE_TTL', 7 * 24 * 3600))
+NEGATIVE_TTL = int(os.environ.get('TMDB_NEGATIVE_TTL', 3600))
+DETAIL_TTL = int(os.environ.get('TMDB_DETAIL_TTL', 24 * 3600))
+CACHE_SIZE = int(os.environ.get('TMDB_CACHE_SIZE', 512))
+SNAPSHOT_PATH = os.environ.get('TMDB_SNAPSHOT', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tmdb_snapshot.bin'))
+SNAPSHOT_KIND = b'TMDB'
+SNAPSHOT_VERSION = 2
+
+executor = ThreadPoolExecutor(max_workers=3)
+titles = build_cache(CACHE_SIZE, TITLE_TTL, name='tmdb_titles')
+details = build_cache(CACHE_SIZE, DETAIL_TTL, name='tmdb_details')
+
+
+def span_name(path):
+    # '/search/movie' -> 'tmdb.search', '/movie/123' -> 'tmdb.movie', '/movie/123/credits' -> 'tmdb.credits'
+    parts = path.strip('/').split('/')
+    if parts[0] == 'search':
+        return 'tmdb.search'
+    return 'tmdb.' + ('movie' if parts[-1].isdigit() else parts[-1])
+
+
+def get(path, timings, until=None, **params):
+    ###
+    ### GET a TMDb endpoint, returning the decoded JSON or None. The elapsed time
+    ### (in ms) is recorded in timings under path. No request or retry is made
+    ### past until (a time.monotonic() value), and timeouts are cut to it.
+    ###
+    params['api_key'] = os.environ['TMDB_API_KEY']
+    start = time.perf_counter()
+    try:
+        with tracing.span(span_name(path)):
+            r = upstream.get(TMDB_URL + path, params=params, timeout=(upstream.CONNECT_TIMEOUT, CALL_TIMEOUT), quota=quota.governor('tmdb', params['api_key']), until=until)
+        if r.status_code == 200 and r.text:
+            tracing.incr('tmdb.payload_bytes', len(r.content), 'Bytes')
+            with tracing.span('tmdb.decode'):
+                return r.json()
+        logger.debug('tmdb request failed path={}, status={}'.format(path, r.status_code))
+    except requests.RequestException as e:
+        logger.debug('tmdb request failed path={}, error={}'.format(path, e))
+    finally:
+        timings[path] = round((time.perf_counter() - start) * 1000, 1)
+    return None
+
+
+def search(movie_title, timings, until=None):
+    ###
+    ### Returns the (id, title) of the closest TMDb match for movie_title, (0, '')
+    ### if there is none, or None if the search itself failed.
+    ###
+    result = get('/search/movie', timings, until, language='en-US', page='1', include_adult='false', primary_release_year='2018', query=movie_title.strip())
+    if result is None:
+        return None
+    results = result['results']
+    best, best_sim = FuzzyMatcher([m['title'] for m in results]).best(movie_title)
+    if best is not None:
+        return results[best]['id'], results[best]['title']
+    return 0, ''
+
+
+def resolve(movie_title, timings, until=None):
+    ###
+    ### Memoized search(): returns the (id, title) for movie_title, with id 0 if no
+    ### TMDb movie matches it.
+    ###
+    key = 'tmdb-title:' + normalize(movie_title)
+    resolved = titles.get(key)
+    if resolved is None and bundled is not None:
+        resolved = bundled.title(key)
+    if resolved is None:
+        # concurrent searches for the same title share a single request
+        resolved = titles.load(key, lambda: search_and_store(key, movie_title, timings, until), deadline.clamp(LOAD_WAIT, until))
+    if resolved is None:
+        return 0, ''
+    return resolved[0], resolved[1]
+
+
+def search_and_store(key, movie_title, timings, until=None):
+    resolved = search(movie_title, timings, until)
+    if resolved is None:
+        return None
+    movie_id, title = resolved
+    if movie_id:
+        titles.set(key, [movie_id, title])
+        titles.set('tmdb-title:' + normalize(title), [movie_id, title])
+    else:
+        titles.set(key, [0, ''], NEGATIVE_TTL)
+    return [movie_id, title]
+
+
+def fetch_detail(movie_id, timings, until=None):
+    ###
+    ### Returns a dict with the 'release_dates', 'details' and 'credits' responses
+    ### for movie_id; a section is None if it could not be fetched by until (or
+    ### the invocation's deadline if that comes first). Requests still running
+    ### then end by until too, so they do not hold up the executor.
+    ###
+    if until is None:
+        until = time.monotonic() + DEADLINE
+    if APPEND_TO_RESPONSE:
+        details = get('/movie/%s' % movie_id, timings, until, language='en-US', append_to_response='release_dates,credits')
+        if details and 'release_dates' in details and 'credits' in details:
+            return {
+                'release_dates': details.pop('release_dates'),
+                'credits': details.pop('credits'),
+                'details': details
+            }
+    futures = {
+        'release_dates': executor.submit(get, '/movie/%s/release_dates' % movie_id, timings, until),
+        'details': executor.submit(get, '/movie/%s' % movie_id, timings, until, language='en-US'),
+        'credits': executor.submit(get, '/movie/%s/credits' % movie_id, timings, until)
+    }
+    wait(futures.values(), timeout=deadline.remaining(until))
+    return {k: f.result() if f.done() else None for k, f in futures.items()}
+
+
+def movie_detail(movie_title):
+    ###
+    ### Resolve movie_title and return its (possibly cached) detail record, or
+    ### None if no TMDb movie matches it. A record missing sections that could
+    ### not be fetched (e.g. the credits) is returned as it is. The lookup as a
+    ### whole takes at most DEADLINE seconds.
+    ###
+    timings = {}
+    start = time.perf_counter()
+    until = time.monotonic() + DEADLINE
+    movie_id, title = resolve(movie_title, timings, until)
+    if not movie_id:
+        return None
+    detail = details.get('tmdb-detail:%s' % movie_id)
+    if detail is None and bundled is not None:
+        detail = bundled.detail(movie_id)
+    if detail is None:
+        sections = fetch_detail(movie_id, timings, until)
+        detail = assemble_detail(movie_id, title, sections)
+        if not all(sections.values()):
+            deadline.degrade('detail.partial')
+    timings['total'] = round((time.perf_counter() - start) * 1000, 1)
+    logger.debug('tmdb timings={}'.format(timings))
+    return detail
+
+
+async def movie_detail_async(movie_title):
+    ###
+    ### movie_detail() as a coroutine, for gathering with other calls.
+    ###
+    return await upstream.run_async(movie_detail, movie_title)
+
+
+def assemble_detail(movie_id, title, sections):
+    ###
+    ### Build the detail record from the fetched sections. Only complete records
+    ### are cached, so a section that timed out is retried next time.
+    ###
+    detail = {
+        'id': movie_id,
+        'title': title,
+        'rating': '',
+        'release_date': '',
+        'runtime': 0,
+        'stars': [],
+        'directors': []
+    }
+    if sections['release_dates']:
+        for r in sections['release_dates']['results']:
+            if r['iso_3166_1'] == 'US':
+                detail['rating'] = r['release_dates'][0]['certification']
+    if sections['details']:
+        detail['runtime'] = sections['details']['runtime'] or 0
+        detail['release_date'] = sections['details']['release_date']
+    if sections['credits']:
+        detail['stars'] = [c['name'] for c in sections['credits']['cast'][:3]]
+        detail['directors'] = [c['name'] for c in sections['credits']['crew'] if c['department'] == 'Directing' and c['job'] == 'Director']
+    if all(sections.values()):
+        details.set('tmdb-detail:%s' % movie_id, detail)
+    return detail
+
+
+### --- Warm-start snapshots --- ###
+
+
+class DetailSnapshot(object):
+    ###
+    ### A bundled snapshot, mapped and searched in place: title keys (sorted)
+    ### with their TMDb IDs and canonical titles, and TMDb IDs (sorted) with
+    ### their detail records as compact JSON. Only the keys compared by a lookup
+    ### and the record it finds are decoded.
+    ###
+
+    def __init__(self, path):
+        snap = snapshot.Snapshot(path, SNAPSHOT_KIND, SNAPSHOT_VERSION)
+        self.created = snap.meta['created']
+        self.keys = snap.strings(1)
+        self.title_ids = snap.section(3)
+        self.title_names = snap.strings(4)
+        self.detail_ids = snap.section(6)
+        self.records = snap.strings(7)
+
+    def title(self, key):
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return [self.title_ids[i], self.title_names[i]]
+        return None
+
+    def detail(self, movie_id):
+        i = bisect_left(self.detail_ids, movie_id)
+        if i < len(self.detail_ids) and self.detail_ids[i] == movie_id:
+            return json.loads(self.records[i])
+        return None
+
+
+bundled = None
+
+
+def save_snapshot(path=SNAPSHOT_PATH):
+    ###
+    ### Write the bundled snapshot's entries plus every cached title resolution
+    ### and detail record to path, e.g. to be bundled into the deployment
+    ### package. "Not found" titles are left out, so they are retried.
+    ###
+    resolved = {}
+    records = {}
+    if bundled is not None:
+        for i, key in enumerate(bundled.keys):
+            resolved[key] = [bundled.title_ids[i], bundled.title_names[i]]
+        for i, movie_id in enumerate(bundled.detail_ids):
+            records[movie_id] = bundled.records[i]
+    for key, value, expires_at in titles.first.items():
+        if value[0]:
+            resolved[key] = value
+    for key, value, expires_at in details.first.items():
+        records[value['id']] = json.dumps(value, separators=(',', ':'))
+    keys = sorted(resolved)
+    ids = sorted(records)
+    sections = snapshot.string_table(keys) + (array('I', [resolved[k][0] for k in keys]),) + snapshot.string_table([resolved[k][1] for k in keys])
+    sections += (array('I', ids),) + snapshot.string_table([records[i] for i in ids])
+    snapshot.save(path, SNAPSHOT_KIND, SNAPSHOT_VERSION, {'created': int(time.time())}, sections)
+    return len(keys), len(ids)
+
+
+def load_snapshot(path=SNAPSHOT_PATH):
+    ###
+    ### Map the snapshot written by save_snapshot, if one exists, behind the
+    ### in-process caches. Returns the number of titles and details in it.
+    ###
+    global bundled
+    try:
+        bundled = DetailSnapshot(path)
+    except FileNotFoundError:
+        return 0, 0
+    except (OSError, ValueError):
+        logger.exception('unable to load tmdb snapshot {}'.format(path))
+        return 0, 0
+    return len(bundled.keys), len(bundled.detail_ids)
+
+
+load_snapshot()
+
+
+if __name__ == '__main__':
+    # usage: python tmdb.py "movie title" ["movie title" ...]
+    # resolves each title and writes tmdb_snapshot.bin for bundling
+    logging.basicConfig(level=logging.INFO)
+    for movie_title in sys.argv[1:]:
+        movie_detail(movie_title)
+    logger.info('wrote %d titles and %d details to %s' % (save_snapshot() + (SNAPSHOT_PATH,)))
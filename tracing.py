@@ -0,0 +1,167 @@
+###
+### Per-invocation timing and counters, emitted as one CloudWatch Embedded Metric
+### Format (EMF) record per invocation.
+###
+### Code anywhere in the bot can time a phase with `with tracing.span('name'):`
+### (or the @traced('name') decorator) and count things with tracing.incr().
+### Everything is attributed to the invocation currently being handled, which
+### lambda_handler opens with tracing.invocation(). When tracing is disabled
+### (TRACING=false, the default) or no invocation is open, span() returns a
+### shared no-op and incr() returns immediately.
+###
+
+import os
+import sys
+import json
+import time
+import functools
+
+ENABLED = os.environ.get('TRACING', 'false').lower() == 'true'
+NAMESPACE = os.environ.get('TRACING_NAMESPACE', 'MovieBot')
+
+_current = None
+
+
+class Trace(object):
+    ###
+    ### Metrics accumulated over one invocation.
+    ###
+    __slots__ = ('start', 'metrics', 'units', 'properties')
+
+    def __init__(self, **properties):
+        self.start = time.perf_counter()
+        self.metrics = {}
+        self.units = {}
+        self.properties = properties
+
+    def add(self, name, value, unit):
+        self.metrics[name] = self.metrics.get(name, 0) + value
+        self.units[name] = unit
+
+    def set(self, name, value, unit):
+        self.metrics[name] = value
+        self.units[name] = unit
+
+    def record(self):
+        ###
+        ### Returns the EMF record for this trace, with the properties given to
+        ### invocation() as dimensions.
+        ###
+        metrics = dict((name, round(value, 3) if isinstance(value, float) else value) for name, value in self.metrics.items())
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': NAMESPACE,
+                    'Dimensions': [sorted(self.properties)],
+                    'Metrics': [{'Name': name, 'Unit': self.units[name]} for name in sorted(metrics)]
+                }]
+            }
+        }
+        record.update(self.properties)
+        record.update(metrics)
+        return record
+
+
+class Span(object):
+    __slots__ = ('trace', 'name', 'start')
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.add(self.name, (time.perf_counter() - self.start) * 1000, 'Milliseconds')
+        return False
+
+
+class NoopSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NOOP = NoopSpan()
+
+
+def span(name):
+    ###
+    ### Context manager adding the time spent in its block to metric `name`.
+    ###
+    trace = _current
+    if trace is None:
+        return NOOP
+    return Span(trace, name)
+
+
+def traced(name):
+    ###
+    ### Decorator timing every call to the decorated function as span `name`.
+    ###
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            trace = _current
+            if trace is None:
+                return fn(*args, **kwargs)
+            with Span(trace, name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def incr(name, value=1, unit='Count'):
+    trace = _current
+    if trace is not None:
+        trace.add(name, value, unit)
+
+
+def gauge(name, value, unit='Count'):
+    # record the latest value of name, rather than a total
+    trace = _current
+    if trace is not None:
+        trace.set(name, value, unit)
+
+
+class invocation(object):
+    ###
+    ### Opens the trace for one invocation and emits its record on exit:
+    ###
+    ###     with tracing.invocation(Intent='GetMovies'):
+    ###         ...
+    ###
+    __slots__ = ('properties', 'trace')
+
+    def __init__(self, **properties):
+        self.properties = properties
+        self.trace = None
+
+    def __enter__(self):
+        global _current
+        if ENABLED:
+            self.trace = _current = Trace(**self.properties)
+        return self.trace
+
+    def __exit__(self, *exc):
+        global _current
+        if self.trace is not None:
+            _current = None
+            self.trace.add('invocation', (time.perf_counter() - self.trace.start) * 1000, 'Milliseconds')
+            if exc[0] is not None:
+                self.trace.add('errors', 1, 'Count')
+            emit(self.trace.record())
+        return False
+
+
+def emit(record):
+    # EMF records must be written to the log as a bare JSON line
+    sys.stdout.write(json.dumps(record, separators=(',', ':')) + '\n')
+    sys.stdout.flush()
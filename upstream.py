@@ -0,0 +1,242 @@
+###
+### HTTP client shared by every outbound API call (Gracenote TMS and TMDb).
+###
+### The requests Session is created at module scope so pooled keep-alive
+### connections are reused across warm Lambda invocations. Every request gets a
+### connect/read timeout, 429 and 5xx responses (and connection errors) are
+### retried a bounded number of times with jittered exponential backoff, and a
+### per-host circuit breaker stops calling a host that keeps failing until a
+### cool-down has passed.
+###
+### Timeouts, retries and backoff are also cut to the invocation's time budget
+### (see deadline.py): a request that runs out of it raises DeadlineExceeded
+### without counting against the host's circuit breaker.
+###
+### run_async() lets the async handler path (see moviebot.dispatch_async) await
+### blocking data-layer calls, so independent upstream waits can overlap with
+### asyncio.gather. They run on a module-scope thread pool sized to the
+### session's connection pool, which stays warm across invocations.
+###
+
+import os
+import time
+import asyncio
+import functools
+import random
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+import deadline
+import tracing
+
+logger = logging.getLogger()
+
+CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 2))
+READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 5))
+MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 2))
+BACKOFF = float(os.environ.get('HTTP_BACKOFF', 0.2))
+MAX_BACKOFF = float(os.environ.get('HTTP_MAX_BACKOFF', 2))
+BREAKER_THRESHOLD = int(os.environ.get('HTTP_BREAKER_THRESHOLD', 5))
+BREAKER_COOLDOWN = float(os.environ.get('HTTP_BREAKER_COOLDOWN', 30))
+POOL_SIZE = 10
+
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+class CircuitOpenError(requests.RequestException):
+    ###
+    ### Raised instead of issuing a request to a host whose circuit is open.
+    ###
+    pass
+
+
+class DeadlineExceeded(requests.RequestException):
+    ###
+    ### Raised instead of issuing, retrying or waiting for a request once the
+    ### invocation's time budget (see deadline.py) is spent.
+    ###
+    pass
+
+
+class CircuitBreaker(object):
+    ###
+    ### Opens after `threshold` consecutive failures; once `cooldown` seconds have
+    ### passed a single trial request is let through, and its outcome closes or
+    ### re-opens the circuit. A trial that ends without an outcome (it got no
+    ### quota, or no time left) is released, so that another can be made.
+    ###
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.trial or time.time() < self.opened_at + self.cooldown:
+                return False
+            # the thread making the trial request
+            self.trial = threading.get_ident()
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def release_trial(self):
+        ###
+        ### Called once the calling thread's request is over. If it was the
+        ### trial and recorded no outcome, the next request may be the trial.
+        ###
+        with self._lock:
+            if self.trial == threading.get_ident():
+                self.trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.warning('circuit opened after {} failures'.format(self.failures))
+                self.opened_at = time.time()
+            self.trial = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if self.trial else 'open'
+
+
+def build_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE, max_retries=0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+session = build_session()
+executor = ThreadPoolExecutor(max_workers=POOL_SIZE)
+breakers = {}
+stats = {}
+_lock = threading.Lock()
+
+
+def _host_state(host):
+    with _lock:
+        if host not in breakers:
+            breakers[host] = CircuitBreaker()
+            stats[host] = {'requests': 0, 'retries': 0, 'failures': 0, 'rejected': 0}
+        return breakers[host], stats[host]
+
+
+def backoff(attempt, response=None):
+    ###
+    ### Seconds to wait before retry number attempt (0-based): full jitter over an
+    ### exponentially growing window, or the server's Retry-After if it is shorter
+    ### than MAX_BACKOFF.
+    ###
+    if response is not None and response.headers.get('Retry-After', '').isdigit():
+        return min(float(response.headers['Retry-After']), MAX_BACKOFF)
+    return random.uniform(0, min(MAX_BACKOFF, BACKOFF * (2 ** attempt)))
+
+
+def get(url, params=None, timeout=None, retries=None, quota=None, until=None, **kwargs):
+    ###
+    ### GET url through the shared session. Returns the final Response (which may
+    ### still be an error status once retries are exhausted, or, already closed,
+    ### once there is no time left to retry); raises a requests.RequestException on connection
+    ### failure, an open circuit, a spent deadline or (if a quota Governor is
+    ### given) an exhausted quota. until (a time.monotonic() value) is a deadline
+    ### for this call, retries included, on top of the invocation's.
+    ###
+    host = urlsplit(url).netloc
+    breaker, host_stats = _host_state(host)
+    if not breaker.allow():
+        host_stats['rejected'] += 1
+        tracing.incr('http.rejected')
+        raise CircuitOpenError('circuit open for %s' % host)
+    if timeout is None:
+        timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+    if retries is None:
+        retries = MAX_RETRIES
+    try:
+        attempt = 0
+        while True:
+            if quota is not None:
+                quota.acquire()
+            call_timeout = deadline.timeout(timeout, until)
+            if call_timeout == 0:
+                tracing.incr('http.deadline')
+                raise DeadlineExceeded('deadline passed before calling %s' % host)
+            host_stats['requests'] += 1
+            tracing.incr('http.requests')
+            try:
+                r = session.get(url, params=params, timeout=call_timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if call_timeout is not timeout and isinstance(e, requests.Timeout):
+                    # cut short by the deadline rather than by the host
+                    tracing.incr('http.deadline')
+                    raise DeadlineExceeded('deadline passed waiting for %s' % host)
+                if attempt >= retries:
+                    host_stats['failures'] += 1
+                    tracing.incr('http.failures')
+                    breaker.record_failure()
+                    raise
+                logger.debug('retrying host={}, error={}'.format(host, e))
+                r = None
+            else:
+                if r.status_code not in RETRY_STATUSES:
+                    breaker.record_success()
+                    return r
+                if attempt >= retries:
+                    host_stats['failures'] += 1
+                    tracing.incr('http.failures')
+                    breaker.record_failure()
+                    return r
+                logger.debug('retrying host={}, status={}'.format(host, r.status_code))
+            pause = backoff(attempt, r)
+            if r is not None:
+                # hand the connection back to the pool; with stream=True the body of
+                # a response that will be retried or discarded is never read
+                r.close()
+            if deadline.clamp(pause, until) < pause:
+                # no time left to retry, so this attempt's outcome is final
+                tracing.incr('http.deadline')
+                if r is None:
+                    raise DeadlineExceeded('deadline passed retrying %s' % host)
+                return r
+            host_stats['retries'] += 1
+            tracing.incr('http.retries')
+            time.sleep(pause)
+            attempt += 1
+    finally:
+        breaker.release_trial()
+
+
+async def run_async(fn, *args, **kwargs):
+    ###
+    ### Await fn(*args, **kwargs) (e.g. a repository lookup that may call get())
+    ### on the I/O thread pool instead of blocking the event loop.
+    ###
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+
+async def get_async(url, **kwargs):
+    ###
+    ### get() as a coroutine, for gathering with other calls.
+    ###
+    return await run_async(get, url, **kwargs)